@@ -0,0 +1,77 @@
+"""
+Compare the query engines on the staged snapshot of the configured DB (settings.DB_PATH).
+
+Usage:
+    pip install queens[duckdb]
+    python benchmarks/query_engines.py [COLLECTION] [--repeat N]
+
+Two workloads are timed for each engine:
+- table: queens.query() of every staged table, as the API and notebooks do
+- aggregate: a scan of the whole {collection}_prod table, summing values by table and year
+"""
+import argparse
+import time
+
+from tabulate import tabulate
+
+from queens import facade
+from queens import settings as s
+from queens.core import engines as eng
+from queens.core import read_write as rw
+from queens.core import utils as u
+
+
+def _best_of(f, repeat: int) -> float:
+    """Best wall time of `repeat` runs, in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def main(data_collection: str, repeat: int) -> None:
+    tables = rw.read_sql_as_frame(
+        s.DB_PATH,
+        u.generate_select_sql(from_table="_metadata", cols=["table_name"],
+                              where="data_collection = ?", distinct=True),
+        (data_collection,)
+    )["table_name"].tolist()
+
+    aggregate_sql = f"""
+        SELECT table_name, year, SUM(value) AS value
+        FROM {data_collection}_prod
+        GROUP BY table_name, year;
+    """
+
+    workloads = {
+        "table": {
+            "sqlite": lambda: [facade.query(data_collection, t, engine="sqlite") for t in tables],
+            "duckdb": lambda: [facade.query(data_collection, t, engine="duckdb", as_arrow=True) for t in tables],
+        },
+        "aggregate": {
+            "sqlite": lambda: rw.read_sql_as_frame(s.DB_PATH, aggregate_sql),
+            "duckdb": lambda: eng.read_sql_as_arrow(s.DB_PATH, aggregate_sql),
+        },
+    }
+
+    # warm up connections and page cache
+    for runs in workloads.values():
+        for f in runs.values():
+            f()
+
+    rows = [[name, engine, round(_best_of(f, repeat), 1)]
+            for name, runs in workloads.items()
+            for engine, f in runs.items()]
+    print(f"{len(tables)} tables in {data_collection}_prod, best of {repeat} runs")
+    print(tabulate(rows, headers=["workload", "engine", "ms"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("collection", nargs="?", default="dukes")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    main(args.collection, args.repeat)
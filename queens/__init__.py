@@ -4,14 +4,19 @@ logging.getLogger(__name__).addHandler(logging.NullHandler())
 
 # configuration
 from .settings import set_config, setup_logging
-from .facade import  ingest, stage, info, metadata, versions, query, export
+from .facade import  ingest, stage, info, metadata, versions, query, aggregate, export, maintain, snapshots, drop_snapshot, diff
 
 __all__ = ["set_config",
            "setup_logging",
            "ingest",
            "stage",
            "query",
+           "aggregate",
            "metadata",
            "info",
            "versions",
-           "export"]
+           "export",
+           "maintain",
+           "snapshots",
+           "drop_snapshot",
+           "diff"]
@@ -2,99 +2,271 @@ import os
 # silence numexpr message when importing pandas
 os.environ.setdefault("NUMEXPR_NUM_THREADS", "8")
 
+import hashlib
 import sqlite3
+import threading
 import fastapi as f
-from typing import Optional
+import fastapi.responses
+from typing import Optional, Union, Tuple, List
 from contextlib import asynccontextmanager
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel, Field
 
 from ..core import utils as u
+from ..core import engines as eng
+from ..core import read_write as rw
 import json
 
 from ..etl import validation as vld
-from ..core.read_write import read_sql_as_frame
+from ..etl.bootstrap import verify_read_only
+from ..etl.process import get_data_diff
 from .. import settings as s
+from . import serialize as ser
+from .cache import ResponseCache
+from .registry import MetadataRegistry
 
 DEFAULT_LIMIT = 1000
 MAX_LIMIT = 5000
+STREAM_BATCH_SIZE = 5000
+MAX_BATCH = 20
+BATCH_WORKERS = 4
+
+# cacheable by clients and proxies, revalidated with the ETag on every use
+CACHE_CONTROL = "public, no-cache"
+
+
+# set once the worker has loaded its metadata registry, cleared when it starts shutting down
+ready = threading.Event()
+
+# long-lived threads running parallel /batch queries, so that their pooled read connections
+# are reused across requests. Started and stopped by lifespan
+batch_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _stop_batch_executor()-> None:
+    """Close the pooled connections of the batch threads, then stop them."""
+    global batch_executor
+    pool, batch_executor = batch_executor, None
+    if pool is None:
+        return
+
+    # the barrier keeps each task on its own thread, so that every thread closes its connections
+    barrier = threading.Barrier(BATCH_WORKERS)
+
+    def close()-> None:
+        try:
+            barrier.wait(timeout=5)
+        except threading.BrokenBarrierError:
+            pass
+        rw.close_readers()
+        eng.close_duckdb()
+
+    for _ in range(BATCH_WORKERS):
+        pool.submit(close)
+    pool.shutdown(wait=True)
 
 
 @asynccontextmanager
 async def lifespan(a: f.FastAPI):
     """
-    Set up API logger.
+    Set up API logger. In read-only mode, verify that the DB can be served as immutable.
+    Load the metadata registry, so that the first requests only do memory lookups.
+    Each worker process runs this on its own (see `queens serve --workers`): it opens its own
+    connections and warms its own registry, and only reports ready on /health afterwards.
+    On shutdown (after in-flight requests are done) the worker reports unavailable and
+    releases its caches and connections.
     """
     s.setup_logging(to_console=False, to_file=True, file_name="queens_api.log")
-    logging.getLogger(__name__).info("QUEENS API started.")
+    response_cache.clear()
+    response_cache.max_bytes = s.RESPONSE_CACHE_SIZE
+    if s.READ_ONLY:
+        staged = verify_read_only(s.DB_PATH, s.SCHEMA)
+        logging.getLogger(__name__).info(f"Serving read-only snapshot of {staged}.")
+
+    metadata_registry.clear()
+    metadata_registry.load(s.DB_PATH, _cache_version())
+
+    global batch_executor
+    _stop_batch_executor()
+    batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="queens-batch")
+    ready.set()
+    logging.getLogger(__name__).info(f"QUEENS API started (worker {os.getpid()}).")
 
     yield
 
+    ready.clear()
+    _stop_batch_executor()
+    metadata_registry.clear()
+    response_cache.clear()
+    rw.close_readers()
+    logging.getLogger(__name__).info(f"QUEENS API stopped (worker {os.getpid()}).")
+
 
 app = f.FastAPI(
     title="QUEENS API",
     lifespan=lifespan
 )
 
+# serialised /data and /metadata responses, invalidated when the snapshot version changes
+response_cache = ResponseCache(s.RESPONSE_CACHE_SIZE)
+
+# column types and cast maps of the staged tables, reloaded when the snapshot version changes
+metadata_registry = MetadataRegistry()
+
+
+def _cache_version()-> str:
+    """Version of the served data: DB path and snapshot version token."""
+    return f"{s.DB_PATH}:{rw.get_snapshot_version(s.DB_PATH)}"
+
+
+def _normalize_filters(filters: Optional[str])-> Optional[str]:
+    """Canonical form of a filters JSON string, used in cache keys (as passed if malformed)."""
+    if not filters:
+        return None
+    try:
+        return json.dumps(json.loads(filters), sort_keys=True, separators=(",", ":"))
+    except json.JSONDecodeError:
+        return filters
+
+
+def _etag(version: str, cache_key: tuple)-> str:
+    """Strong ETag of a response: digest of the snapshot version and the normalised request."""
+    digest = hashlib.blake2b(repr((version, cache_key)).encode("utf-8"), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str)-> bool:
+    """Whether an If-None-Match header matches the ETag (weak comparison, as required for GET)."""
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.removeprefix("W/") == etag for t in tags)
+
+
+def _not_modified(etag: str)-> f.Response:
+    """304 response for a conditional GET whose ETag still matches."""
+    return f.Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL, "Vary": "Accept"})
+
+
+def _cached_response(entry: tuple, status: str, etag: str)-> f.Response:
+    """Build a response from a cache entry (body, media_type, headers)."""
+    body, media_type, headers = entry
+    return f.Response(content=body,
+                      media_type=media_type,
+                      headers={**headers,
+                               "X-Cache": status,
+                               "ETag": etag,
+                               "Cache-Control": CACHE_CONTROL,
+                               "Vary": "Accept"})
+
 # -----------------
 # startup
 # -----------------
 
-@app.get("/data/{collection}")
-def get_data(
-    collection: str = f.Path(..., description="Data collection key, e.g. 'dukes'"),
-    table_name: str = f.Query(..., description="Table identifier within the collection, e.g. '1.1'"),
-    filters: Optional[str] = f.Query(
-        None,
-        description=(
-            "JSON string of filters. Supports flat and nested forms. "
-            'Examples: {"year": 2022, "fuel": "Petroleum products"} '
-            'or {"year": {"gte": 2010}, "fuel": {"like": "%gas%"}} '
-            'or {"$or": [{"fuel": "Gas"},{"fuel": "Coal"}], "year": {"gt": 2020}}'
-        ),
-    ),
-    limit: int = f.Query(DEFAULT_LIMIT, ge=1, description=f"Max rows per page (<= {MAX_LIMIT})"),
-    cursor: Optional[int] = f.Query(None, description="Pagination cursor (internal rowid); return rows with rowid > cursor"),
+FILTERS_DESCRIPTION = (
+    "JSON string of filters. Supports flat and nested forms. "
+    'Examples: {"year": 2022, "fuel": "Petroleum products"} '
+    'or {"year": {"gte": 2010}, "fuel": {"like": "%gas%"}} '
+    'or {"$or": [{"fuel": "Gas"},{"fuel": "Coal"}], "year": {"gt": 2020}}'
+)
 
-)-> dict:
-    """
-    Return rows from `{collection}_prod` filtered by `table_name` + optional filters.
-    Cursor pagination: results are ordered by internal `rowid`. Pass back `next_cursor` from the
-    previous response to get the next page. Columns `ingest_id`,`ingest_ts` are removed.
 
+def _resolve_table(
+        collection: str,
+        table_name: str,
+        as_of: Optional[str],
+        snapshot: Optional[str],
+        version: str
+)-> Tuple[tuple, Optional[str]]:
     """
+    Check that the requested table exists (staged, in the named snapshot, or with a version at
+    as_of) and return its column info with the as_of cutoff. Staged tables are looked up in the
+    metadata registry, in memory. Run before conditional GET checks, so that a missing resource
+    gets 404 rather than 304. Errors are raised as HTTPException.
 
+    Returns:
+        a tuple (column_info, cutoff), cutoff being None unless as_of is passed
+    """
     # check that the data collection exists
     try:
         u.check_inputs(data_collection=collection, etl_config=s.ETL_CONFIG)
     except NameError as e:
         raise f.HTTPException(status_code=404, detail=str(e))
 
-    # ensure the requested table_name is actually staged
-    # (present in _metadata)
-    # Not enouch to check on ETL_CONFIG
-    exists_q = u.generate_select_sql(
-        from_table="_metadata",
-        cols=["column_name"],
-        where="data_collection = ? AND table_name = ?"
-    )
-    exists_df = read_sql_as_frame(
-        conn_path=s.DB_PATH,
-        query=exists_q,
-        query_params=(collection, table_name)
-    )
-    if exists_df.empty:
-        raise f.HTTPException(
-            status_code=404,
-            detail=f"Table '{table_name}' is not staged for collection '{collection}'."
-        )
+    if as_of is not None and snapshot is not None:
+        raise f.HTTPException(status_code=422, detail="Pass either as_of or snapshot, not both.")
+
+    cutoff = None
+    if as_of is not None:
+        # as-of reads: the table must have a version at the cutoff
+        try:
+            cutoff = u.parse_cutoff(as_of)
+        except ValueError as e:
+            raise f.HTTPException(status_code=422, detail=f"Invalid as_of date: {e}")
+
+        if table_name not in rw.get_selected_versions(s.DB_PATH, collection, cutoff):
+            raise f.HTTPException(
+                status_code=404,
+                detail=f"Table '{table_name}' has no version for collection '{collection}' as of {as_of}."
+            )
+        # RAW versions have no metadata: columns are validated against the schema
+        column_info = rw.schema_column_info(collection, s.SCHEMA)
+    else:
+        # ensure the requested table_name is actually staged
+        # (present in _metadata, or _snapshot_metadata for a named snapshot)
+        # Not enouch to check on ETL_CONFIG
+        column_info = metadata_registry.get(s.DB_PATH, version, collection, table_name, snapshot)
+        if column_info is None:
+            staged_in = "staged" if snapshot is None else f"in snapshot '{snapshot}'"
+            raise f.HTTPException(
+                status_code=404,
+                detail=f"Table '{table_name}' is not {staged_in} for collection '{collection}'."
+            )
+
+    return column_info, cutoff
+
+
+def _prepare_data_query(
+        collection: str,
+        table_name: str,
+        filters: Union[str, dict, None],
+        as_of: Optional[str],
+        snapshot: Optional[str],
+        version: str,
+        fields: Optional[list] = None,
+        table_info: Optional[tuple] = None
+)-> dict:
+    """
+    Validate a data request and resolve it into the source table and WHERE clause shared by
+    the data endpoints. Column types come from the metadata registry at the given snapshot
+    version, so validation runs without queries. Errors are raised as HTTPException.
+    Filters can be passed as a JSON string (query parameters) or already parsed (JSON bodies).
+    With fields, only those data columns are selected. table_info is the result of
+    _resolve_table, if the endpoint already ran it.
+
+    Returns:
+        a dictionary with from_table, rowid_col (column used for ordering and cursors),
+        where_sql, query_params, columns (the data columns of the table), sql_types,
+        select_cols (the columns to select besides the rowid) and drop_empty (whether
+        all-null columns must be dropped from the result)
+    """
+    if table_info is None:
+        table_info = _resolve_table(collection, table_name, as_of, snapshot, version)
+    column_info, cutoff = table_info
 
     # parse filters (string to dict)
     try:
         logging.debug("Parsing filter JSON string.")
-        filters_dict = json.loads(filters) if filters else {}
+        if isinstance(filters, dict):
+            filters_dict = dict(filters)
+        else:
+            filters_dict = json.loads(filters) if filters else {}
     except json.JSONDecodeError as e:
         logging.error("Malformed filter string")
         raise f.HTTPException(status_code=400, detail=str(e))
+    if not isinstance(filters_dict, dict):
+        raise f.HTTPException(status_code=400, detail="Filters must be a JSON object.")
 
     # normalise filters
     try:
@@ -102,8 +274,8 @@ def get_data(
         base_raw, or_raw = vld.normalize_filters(filters_dict)
 
         # validate+cast each group
-        base = vld.validate_query_filters(collection, table_name, base_raw, s.DB_PATH, s.SCHEMA)
-        ors = [vld.validate_query_filters(collection, table_name, g,s.DB_PATH, s.SCHEMA) for g in or_raw]
+        base = vld.validate_query_filters(collection, table_name, base_raw, s.DB_PATH, s.SCHEMA, column_info)
+        ors = [vld.validate_query_filters(collection, table_name, g,s.DB_PATH, s.SCHEMA, column_info) for g in or_raw]
     except (KeyError, ValueError, TypeError, NameError) as e:
         logging.error("Invalid columns, operators or value passed")
         raise f.HTTPException(status_code=422, detail=str(e))
@@ -123,30 +295,77 @@ def get_data(
         logging.error("Error while generating WHERE clause: " + str(e))
         raise f.HTTPException(status_code=422, detail=str(e))
 
-    # cap maximum response length
-    limit = min(int(limit), MAX_LIMIT)
+    from_table, rowid_col = f"{collection}_prod", "rowid"
+    if snapshot is not None:
+        from_table = rw.snapshot_table(collection, snapshot)
+    elif as_of is not None:
+        from_table, rowid_col = f"{collection}_history", "raw_rowid"
+        where_sql = u.generate_as_of_where(where_sql)
+        query_params = [collection, table_name, cutoff] + query_params
+
+    # data columns in schema order (metadata only lists the non-empty ones)
+    sql_types = column_info[0]
+    columns = u.get_table_columns(collection, s.SCHEMA, sql_types)
+
+    # column projection: the columns of the table in the metadata, so that the empty columns
+    # of PROD are not read. as_of reads have no metadata and drop them from the result instead
+    select_cols = ["table_description"] + [u.quote_identifier(c) for c in columns]
+    drop_empty = as_of is not None and not fields
+    if fields:
+        try:
+            fields = vld.validate_fields(collection, table_name, fields, s.DB_PATH, s.SCHEMA, column_info)
+        except (KeyError, NameError) as e:
+            logging.error("Invalid fields passed")
+            raise f.HTTPException(status_code=422, detail=str(e))
+        select_cols = ["table_description"] + [u.quote_identifier(c) for c in fields]
+
+    return {"from_table": from_table,
+            "rowid_col": rowid_col,
+            "where_sql": where_sql,
+            "query_params": query_params,
+            "columns": columns,
+            "sql_types": sql_types,
+            "select_cols": select_cols,
+            "drop_empty": drop_empty}
+
+
+def _fetch_page(
+        q: dict,
+        limit: int,
+        cursor: Optional[int]
+)-> Tuple[list, list, Optional[int]]:
+    """
+    Read one page of a prepared data query (see _prepare_data_query), ordered by rowid.
+    Pages are always read with SQLite: a rowid range on the pooled connection is a short
+    index seek, and the rowid of the attached tables is not exposed the same way by DuckDB.
+
+    Returns:
+        a tuple (column names, rows, next_cursor), with the rowid as first column.
+        next_cursor is None on the last page
+    """
+    rowid_col = q["rowid_col"]
+    where_sql, query_params = q["where_sql"], list(q["query_params"])
 
-    # final query
     try:
         logging.debug("Generate query and read data from DB.")
         where_curs = where_sql
         if cursor is not None:
-            where_curs = f"({where_sql}) AND (rowid > ?)"
+            where_curs = f"({where_sql}) AND ({rowid_col} > ?)"
             query_params.append(int(cursor))
 
         # generate the query
         query = u.generate_select_sql(
-            cols=["rowid", "*"],
-            from_table=f"{collection}_prod",
+            cols=[f"{rowid_col} AS rowid"] + q["select_cols"],
+            from_table=q["from_table"],
             where=where_curs,
-            order_by=["rowid"],
+            order_by=[rowid_col],
             limit=True
         )
 
         # add limit to parameters
         query_params.append(limit)
 
-        df = read_sql_as_frame(
+        columns, rows = rw.read_sql_rows(
             conn_path=s.DB_PATH,
             query=query,
             query_params=tuple(query_params)
@@ -158,56 +377,356 @@ def get_data(
         logging.error("Unexpected error: " + str(e))
         raise f.HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
-    if df is None or df.empty:
-        return {"data": [], "next_cursor": None, "table_description": None}
-
-    # optimistic last-page check
-    if len(df) < limit:
+    # optimistic last-page check (rowid is the first column)
+    if len(rows) < limit:
         next_cursor = None
     else:
-        next_cursor = int(df["rowid"].iloc[-1])
+        next_cursor = int(rows[-1][0])
 
-    # get table description
-    table_description = df["table_description"].values[0]
+    return columns, rows, next_cursor
 
-    # drop service/internal columns
-    df.drop(columns=["rowid",
-                     "ingest_id",
-                     "ingest_ts",
-                     "table_description"],
-            inplace=True,
-            errors="ignore")
-    df.dropna(axis=1, how="all", inplace=True)
 
-    # compound response
-    return {"data": df.to_dict(orient="records"),
-            "table_description": table_description,
+def _json_page(
+        columns: list,
+        rows: list,
+        next_cursor: Optional[int],
+        drop_empty: bool = True
+)-> dict:
+    """JSON body of a data page, without service/internal (and, with drop_empty, empty) columns."""
+    if not rows:
+        return {"data": [], "next_cursor": None, "table_description": None}
+
+    return {"data": ser.records_from_rows(columns, rows, drop_empty=drop_empty),
+            "table_description": rows[0][columns.index("table_description")],
             "next_cursor": next_cursor}
 
 
+def _response_format(
+        fmt: Optional[str],
+        accept: Optional[str],
+        formats: dict,
+        default: str
+)-> str:
+    """Resolve the response format of a request (see serialize.negotiate_format), 422 if invalid."""
+    try:
+        return ser.negotiate_format(fmt, accept, formats, default)
+    except ValueError as e:
+        raise f.HTTPException(status_code=422, detail=str(e))
 
-@app.get("/metadata/{collection}")
-def get_metadata(
-        collection: str,
-        table_name: str
-)-> dict:
 
+@app.get("/data/{collection}")
+def get_data(
+    collection: str = f.Path(..., description="Data collection key, e.g. 'dukes'"),
+    table_name: str = f.Query(..., description="Table identifier within the collection, e.g. '1.1'"),
+    filters: Optional[str] = f.Query(None, description=FILTERS_DESCRIPTION),
+    limit: int = f.Query(DEFAULT_LIMIT, ge=1, description=f"Max rows per page (<= {MAX_LIMIT})"),
+    cursor: Optional[int] = f.Query(None, description="Pagination cursor (internal rowid); return rows with rowid > cursor"),
+    as_of: Optional[str] = f.Query(None, description="Read the version of the table current at this date (YYYY-MM-DD) instead of the staged snapshot"),
+    snapshot: Optional[str] = f.Query(None, description="Read from a named snapshot (see `queens stage --name`) instead of the staged data"),
+    fields: Optional[str] = f.Query(None, description="Comma-separated columns to return, e.g. 'year,fuel,value'. Default is all columns of the table"),
+    format: Optional[str] = f.Query(None, description="Response format: json (default), arrow or parquet. Overrides the Accept header"),
+    accept: Optional[str] = f.Header(None, include_in_schema=False),
+    if_none_match: Optional[str] = f.Header(None, include_in_schema=False),
+
+)-> f.Response:
+    """
+    Return rows from `{collection}_prod` filtered by `table_name` + optional filters.
+    Cursor pagination: results are ordered by internal `rowid`. Pass back `next_cursor` from the
+    previous response to get the next page. Columns `ingest_id`,`ingest_ts` are removed.
+    With `as_of`, rows are read from the version of the table that was current at that date
+    (`{collection}_history`), without touching the staged snapshot. With `snapshot`, rows are
+    read from the named snapshot `{collection}_snap_{snapshot}`. With `fields`, only those columns
+    are selected (validated against the table metadata).
+    Rows go from the cursor straight to JSON bytes (with orjson if installed), without pandas.
+    With `format=arrow|parquet` (or an Accept header with their media type) the page is returned
+    as an Arrow IPC stream or a Parquet file, built column by column from the cursor rows; the
+    cursor and the table description are then in the `X-Next-Cursor` header and in the schema metadata.
+
+    """
+    fmt = _response_format(format, accept, {**ser.JSON_FORMATS, **ser.BINARY_FORMATS}, "json")
+
+    # cap maximum response length
+    limit = min(int(limit), MAX_LIMIT)
+
+    # serve repeated queries from the cache while the snapshot is unchanged
+    version = _cache_version()
+    table_info = _resolve_table(collection, table_name, as_of, snapshot, version)
+    field_list = [c.strip() for c in fields.split(",") if c.strip()] if fields else None
+    cache_key = ("data", collection, table_name, _normalize_filters(filters), cursor, limit, fmt, as_of, snapshot,
+                 tuple(field_list or ()))
+    etag = _etag(version, cache_key)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+
+    cached = response_cache.get(cache_key, version)
+    if cached is not None:
+        return _cached_response(cached, "HIT", etag)
+
+    q = _prepare_data_query(collection, table_name, filters, as_of, snapshot, version,
+                            fields=field_list, table_info=table_info)
+    columns, rows, next_cursor = _fetch_page(q, limit, cursor)
+
+    if fmt in ser.BINARY_FORMATS:
+        # binary columnar page, without service/internal and empty columns
+        keep = ser.kept_columns(columns, rows, drop_empty=q["drop_empty"])
+        metadata = {"next_cursor": "" if next_cursor is None else str(next_cursor)}
+        if rows:
+            metadata["table_description"] = rows[0][columns.index("table_description")] or ""
+        schema = ser.arrow_schema([columns[i] for i in keep], q["sql_types"], metadata)
+        headers = {} if next_cursor is None else {"X-Next-Cursor": str(next_cursor)}
+        entry = (ser.binary_bytes(fmt, ser.rows_to_batch(rows, schema, keep)), ser.BINARY_FORMATS[fmt], headers)
+
+    else:
+        entry = (ser.dumps(_json_page(columns, rows, next_cursor, q["drop_empty"])), "application/json", {})
+
+    response_cache.put(cache_key, version, entry)
+    return _cached_response(entry, "MISS", etag)
+
+
+@app.get("/stream/{collection}")
+def stream_data(
+    collection: str = f.Path(..., description="Data collection key, e.g. 'dukes'"),
+    table_name: str = f.Query(..., description="Table identifier within the collection, e.g. '1.1'"),
+    filters: Optional[str] = f.Query(None, description=FILTERS_DESCRIPTION),
+    format: Optional[str] = f.Query(None, description=f"Output format, one of {list(ser.STREAM_FORMATS)} (default ndjson). Overrides the Accept header"),
+    as_of: Optional[str] = f.Query(None, description="Read the version of the table current at this date (YYYY-MM-DD) instead of the staged snapshot"),
+    snapshot: Optional[str] = f.Query(None, description="Read from a named snapshot (see `queens stage --name`) instead of the staged data"),
+    accept: Optional[str] = f.Header(None, include_in_schema=False),
+)-> f.responses.StreamingResponse:
+    """
+    Stream all the rows of a table matching the filters (same parameters as `/data`) in a
+    single response, as NDJSON (one record per line), CSV, an Arrow IPC stream (one record batch
+    per batch) or a Parquet file (one row group per batch). Rows are read from the cursor in
+    batches of STREAM_BATCH_SIZE, so memory stays bounded whatever the size of the table.
+    Service columns are removed and only the columns listed in the table metadata are returned.
+    as_of streams have no metadata: they return every schema column (the empty ones included),
+    as the columns cannot be known before the last batch is read.
+
+    """
+    fmt = _response_format(format, accept, ser.STREAM_FORMATS, "ndjson")
+    q = _prepare_data_query(collection, table_name, filters, as_of, snapshot, _cache_version())
+
+    query = u.generate_select_sql(
+        cols=[f"[{c}]" for c in q["columns"]],
+        from_table=q["from_table"],
+        where=q["where_sql"],
+        order_by=[q["rowid_col"]]
+    )
+    try:
+        columns, batches = rw.iter_sql_rows(
+            conn_path=s.DB_PATH,
+            query=query,
+            query_params=tuple(q["query_params"]),
+            batch_size=STREAM_BATCH_SIZE
+        )
+    except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+        logging.error("Database error: " + str(e))
+        raise f.HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    if fmt in ser.BINARY_FORMATS:
+        chunks = ser.binary_chunks(fmt, ser.arrow_schema(columns, q["sql_types"]), batches)
+    elif fmt == "csv":
+        chunks = ser.csv_chunks(columns, batches)
+    else:
+        chunks = ser.ndjson_chunks(columns, batches)
+
+    file_name = f"{collection}_{table_name}.{fmt}"
+    return f.responses.StreamingResponse(
+        chunks,
+        media_type=ser.STREAM_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'}
+    )
+
+
+class BatchQuery(BaseModel):
+    """One query of a /batch request: the same parameters as /data (JSON output only)."""
+    id: Optional[str] = Field(None, description="Key of the result. Default is the position in the batch")
+    table_name: str
+    filters: Optional[dict] = None
+    limit: int = Field(DEFAULT_LIMIT, ge=1)
+    cursor: Optional[int] = None
+    fields: Optional[List[str]] = None
+    as_of: Optional[str] = None
+    snapshot: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    queries: List[BatchQuery] = Field(..., min_length=1, max_length=MAX_BATCH)
+    parallel: bool = Field(False, description="Run the queries on the batch threads of the worker instead of one after the other")
+
+
+def _run_batch_query(collection: str, bq: BatchQuery, version: str)-> dict:
+    """Run one query of a batch; HTTP errors are returned in the result instead of raised."""
     try:
-        # verify existence of data collection
-        u.check_inputs(
-            data_collection=collection,
-            etl_config=s.ETL_CONFIG)
+        q = _prepare_data_query(collection, bq.table_name, bq.filters, bq.as_of, bq.snapshot,
+                                version, fields=bq.fields)
+        columns, rows, next_cursor = _fetch_page(q, min(bq.limit, MAX_LIMIT), bq.cursor)
+    except f.HTTPException as e:
+        return {"error": {"status": e.status_code, "detail": e.detail}}
+
+    return _json_page(columns, rows, next_cursor, q["drop_empty"])
+
+
+@app.post("/batch/{collection}")
+def post_batch(
+    batch: BatchRequest,
+    collection: str = f.Path(..., description="Data collection key, e.g. 'dukes'"),
+)-> f.Response:
+    """
+    Run several /data queries on tables of `collection` in one round trip.
+    Each query takes the /data parameters (`filters` as a JSON object) plus an optional `fields`
+    list, and its page is returned under its `id` (or its position in the batch). A failing
+    query returns `{"error": {"status", "detail"}}` without failing the others.
+    Queries run one after the other on the pooled read connection of the handler thread; with
+    `parallel`, they are spread over the long-lived batch threads of the worker (BATCH_WORKERS),
+    whose pooled connections are reused across requests.
+
+    """
+    ids = [bq.id if bq.id is not None else str(i) for i, bq in enumerate(batch.queries)]
+    if len(set(ids)) < len(ids):
+        raise f.HTTPException(status_code=422, detail="Query ids must be unique within a batch.")
+
+    version = _cache_version()
+    pool = batch_executor
+    if batch.parallel and pool is not None and len(batch.queries) > 1:
+        pages = list(pool.map(lambda bq: _run_batch_query(collection, bq, version), batch.queries))
+    else:
+        pages = [_run_batch_query(collection, bq, version) for bq in batch.queries]
 
+    return f.Response(content=ser.dumps({"results": dict(zip(ids, pages))}),
+                      media_type="application/json")
+
+
+@app.get("/aggregate/{collection}")
+def get_aggregate(
+    collection: str = f.Path(..., description="Data collection key, e.g. 'dukes'"),
+    table_name: str = f.Query(..., description="Table identifier within the collection, e.g. '1.1'"),
+    group_by: Optional[str] = f.Query(None, description="Comma-separated dimension columns to group by, e.g. 'year,fuel'. Default aggregates the whole selection"),
+    agg: str = f.Query("sum", description=f"Aggregate function applied to value: {', '.join(s.AGG_SQL)}"),
+    filters: Optional[str] = f.Query(None, description=FILTERS_DESCRIPTION),
+    as_of: Optional[str] = f.Query(None, description="Aggregate the version of the table current at this date (YYYY-MM-DD)"),
+    snapshot: Optional[str] = f.Query(None, description="Aggregate a named snapshot instead of the staged data"),
+    if_none_match: Optional[str] = f.Header(None, include_in_schema=False),
+)-> f.Response:
+    """
+    Aggregate the `value` column of a table in SQL, grouped by the `group_by` dimensions, after
+    applying the same filters as `/data`. Returns `{"data": [...]}` with one record per group
+    (the group_by columns and the aggregate as `value`), ordered by group.
+
+    """
+    group_cols = [c.strip() for c in group_by.split(",") if c.strip()] if group_by else []
+
+    version = _cache_version()
+    table_info = _resolve_table(collection, table_name, as_of, snapshot, version)
+    cache_key = ("aggregate", collection, table_name, tuple(group_cols), agg,
+                 _normalize_filters(filters), as_of, snapshot)
+    etag = _etag(version, cache_key)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+
+    cached = response_cache.get(cache_key, version)
+    if cached is not None:
+        return _cached_response(cached, "HIT", etag)
+
+    q = _prepare_data_query(collection, table_name, filters, as_of, snapshot, version, table_info=table_info)
+    try:
+        group_cols = vld.validate_aggregate(collection, table_name, group_cols, agg, s.DB_PATH,
+                                            s.SCHEMA, (q["sql_types"], None))
+    except (KeyError, ValueError, NameError) as e:
+        logging.error("Invalid aggregate function or group_by columns passed")
+        raise f.HTTPException(status_code=422, detail=str(e))
+
+    try:
+        query = u.generate_aggregate_sql(
+            from_table=q["from_table"],
+            group_by=group_cols,
+            agg_func=s.AGG_SQL[agg],
+            where=q["where_sql"]
+        )
+        use_duckdb = eng.check_engine() == "duckdb" and as_of is None
+        read_rows = eng.read_sql_rows if use_duckdb else rw.read_sql_rows
+        columns, rows = read_rows(
+            conn_path=s.DB_PATH,
+            query=query,
+            query_params=tuple(q["query_params"])
+        )
+    except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+        logging.error("Database error: " + str(e))
+        raise f.HTTPException(status_code=500, detail=f"Database error: {e}")
+
+    entry = (ser.dumps({"data": [dict(zip(columns, r)) for r in rows]}), "application/json", {})
+    response_cache.put(cache_key, version, entry)
+    return _cached_response(entry, "MISS", etag)
+
+
+@app.get("/diff/{collection}")
+def get_diff(
+    collection: str = f.Path(..., description="Data collection key, e.g. 'dukes'"),
+    from_ts: str = f.Query(..., description="Date (YYYY-MM-DD) or ingest timestamp of the old vintage"),
+    to_ts: Optional[str] = f.Query(None, description="Date (YYYY-MM-DD) or ingest timestamp of the new vintage. Default is the latest"),
+    table_name: Optional[str] = f.Query(None, description="Optional table identifier. Default compares all tables"),
+    detail: bool = f.Query(False, description="Return the added, removed and changed cells instead of the counts per table"),
+    limit: int = f.Query(DEFAULT_LIMIT, ge=1, description=f"Max cells returned with detail (<= {MAX_LIMIT})"),
+)-> dict:
+    """
+    Compare the versions of the tables of `collection` selected at two cutoffs. By default,
+    return the number of added, removed, changed and unchanged cells per table. With `detail`,
+    return the changed cells (dimension columns, `change`, `old_value`, `new_value`).
+
+    """
+    try:
+        df = get_data_diff(data_collection=collection,
+                           from_ts=from_ts,
+                           to_ts=to_ts,
+                           table_name=table_name,
+                           detail=detail)
     except NameError as e:
-        logging.error("Unknown data collection or table name")
         raise f.HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise f.HTTPException(status_code=422, detail=f"Invalid timestamp: {e}")
+    except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+        logging.error("Database error: " + str(e))
+        raise f.HTTPException(status_code=500, detail=f"Database error: {e}")
+
+    truncated = False
+    if detail:
+        limit = min(int(limit), MAX_LIMIT)
+        truncated = len(df) > limit
+        df = df.head(limit).dropna(axis=1, how="all")
+
+    # NaN is not valid JSON
+    df = df.astype(object).where(df.notna(), None)
+
+    return {"data": df.to_dict(orient="records"),
+            "truncated": truncated}
+
+
+@app.get("/metadata/{collection}")
+def get_metadata(
+        collection: str,
+        table_name: str,
+        if_none_match: Optional[str] = f.Header(None, include_in_schema=False)
+)-> f.Response:
+
+    # verify that the table is staged (before the conditional GET: missing tables get 404)
+    version = _cache_version()
+    _resolve_table(collection, table_name, None, None, version)
+
+    cache_key = ("metadata", collection, table_name)
+    etag = _etag(version, cache_key)
+    if _etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+
+    cached = response_cache.get(cache_key, version)
+    if cached is not None:
+        return _cached_response(cached, "HIT", etag)
 
     try:
         query = u.generate_select_sql(
             from_table="_metadata",
             where="data_collection = ? AND table_name =?"
         )
-        df = read_sql_as_frame(
+        columns, rows = rw.read_sql_rows(
             conn_path=s.DB_PATH,
             query=query,
             query_params=(collection, table_name)
@@ -219,4 +738,36 @@ def get_metadata(
         logging.error("Unexpected error: " + str(e))
         raise f.HTTPException(status_code=500, detail=f"Unexpected error: {e}")
 
-    return {"data": df.to_dict(orient="records")}
+    entry = (ser.dumps({"data": [dict(zip(columns, r)) for r in rows]}), "application/json", {})
+    response_cache.put(cache_key, version, entry)
+    return _cached_response(entry, "MISS", etag)
+
+
+@app.get("/cache/stats")
+def get_cache_stats()-> dict:
+    """
+    Size, hit and miss counters of the response cache of this worker.
+    """
+    return response_cache.stats()
+
+
+@app.get("/health")
+def get_health(response: f.Response)-> dict:
+    """
+    Readiness of the worker serving the request, for load balancers and process managers:
+    200 once its metadata registry is loaded and the database answers, 503 while it is
+    starting or shutting down. `snapshot_version` shows which data the worker serves.
+    """
+    body = {"status": "ready", "pid": os.getpid(), "read_only": s.READ_ONLY}
+    if not ready.is_set():
+        body["status"] = "unavailable"
+    else:
+        try:
+            body["snapshot_version"] = rw.get_snapshot_version(s.DB_PATH)
+        except sqlite3.DatabaseError as e:
+            logging.error("Database error: " + str(e))
+            body.update(status="unavailable", detail=f"Database error: {e}")
+
+    if body["status"] != "ready":
+        response.status_code = 503
+    return body
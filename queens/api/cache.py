@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of serialised API responses, valid for one snapshot version.
+
+    Entries are (body, media_type, headers) tuples keyed on the normalised request. The
+    cache holds the snapshot version token (see read_write.get_snapshot_version) its entries
+    were computed for: looking up or storing an entry with a different token drops all the
+    entries, so a `queens stage` (or any other write) invalidates the cache of every worker
+    without any coordination. The total size of the cached bodies is kept under max_bytes,
+    evicting the least recently used entries first; max_bytes=0 disables the cache.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self)-> bool:
+        return self.max_bytes > 0
+
+    def _check_version(self, version: str)-> None:
+        """Drop all entries if the snapshot version changed (lock held by the caller)."""
+        if version != self._version:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+
+    def get(self, key: tuple, version: str)-> Optional[tuple]:
+        """
+        Return the cached entry for key at the given snapshot version, or None.
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: tuple, version: str, entry: tuple)-> None:
+        """
+        Store an entry (body, media_type, headers) computed at the given snapshot version.
+        Bodies larger than a quarter of the cache are not stored.
+        """
+        size = len(entry[0])
+        if not self.enabled or size > self.max_bytes // 4:
+            return
+
+        with self._lock:
+            self._check_version(version)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[0])
+
+    def clear(self)-> None:
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = None
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self)-> dict:
+        """Counters and size of the cache."""
+        with self._lock:
+            return {"enabled": self.enabled,
+                    "entries": len(self._entries),
+                    "bytes": self._bytes,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "snapshot_version": self._version}
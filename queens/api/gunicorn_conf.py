@@ -0,0 +1,32 @@
+"""
+Gunicorn settings for serving the QUEENS API with several worker processes:
+
+    gunicorn -c python:queens.api.gunicorn_conf queens.api.app:app
+
+Requires the optional dependency (pip install queens[serve]). Workers are Uvicorn workers that
+share the SQLite file; the app is not preloaded, so each worker opens its own connections and
+warms its own metadata registry (see app.lifespan) and reports ready on /health. Settings can be
+overridden on the command line or through the environment variables below.
+"""
+import logging
+import os
+
+from .. import settings as s
+from ..etl.bootstrap import verify_read_only
+
+bind = os.environ.get("QUEENS_BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# SQLite connections must not be inherited across fork
+preload_app = False
+
+# in-flight requests are completed before the workers exit
+graceful_timeout = s.SHUTDOWN_TIMEOUT
+
+
+def on_starting(server)-> None:
+    """Check once, in the master process, that the DB can be served read-only."""
+    if s.READ_ONLY:
+        staged = verify_read_only(s.DB_PATH, s.SCHEMA)
+        logging.getLogger(__name__).info(f"Serving read-only snapshot of {staged} with {server.cfg.workers} workers.")
@@ -0,0 +1,64 @@
+import logging
+import threading
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+from ..core import read_write as rw
+
+
+class MetadataRegistry:
+    """
+    In-memory copy of the column info (SQL types and cast maps) of every staged table and
+    named snapshot, so that request validation only does dictionary lookups.
+
+    The registry is loaded with one query per metadata table and is tied to the snapshot
+    version token it was loaded at (see read_write.get_snapshot_version): looking up a table
+    with a different token reloads it first, so a `queens stage` is picked up by every worker.
+    """
+
+    def __init__(self):
+        self._info = {}
+        self._version = None
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def load(self, conn_path: Union[str, Path], version: str)-> None:
+        """
+        (Re)load the column info of all tables from the DB.
+
+        Args:
+            conn_path: Database path
+            version: snapshot version the DB is at (see api.app._cache_version)
+        """
+        with self._lock:
+            if version == self._version:
+                return
+            self._info = rw.load_all_column_info(conn_path)
+            self._version = version
+            self.loads += 1
+        logging.debug(f"Metadata registry loaded: {len(self._info)} table(s).")
+
+    def get(
+            self,
+            conn_path: Union[str, Path],
+            version: str,
+            data_collection: str,
+            table_name: str,
+            snapshot: str = None
+    )-> Optional[Tuple[dict, dict]]:
+        """
+        Return (sql_types, cast) of a staged table, or of a table of a named snapshot,
+        reloading the registry if the snapshot version changed.
+
+        Returns:
+            the column info, or None if the table is not staged (or not in the snapshot)
+        """
+        if version != self._version:
+            self.load(conn_path, version)
+        return self._info.get((data_collection, snapshot, table_name))
+
+    def clear(self)-> None:
+        """Forget the loaded metadata: the next lookup reloads it."""
+        with self._lock:
+            self._info = {}
+            self._version = None
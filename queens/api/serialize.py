@@ -0,0 +1,235 @@
+import csv
+import io
+import json
+from operator import itemgetter
+from typing import Iterator, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# optional fast JSON encoder (pip install queens[fast])
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# columns returned by the data queries that are not part of the response records
+SERVICE_COLUMNS = ("rowid", "raw_rowid", "ingest_id", "ingest_ts", "table_description")
+
+
+def dumps(obj)-> bytes:
+    """
+    Serialise a JSON-compatible object to bytes, with orjson if installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def kept_columns(
+        columns: list,
+        rows: list,
+        drop: tuple = SERVICE_COLUMNS,
+        drop_empty: bool = True
+)-> list:
+    """
+    Positions of the columns to return: all but the given service columns and, with
+    drop_empty, the columns that only contain nulls.
+    """
+    return [i for i, c in enumerate(columns)
+            if c not in drop and (not drop_empty or any(r[i] is not None for r in rows))]
+
+
+def records_from_rows(
+        columns: list,
+        rows: list,
+        drop: tuple = SERVICE_COLUMNS,
+        drop_empty: bool = True
+)-> list:
+    """
+    Convert cursor rows into records, dropping the given service columns and the
+    columns that only contain nulls (same output as DataFrame.dropna(axis=1, how="all")
+    followed by to_dict(orient="records"), without pandas).
+
+    Args:
+        columns: column names, as in cursor.description
+        rows: list of row tuples
+        drop: columns to leave out
+        drop_empty: whether to scan for and drop the all-null columns. Not needed when
+            only the columns listed in the table metadata were selected
+
+    Returns:
+        a list of dictionaries
+    """
+    keep = kept_columns(columns, rows, drop, drop_empty)
+    if not keep:
+        return [{} for _ in rows]
+
+    names = [columns[i] for i in keep]
+    if len(keep) == 1:
+        i = keep[0]
+        return [{names[0]: r[i]} for r in rows]
+
+    getter = itemgetter(*keep)
+    return [dict(zip(names, getter(r))) for r in rows]
+
+
+# media types of the response formats
+JSON_FORMATS = {"json": "application/json"}
+BINARY_FORMATS = {"arrow": "application/vnd.apache.arrow.stream",
+                  "parquet": "application/vnd.apache.parquet"}
+STREAM_FORMATS = {"ndjson": "application/x-ndjson",
+                  "csv": "text/csv",
+                  **BINARY_FORMATS}
+
+# Arrow types of the schema SQL types (DATETIME values are stored as ISO strings)
+ARROW_TYPES = {"TEXT": pa.string(),
+               "INTEGER": pa.int64(),
+               "REAL": pa.float64(),
+               "DATETIME": pa.string()}
+
+
+def negotiate_format(
+        fmt: Optional[str],
+        accept: Optional[str],
+        formats: dict,
+        default: str
+)-> str:
+    """
+    Resolve the response format of a request: an explicit ?format= wins, otherwise
+    the first media type of the Accept header that matches one of the formats is used.
+
+    Args:
+        fmt: value of the format query parameter, if any
+        accept: value of the Accept header, if any
+        formats: supported formats {name: media type}
+        default: format used when nothing matches
+
+    Returns:
+        the format name
+
+    Raises:
+        ValueError if fmt is not one of the supported formats
+    """
+    if fmt is not None:
+        fmt = fmt.lower()
+        if fmt not in formats:
+            raise ValueError(f"Invalid format {fmt}. Options are {list(formats)}")
+        return fmt
+
+    by_media_type = {media_type: name for name, media_type in formats.items()}
+    for item in (accept or "").split(","):
+        media_type = item.split(";")[0].strip().lower()
+        if media_type in by_media_type:
+            return by_media_type[media_type]
+
+    return default
+
+
+def arrow_schema(
+        columns: list,
+        sql_types: dict,
+        metadata: dict = None
+)-> pa.Schema:
+    """
+    Arrow schema of a result set, typed from the SQL types of the columns
+    (table_name and unknown columns are strings).
+    """
+    return pa.schema([(c, ARROW_TYPES.get(sql_types.get(c), pa.string())) for c in columns],
+                     metadata=metadata)
+
+
+def rows_to_batch(
+        rows: list,
+        schema: pa.Schema,
+        positions: list = None
+)-> pa.RecordBatch:
+    """
+    Build an Arrow record batch from cursor rows, column by column, without pandas.
+
+    Args:
+        rows: list of row tuples
+        schema: schema of the batch
+        positions: position in the rows of each field of the schema. Default is in order
+    """
+    positions = positions if positions is not None else range(len(schema))
+    arrays = [pa.array([r[i] for r in rows], type=field.type)
+              for i, field in zip(positions, schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _writer(fmt: str, sink, schema: pa.Schema):
+    """Open an Arrow IPC stream or Parquet writer on a sink."""
+    if fmt == "arrow":
+        return pa.ipc.new_stream(sink, schema)
+    return pq.ParquetWriter(sink, schema, compression="zstd")
+
+
+def binary_bytes(
+        fmt: str,
+        batch: pa.RecordBatch
+)-> bytes:
+    """
+    Serialise a record batch to an Arrow IPC stream or a Parquet file.
+    """
+    sink = io.BytesIO()
+    with _writer(fmt, sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue()
+
+
+def binary_chunks(
+        fmt: str,
+        schema: pa.Schema,
+        batches: Iterator[list]
+)-> Iterator[bytes]:
+    """
+    Encode batches of rows as an Arrow IPC stream (one record batch per batch) or a
+    Parquet file (one row group per batch), yielding the bytes written after each batch.
+    """
+    sink = io.BytesIO()
+    writer = _writer(fmt, sink, schema)
+    try:
+        for rows in batches:
+            writer.write_batch(rows_to_batch(rows, schema))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate(0)
+    finally:
+        writer.close()
+
+    # stream end marker or Parquet footer
+    yield sink.getvalue()
+
+
+def ndjson_chunks(
+        columns: list,
+        batches: Iterator[list]
+)-> Iterator[bytes]:
+    """
+    Encode batches of rows as NDJSON, one chunk per batch.
+    """
+    for rows in batches:
+        yield b"".join(dumps(dict(zip(columns, r))) + b"\n" for r in rows)
+
+
+def csv_chunks(
+        columns: list,
+        batches: Iterator[list]
+)-> Iterator[bytes]:
+    """
+    Encode batches of rows as CSV (header first), one chunk per batch.
+    Nulls are written as empty fields.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate(0)
+
+    # header only for empty results
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
@@ -10,10 +10,11 @@ import uvicorn
 from pathlib import Path
 
 from . import settings as s
-from .etl.bootstrap import initialize, is_staged
+from .etl.bootstrap import initialize, is_staged, verify_read_only
 from .etl.process import (ingest_tables, ingest_all_tables,
                                 get_data_info, get_metadata, stage_data,
-                                get_data_versions)
+                                get_data_versions, maintain_db, get_snapshots,
+                                get_data_diff)
 from .core  import read_write as rw
 
 app = typer.Typer()
@@ -29,8 +30,9 @@ def auto_startup(ctx: typer.Context)-> None:
                     level="info")
 
     # only certain commands require auto-startup
-    commands_requiring_init = {"ingest", "stage", "info", "export", "serve"}
-    if ctx.invoked_subcommand in commands_requiring_init:
+    # serve initialises the DB itself, unless it is run in read-only mode
+    commands_requiring_init = {"ingest", "stage", "info", "export", "maintain", "snapshots", "diff"}
+    if ctx.invoked_subcommand in commands_requiring_init and not s.READ_ONLY:
         created = initialize(db_path=s.DB_PATH, schema=s.SCHEMA)
         if created:
             typer.echo("Initialized QUEENS DB/tables.")
@@ -42,6 +44,11 @@ def auto_startup(ctx: typer.Context)-> None:
 def config(
     db_path: Optional[str] = typer.Option(None, "--db-path"),
     export_path: Optional[str] = typer.Option(None, "--export-path"),
+    synchronous: Optional[str] = typer.Option(None, "--synchronous", help="SQLite synchronous mode for ingest/stage runs (OFF, NORMAL, FULL, EXTRA)"),
+    dictionary_encoding: Optional[bool] = typer.Option(None, "--dictionary-encoding/--no-dictionary-encoding", help="Store dimensions of newly created RAW tables as integer codes"),
+    query_engine: Optional[str] = typer.Option(None, "--query-engine", help="Engine for queries (sqlite, duckdb, parquet)"),
+    parquet_mirror: Optional[bool] = typer.Option(None, "--parquet-mirror/--no-parquet-mirror", help="Write a Parquet mirror of the prod table on stage"),
+    response_cache_size: Optional[int] = typer.Option(None, "--response-cache-size", help="Size in bytes of the API response cache (0 disables it)"),
     show_current: bool = typer.Option(False, "--show-current")
 ):
     if show_current:
@@ -49,14 +56,27 @@ def config(
         typer.echo(f"DB path:     {s.DB_PATH}")
         typer.echo(f"Export dir:  {s.EXPORT_DIR}")
         typer.echo(f"Templates:   {s.TEMPLATES_DIR}")
+        typer.echo(f"Synchronous: {s.SQLITE_SYNCHRONOUS}")
+        typer.echo(f"Dictionary encoding: {s.DICTIONARY_ENCODING}")
+        typer.echo(f"Query engine: {s.QUERY_ENGINE}")
+        typer.echo(f"Parquet mirror: {s.PARQUET_MIRROR}")
+        typer.echo(f"Response cache size: {s.RESPONSE_CACHE_SIZE}")
         raise typer.Exit(code=0)
 
-    if (db_path is None) and (export_path is None):
-        typer.echo("Nothing to change. Use --db-path and/or --export-path or --show-current.")
+    if all(opt is None for opt in (db_path, export_path, synchronous, dictionary_encoding, query_engine, parquet_mirror,
+                                  response_cache_size)):
+        typer.echo("Nothing to change. Use --db-path, --export-path, --synchronous, --dictionary-encoding, --query-engine, "
+                   "--parquet-mirror and/or --response-cache-size or --show-current.")
         raise typer.Exit(code=0)
 
     try:
-        s.set_config(db_path=db_path, export_path=export_path)
+        s.set_config(db_path=db_path,
+                     export_path=export_path,
+                     synchronous=synchronous,
+                     dictionary_encoding=dictionary_encoding,
+                     query_engine=query_engine,
+                     parquet_mirror=parquet_mirror,
+                     response_cache_size=response_cache_size)
         typer.echo("Configuration updated.")
     except Exception as e:
         if e:
@@ -90,16 +110,23 @@ def ingest(
 @app.command()
 def stage(
     collection: str,
-    as_of_date: Optional[str] = typer.Option(None, "--as_of_date", "--d", help="The cutoff point for data versioning.")
+    as_of_date: Optional[str] = typer.Option(None, "--as_of_date", "--as-of", "--d", help="The cutoff point for data versioning."),
+    incremental: bool = typer.Option(False, "--incremental", "-i", help="Only restage tables whose selected version changed."),
+    mirror: Optional[bool] = typer.Option(None, "--mirror/--no-mirror", help="Write a Parquet mirror of the prod table (default from config)."),
+    name: Optional[str] = typer.Option(None, "--name", "-n", help="Materialise a named snapshot instead of the prod table.")
 )-> None:
     """
-    Stage the most recent data version for a collection.
+    Stage the most recent data version for a collection, or a named snapshot of it with --name.
     """
     try:
         typer.echo(f"Staging {collection} data...")
         stage_data(data_collection=collection,
-                   as_of_date=as_of_date)
-        typer.echo(f"Data for {collection} staged successfully.")
+                   as_of_date=as_of_date,
+                   incremental=incremental,
+                   mirror=mirror,
+                   name=name)
+        snap_str = f" as snapshot '{name}'" if name else ""
+        typer.echo(f"Data for {collection} staged successfully{snap_str}.")
 
     except Exception as e:
         typer.echo(f"ERROR: execution terminated: \n{e}")
@@ -167,16 +194,52 @@ def info(
         raise typer.Exit()
 
 
+@app.command()
+def diff(
+    collection: str,
+    from_ts: str = typer.Option(..., "--from", help="Date (YYYY-MM-DD) or ingest timestamp of the old vintage."),
+    to_ts: Optional[str] = typer.Option(None, "--to", help="Date (YYYY-MM-DD) or ingest timestamp of the new vintage. Default is the latest."),
+    table: Optional[str] = typer.Option(None, "--table", "-t", help="Optional table name to compare"),
+    detail: bool = typer.Option(False, "--detail", "-d", help="List the added, removed and changed cells instead of the counts per table.")
+)-> None:
+    """
+    Compare two vintages of a collection: added, removed and changed cells per table.
+    """
+    try:
+        df = get_data_diff(data_collection=collection,
+                           from_ts=from_ts,
+                           to_ts=to_ts,
+                           table_name=table,
+                           detail=detail)
+
+        if df.empty:
+            typer.echo(f"No differences found for {collection}.")
+        else:
+            typer.echo(tabulate(df.dropna(axis=1, how="all"), headers="keys", showindex=False))
+
+    except Exception as e:
+        typer.echo(f"ERROR: execution terminated: \n{e}")
+        raise typer.Exit(code=1)
+
+
 @app.command()
 def export(
         collection: str,
         file_type: Optional[str] = typer.Option("csv", "--file-type", "-f", help="Format to use for export. Options are csv, parquet or xlsx, default is xsc"),
         table: Optional[str] = typer.Option(None, "--table", "-t", help="Optional table name to download"),
         path: Optional[str] = typer.Option(s.EXPORT_DIR, "--path", "-p", help="Optional destination path"),
-        bulk: Optional[bool] = typer.Option(False, "--bulk", "-b", help="Whether to save all the data in a single file or not")
+        bulk: Optional[bool] = typer.Option(False, "--bulk", "-b", help="Whether to save all the data in a single file or not"),
+        snapshot: Optional[str] = typer.Option(None, "--snapshot", "-s", help="Export a named snapshot instead of the staged data")
 )-> None:
+    # interrupt if the snapshot does not exist
+    if snapshot is not None:
+        if snapshot not in rw.get_snapshots(s.DB_PATH, collection):
+            typer.echo(f"Cannot export: no snapshot '{snapshot}' for {collection}. "
+                       f"Run: `queens stage {collection} --name {snapshot}`.")
+            raise typer.Exit(code=1)
+
     # interrupt if data colleciton is not staged
-    if not is_staged(db_path=s.DB_PATH, data_collection=collection):
+    elif not is_staged(db_path=s.DB_PATH, data_collection=collection):
         missing = f"{collection} staging table is missing"
         hint = f"Run: `queens stage {collection}`"
 
@@ -194,7 +257,8 @@ def export(
                 data_collection=collection,
                 file_type=file_type,
                 output_path=path,
-                table_name=table
+                table_name=table,
+                snapshot=snapshot
             )
         else:
             bulk_str = " as a single file" if bulk else ""
@@ -203,23 +267,97 @@ def export(
                 data_collection=collection,
                 file_type=file_type,
                 output_path=path,
-                bulk_export=bulk
+                bulk_export=bulk,
+                snapshot=snapshot
             )
     except Exception as e:
         typer.echo(f"ERROR: execution terminated. \n{e}")
         raise typer.Exit(code=1)
 
 
+@app.command()
+def maintain(
+    collection: Optional[str] = typer.Argument(None, help="Data collection to prune. Default is all collections."),
+    keep_last: Optional[int] = typer.Option(None, "--keep-last", "-k", help="Number of versions to keep per table. Versions used by the staged snapshot are always kept."),
+    no_vacuum: bool = typer.Option(False, "--no-vacuum", help="Skip ANALYZE and VACUUM after pruning.")
+)-> None:
+    """
+    Remove failed ingests and old versions according to the retention policy, then compact the DB.
+    """
+    try:
+        typer.echo("Running maintenance...")
+        res = maintain_db(data_collection=collection,
+                          keep_last=keep_last,
+                          vacuum=not no_vacuum)
+
+        typer.echo(tabulate(res["pruned"], headers="keys"))
+        typer.echo(f"Reclaimed {res['bytes_reclaimed'] / 1_000_000:.2f} MB.")
+
+    except Exception as e:
+        typer.echo(f"ERROR: execution terminated: \n{e}")
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def snapshots(
+    collection: str,
+    drop: Optional[str] = typer.Option(None, "--drop", help="Name of a snapshot to drop.")
+)-> None:
+    """
+    List the named snapshots of a collection, or drop one with --drop.
+    """
+    try:
+        if drop:
+            rw.drop_snapshot(s.DB_PATH, collection, drop)
+            typer.echo(f"Snapshot '{drop}' of {collection} dropped.")
+            return
+
+        df = get_snapshots(data_collection=collection)
+        if df.empty:
+            typer.echo(f"No snapshots found for {collection}.")
+        else:
+            typer.echo(tabulate(df, headers="keys"))
+
+    except Exception as e:
+        typer.echo(f"ERROR: execution terminated: \n{e}")
+        raise typer.Exit(code=1)
+
+
 @app.command()
 def serve(
     host: str = typer.Option("127.0.0.1", "--host"),
     port: int =  typer.Option(8000, "--port"),
     reload: bool = typer.Option(False, "--reload", help="Dev reload (spawns reloader process)"),
-    log_level: str = typer.Option("info", "--log-level")
+    log_level: str = typer.Option("info", "--log-level"),
+    read_only: bool = typer.Option(False, "--read-only", help="Serve a published DB as immutable: no locking, whole file memory-mapped, writes refused"),
+    workers: int = typer.Option(1, "--workers", "-w", min=1, help="Number of worker processes sharing the DB file (not with --reload)")
 )-> None:
     """
     Starts the QUEENS API using Uvicorn. The app is not started unless at least one data collection has been staged.
+    With --workers N, Uvicorn supervises N worker processes on the same socket: each one loads its own
+    metadata and reports ready on /health, and on shutdown all of them finish their in-flight requests
+    (up to settings.SHUTDOWN_TIMEOUT seconds) before exiting.
     """
+    if workers > 1 and reload:
+        typer.echo("ERROR: --reload cannot be combined with --workers.")
+        raise typer.Exit(code=1)
+
+    if read_only or s.READ_ONLY:
+        # the environment variable is inherited by the API process(es)
+        os.environ[s.READ_ONLY_ENV_VAR] = "1"
+        s.READ_ONLY = True
+        try:
+            staged = verify_read_only(s.DB_PATH, s.SCHEMA)
+        except RuntimeError as e:
+            typer.echo(f"ERROR: cannot serve {s.DB_PATH} read-only: \n{e}")
+            raise typer.Exit(code=1)
+        typer.echo(f"Serving read-only snapshot of {staged}.")
+    else:
+        created = initialize(db_path=s.DB_PATH, schema=s.SCHEMA)
+        if created:
+            typer.echo("Initialized QUEENS DB/tables.")
+        else:
+            typer.echo("DB/tables already initialized.")
 
     collections = list(s.SCHEMA.keys())  # or s.ETL_CONFIG.keys()
     missing = []
@@ -240,12 +378,28 @@ def serve(
 
     # start API (uvicorn)
     try:
+        if workers > 1:
+            if not s.READ_ONLY:
+                typer.echo("Tip: with several workers, serve a published DB with --read-only to skip locking.")
+            typer.echo(f"Starting API at http://{host}:{port} with {workers} workers")
+            # the supervisor binds the socket, spawns the workers and forwards signals to them
+            uvicorn.run(
+                app="queens.api.app:app",
+                host=host,
+                port=port,
+                workers=workers,
+                log_level=log_level,
+                timeout_graceful_shutdown=s.SHUTDOWN_TIMEOUT,
+            )
+            raise typer.Exit(code=0)
+
         server_config = uvicorn.Config(
             app="queens.api.app:app",  # <-- package-qualified
             host=host,
             port=port,
             reload=reload,
             log_level=log_level,
+            timeout_graceful_shutdown=s.SHUTDOWN_TIMEOUT,
         )
         server = uvicorn.Server(server_config)
         typer.echo(f"Starting API at http://{host}:{port} (reload={reload})")
@@ -261,6 +415,9 @@ def serve(
         typer.echo("\nShutting down...")
         raise typer.Exit(code=0)
 
+    except typer.Exit:
+        raise
+
     except OSError as e:
         # address already in use (Linux errno 98; Windows 10013/10048)
         if getattr(e, "errno", None) in (98, 10013, 10048):
@@ -0,0 +1,260 @@
+import logging
+import threading
+from pathlib import Path
+from typing import Union, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from .. import settings as s
+from . import read_write as rw
+
+# alias of the attached SQLite database inside DuckDB
+_DUCKDB_ALIAS = "queens"
+
+# thread-local DuckDB connections (see get_duckdb)
+_duckdb = threading.local()
+
+
+def _import_duckdb():
+    """Import the optional duckdb dependency, with an install hint if missing."""
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError("The duckdb query engine requires the optional dependency 'duckdb'. "
+                          "Install it with: pip install queens[duckdb]") from e
+    return duckdb
+
+
+def check_engine(engine: str = None)-> str:
+    """
+    Validate a query engine name.
+
+    Args:
+        engine: engine name. Default is settings.QUERY_ENGINE
+
+    Returns:
+        the engine name in lower case
+    """
+    engine = (engine or s.QUERY_ENGINE).lower()
+    if engine not in s.QUERY_ENGINES:
+        raise ValueError(f"Invalid query engine {engine}. Options are {sorted(s.QUERY_ENGINES)}")
+    return engine
+
+
+def _load_sqlite_extension(duckdb, conn)-> None:
+    """
+    Load DuckDB's sqlite extension. It is only installed (downloaded, so network is needed)
+    if it is not already available locally; otherwise a RuntimeError explains how to get it.
+    """
+    # without this, LOAD would try to download a missing extension by itself
+    conn.execute("SET autoinstall_known_extensions = false;")
+    try:
+        conn.execute("LOAD sqlite;")
+        return
+    except duckdb.Error:
+        logging.debug("DuckDB sqlite extension not installed, installing it")
+
+    try:
+        conn.execute("INSTALL sqlite;")
+        conn.execute("LOAD sqlite;")
+    except duckdb.Error as e:
+        conn.close()
+        raise RuntimeError(
+            "The duckdb query engine needs DuckDB's sqlite extension, which is not installed and could "
+            "not be downloaded. Install it once with network access "
+            "(python -c \"import duckdb; duckdb.sql('INSTALL sqlite')\"), or use the sqlite engine."
+        ) from e
+
+
+def get_duckdb(conn_path: Union[str, Path] = None):
+    """
+    Return the DuckDB connection of the calling thread, with the SQLite DB attached
+    read-only and set as the default catalog, so that the SQL generated for SQLite
+    (e.g. by utils.build_where_clause) runs unchanged. The connection is reopened
+    when the DB path changes.
+
+    Args:
+        conn_path: Database path. Default is settings.DB_PATH
+
+    Returns:
+        an open duckdb connection owned by the pool. Do not close it, use close_duckdb().
+
+    """
+    duckdb = _import_duckdb()
+
+    conn_path = str(Path(conn_path or s.DB_PATH).expanduser().resolve())
+    conn = getattr(_duckdb, "conn", None)
+    if conn is not None and _duckdb.path == conn_path:
+        return conn
+
+    close_duckdb()
+
+    logging.debug(f"Attaching {conn_path} to DuckDB")
+    conn = duckdb.connect()
+    _load_sqlite_extension(duckdb, conn)
+    escaped = conn_path.replace("'", "''")
+    conn.execute(f"ATTACH '{escaped}' AS {_DUCKDB_ALIAS} (TYPE SQLITE, READ_ONLY);")
+    conn.execute(f"USE {_DUCKDB_ALIAS};")
+
+    _duckdb.conn = conn
+    _duckdb.path = conn_path
+    return conn
+
+
+def close_duckdb()-> None:
+    """
+    Close the DuckDB connection of the calling thread, if any.
+    """
+    conn = getattr(_duckdb, "conn", None)
+    if conn is not None:
+        conn.close()
+    _duckdb.conn = None
+    _duckdb.path = None
+
+
+def read_sql_as_arrow(
+        conn_path: Union[str, Path],
+        query: str,
+        query_params: tuple = None
+)-> pa.Table:
+    """
+    Run a parametrised query (positional placeholders ?) against the SQLite DB through
+    DuckDB's vectorised engine and return the result as an Arrow table, without going
+    through pandas.
+
+    Args:
+        conn_path: connection string (path of db file)
+        query: the SQL query as a string
+        query_params: tuple of query parameters.
+
+    Returns:
+        a pyarrow Table
+
+    """
+    res = get_duckdb(conn_path).execute(query, list(query_params or ()))
+
+    # fetch_arrow_table is deprecated in recent DuckDB versions
+    to_arrow = getattr(res, "to_arrow_table", None) or res.fetch_arrow_table
+    return to_arrow()
+
+
+def read_sql_rows(
+        conn_path: Union[str, Path],
+        query: str,
+        query_params: tuple = None
+)-> Tuple[list, list]:
+    """
+    DuckDB counterpart of read_write.read_sql_rows: run a parametrised query and return
+    (column names, list of row tuples).
+    """
+    res = get_duckdb(conn_path).execute(query, list(query_params or ()))
+    return [d[0] for d in res.description], res.fetchall()
+
+
+def drop_columns_arrow(
+        table: pa.Table,
+        columns: list
+)-> pa.Table:
+    """
+    Arrow counterpart of the pandas clean-up applied to query results: drop the given
+    (service) columns, where present, and the columns that only contain nulls.
+    """
+    keep = [c for c in table.column_names
+            if c not in columns and table[c].null_count < table.num_rows]
+    return table.select(keep)
+
+
+def _like_literal(value: str)-> str:
+    """Escape a value so that it is matched literally by a LIKE pattern."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def build_arrow_filter(
+        group: dict,
+        schema_dict: dict
+)-> ds.Expression:
+    """
+    Arrow counterpart of utils.build_sql_for_group: combine the operators of a validated
+    filter group ({col: {op: value}}) into a dataset expression. TEXT comparisons are
+    case-insensitive, as with COLLATE NOCASE in SQL; table_name is matched exactly so that
+    partitions are pruned.
+    """
+    expr = None
+    for col, ops in group.items():
+        field = ds.field(col)
+        text = schema_dict[col]["type"] == "TEXT" and col != "table_name"
+        for op, val in ops.items():
+            if text and op in {"eq", "neq", "like"}:
+                pattern = val if op == "like" else _like_literal(val)
+                clause = pc.match_like(field, pattern, ignore_case=True)
+                if op == "neq":
+                    clause = ~clause
+            elif op == "eq":
+                clause = field == val
+            elif op == "neq":
+                clause = field != val
+            elif op == "lt":
+                clause = field < val
+            elif op == "lte":
+                clause = field <= val
+            elif op == "gt":
+                clause = field > val
+            elif op == "gte":
+                clause = field >= val
+            else:
+                raise ValueError(f"Operator {op} is not supported on the Parquet mirror")
+            expr = clause if expr is None else expr & clause
+
+    return expr if expr is not None else ds.scalar(True)
+
+
+def read_parquet_mirror(
+        conn_path: Union[str, Path],
+        data_collection: str,
+        base_group: dict,
+        or_groups: list,
+        schema_dict: dict,
+        columns: list = None
+)-> pa.Table:
+    """
+    Answer a validated query from the Parquet mirror of {data_collection}_prod (see
+    read_write.write_parquet_mirror). Filters are pushed down to the dataset scan: the
+    table_name filter prunes partitions and numeric ranges (e.g. year) skip row groups
+    through their statistics.
+
+    Args:
+        conn_path: Database path, used to locate the mirror
+        data_collection: data collection name
+        base_group: validated base filters, combined with AND
+        or_groups: validated OR groups
+        schema_dict: schema of the data collection
+        columns: optional list of columns to read. Default is all columns
+
+    Returns:
+        a pyarrow Table with plain (decoded) columns
+
+    """
+    path = rw.mirror_path(conn_path, data_collection)
+    if not path.exists():
+        raise RuntimeError(f"No Parquet mirror for {data_collection}. "
+                           f"Run `queens stage {data_collection} --mirror` first.")
+
+    partitioning = ds.partitioning(pa.schema([("table_name", pa.string())]), flavor="hive")
+    dataset = ds.dataset(path, format="parquet", partitioning=partitioning)
+
+    # read dictionary columns as plain strings, as the other engines return them
+    schema = pa.schema([f.with_type(f.type.value_type) if pa.types.is_dictionary(f.type) else f
+                        for f in dataset.schema])
+    dataset = ds.dataset(path, format="parquet", partitioning=partitioning, schema=schema)
+
+    expr = build_arrow_filter(base_group, schema_dict)
+    if or_groups:
+        any_expr = None
+        for g in or_groups:
+            g_expr = build_arrow_filter(g, schema_dict)
+            any_expr = g_expr if any_expr is None else any_expr | g_expr
+        expr = expr & any_expr
+
+    return dataset.to_table(columns=columns, filter=expr)
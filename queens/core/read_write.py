@@ -1,9 +1,16 @@
 import sqlite3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 import logging
 import datetime
 import os
-from typing import Union
+import re
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager, closing
+from typing import Union, Tuple, Iterator
 from pathlib import Path
 from .. import settings as s
 from ..core import utils as u
@@ -98,7 +105,8 @@ def export_table(
         file_type: str,
         table_name: str,
         output_path: Union[str, Path],
-        output_ts: str = None
+        output_ts: str = None,
+        snapshot: str = None
 )-> None:
     """
     Utility that can export a specific table_name within a data_collection to
@@ -109,12 +117,14 @@ def export_table(
         output_ts: destination folder of the files. Default is data/outputs/exported/
         file_type: either 'csv', 'parquet' or 'xlsx'
         table_name: the name of the table to export (i.e. 1.2)
+        snapshot: optional named snapshot to export from. Default is the staged prod table
 
     Returns:
         None
 
     """
     try:
+        source = f"{data_collection}_prod" if snapshot is None else snapshot_table(data_collection, snapshot)
 
         if output_ts is None:
             output_ts = str(datetime.date.today())
@@ -126,7 +136,7 @@ def export_table(
         query = f"""
             SELECT *
             FROM 
-                {data_collection}_prod
+                {source}
             WHERE 
                 table_name = ?
         """
@@ -135,6 +145,7 @@ def export_table(
                                query_params=(table_name,))
 
         file_name = (data_collection
+                     + ("" if snapshot is None else f"_{snapshot}")
                      + "_"
                      + table_name.replace(".","_")
                      + "_"
@@ -163,7 +174,8 @@ def export_all(
         data_collection: str,
         file_type: str,
         output_path: Union[str, Path],
-        bulk_export: bool
+        bulk_export: bool,
+        snapshot: str = None
 )-> None:
     """
     Export all table sin a given data_collection to flat files. Supports csv, parquet and Excel file types.
@@ -175,6 +187,7 @@ def export_all(
         file_type: Either 'csv', 'parquet' of 'xlsx'
         output_path: where to export the outputs
         bulk_export: if True, exports all tables into a single file. Default is False
+        snapshot: optional named snapshot to export from. Default is the staged prod table
 
     Returns:
         None
@@ -184,6 +197,7 @@ def export_all(
     # get absolute path and current timestamp
     output_path = os.path.abspath(output_path)
     output_ts = str(datetime.date.today())
+    source = f"{data_collection}_prod" if snapshot is None else snapshot_table(data_collection, snapshot)
 
     try:
         if not bulk_export:
@@ -199,7 +213,8 @@ def export_all(
                         output_path=output_path,
                         output_ts=output_ts,
                         file_type=file_type,
-                             table_name=table_key)
+                             table_name=table_key,
+                        snapshot=snapshot)
 
                 logging.info(f"Finished exporting [chapter]")
 
@@ -209,8 +224,9 @@ def export_all(
             # export all tables in the data collection to a single file
             logging.info(f"Reading the {data_collection} production table.")
             df = read_sql_as_frame(conn_path=s.DB_PATH,
-                                   query=f"SELECT * FROM {data_collection}_prod")
-            file_name = f"{data_collection}_{output_ts}.{file_type}"
+                                   query=f"SELECT * FROM {source}")
+            prefix = data_collection if snapshot is None else f"{data_collection}_{snapshot}"
+            file_name = f"{prefix}_{output_ts}.{file_type}"
             output_path = os.path.join(output_path, file_name)
 
             logging.info(f"Saving {data_collection} to {file_type}.")
@@ -255,6 +271,8 @@ def execute_sql(
         None
 
     """
+    _check_writable(conn_path)
+
     # get cursor
     with sqlite3.connect(conn_path) as conn:
         cursor = conn.cursor()
@@ -264,6 +282,286 @@ def execute_sql(
     return None
 
 
+def _check_writable(conn_path: Union[str, Path])-> None:
+    """Refuse write paths when the DB is served in read-only mode."""
+    if s.READ_ONLY:
+        raise RuntimeError(f"QUEENS is running in read-only mode: cannot write to {conn_path}. "
+                           f"Unset {s.READ_ONLY_ENV_VAR} to ingest, stage or maintain data.")
+
+
+# thread-local pool of read connections (see get_reader)
+_readers = threading.local()
+
+
+def _read_profile(conn_path: Union[str, Path])-> tuple:
+    """Key identifying a pooled read connection: resolved DB path and pragma profile."""
+    return (str(Path(conn_path).expanduser().resolve()),
+            tuple(sorted(s.READ_PRAGMAS.items())),
+            s.READ_ONLY)
+
+
+def get_reader(conn_path: Union[str, Path] = None)-> sqlite3.Connection:
+    """
+    Return the persistent read connection of the calling thread, opening it on first use.
+    The connection is configured with the pragma profile in settings.READ_PRAGMAS
+    (cache_size, mmap_size, temp_store) and is reopened automatically when the DB path
+    or the profile changes (e.g. after settings.reload_settings()).
+    Connections run in autocommit mode, so no read transaction is held between queries.
+    In read-only mode (settings.READ_ONLY) the file is opened as immutable (no locking and
+    no journal checks) and memory-mapped as a whole.
+
+    Args:
+        conn_path: Database path. Default is settings.DB_PATH
+
+    Returns:
+        an open sqlite3 connection owned by the pool. Do not close it, use close_readers().
+
+    """
+    conn_path = conn_path or s.DB_PATH
+    profile = _read_profile(conn_path)
+
+    conn = getattr(_readers, "conn", None)
+    if conn is not None and _readers.profile == profile:
+        return conn
+
+    # path or pragmas changed since the connection was opened
+    close_readers()
+
+    conn = open_reader(conn_path)
+    _readers.conn = conn
+    _readers.profile = profile
+    return conn
+
+
+def open_reader(
+        conn_path: Union[str, Path] = None,
+        check_same_thread: bool = True
+)-> sqlite3.Connection:
+    """
+    Open a new read connection with the pragma profile of the pooled readers (see get_reader).
+    Used directly for reads that outlive a single call, e.g. streamed responses, whose rows
+    can be fetched from different threads (check_same_thread=False).
+
+    Args:
+        conn_path: Database path. Default is settings.DB_PATH
+        check_same_thread: whether the connection can only be used by the thread that opened it
+
+    Returns:
+        an open sqlite3 connection. The caller is responsible for closing it.
+
+    """
+    conn_path = conn_path or s.DB_PATH
+    profile = _read_profile(conn_path)
+
+    temp_store = str(s.READ_PRAGMAS["temp_store"]).upper()
+    if temp_store not in s.TEMP_STORE_MODES:
+        raise ValueError(f"Invalid temp_store {temp_store}. Options are {sorted(s.TEMP_STORE_MODES)}")
+
+    mmap_size = int(s.READ_PRAGMAS["mmap_size"])
+
+    logging.debug(f"Opening read connection to {profile[0]}")
+    if s.READ_ONLY:
+        uri = Path(profile[0]).as_uri() + "?mode=ro&immutable=1"
+        conn = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=check_same_thread)
+        # map the whole file: pages are shared through the OS cache across workers
+        mmap_size = max(mmap_size, os.path.getsize(profile[0]))
+    else:
+        conn = sqlite3.connect(conn_path, isolation_level=None, check_same_thread=check_same_thread)
+    conn.execute(f"PRAGMA cache_size = {int(s.READ_PRAGMAS['cache_size'])};")
+    conn.execute(f"PRAGMA mmap_size = {mmap_size};").fetchall()
+    conn.execute(f"PRAGMA temp_store = {temp_store};")
+
+    return conn
+
+
+def close_readers()-> None:
+    """
+    Close the pooled read connection of the calling thread, if any.
+    """
+    conn = getattr(_readers, "conn", None)
+    if conn is not None:
+        conn.close()
+    _readers.conn = None
+    _readers.profile = None
+
+
+def connect_writer(
+        conn_path: Union[str, Path],
+        synchronous: str = None
+)-> sqlite3.Connection:
+    """
+    Open a connection for a write run (ingest or stage). The connection is in autocommit
+    mode so that transactions are controlled explicitly through savepoints, and the database
+    is switched to WAL journaling so that readers (e.g. the API) are not blocked while a run
+    is in progress.
+
+    Args:
+        conn_path: path to SQLite DB
+        synchronous: PRAGMA synchronous mode. Default is settings.SQLITE_SYNCHRONOUS
+
+    Returns:
+        an open sqlite3 connection. The caller is responsible for closing it.
+
+    """
+    _check_writable(conn_path)
+
+    synchronous = (synchronous or s.SQLITE_SYNCHRONOUS).upper()
+    if synchronous not in s.SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid synchronous mode {synchronous}. Options are {sorted(s.SYNCHRONOUS_MODES)}")
+
+    conn = sqlite3.connect(conn_path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute(f"PRAGMA synchronous = {synchronous};")
+
+    return conn
+
+
+@contextmanager
+def savepoint(
+        conn: sqlite3.Connection,
+        name: str
+):
+    """
+    Context manager wrapping a block of statements in a SAVEPOINT. The savepoint is released
+    on success (committing the work if it is the outermost one) and rolled back on error, in
+    which case the exception is re-raised.
+
+    Args:
+        conn: connection opened with connect_writer()
+        name: savepoint name
+    """
+    conn.execute(f'SAVEPOINT "{name}";')
+    try:
+        yield conn
+    except Exception:
+        conn.execute(f'ROLLBACK TO "{name}";')
+        conn.execute(f'RELEASE "{name}";')
+        raise
+
+    conn.execute(f'RELEASE "{name}";')
+
+
+def bump_snapshot_version(conn: sqlite3.Connection)-> str:
+    """
+    Replace the snapshot version token with a new random one, within the caller's
+    transaction. Called by every write that changes the data served by the API (ingest,
+    stage, named snapshots, pruning), so that caches keyed on the token are invalidated.
+
+    Args:
+        conn: open connection, normally inside a savepoint
+
+    Returns:
+        the new token
+    """
+    token = uuid.uuid4().hex
+    conn.execute("INSERT OR REPLACE INTO _state (key, value) VALUES ('snapshot_version', ?);",
+                 (token,))
+    return token
+
+
+def get_snapshot_version(conn_path: Union[str, Path] = None)-> str:
+    """
+    Return the current snapshot version token (see bump_snapshot_version), read through
+    the pooled read connection. Empty string if no write has happened yet.
+
+    Args:
+        conn_path: Database path. Default is settings.DB_PATH
+    """
+    try:
+        row = get_reader(conn_path).execute(
+            "SELECT value FROM _state WHERE key = 'snapshot_version';"
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # DB created before the _state table
+        return ""
+    return row[0] if row else ""
+
+
+def _insert_frame(
+        cursor: sqlite3.Cursor,
+        to_table: str,
+        df: pd.DataFrame
+)-> None:
+    """
+    Append the rows of a dataframe to an existing table with a single executemany.
+    Unlike df.to_sql(), this never commits, so it can run inside a savepoint.
+    """
+    cols = ", ".join(f"[{c}]" for c in df.columns)
+    placeholders = ", ".join("?" for _ in df.columns)
+
+    # cast to python objects so that sqlite3 can bind numpy scalars and pandas NAs
+    records = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+
+    cursor.executemany(
+        f"INSERT INTO [{to_table}] ({cols}) VALUES ({placeholders});",
+        records
+    )
+
+
+def is_encoded(
+        data_collection: str,
+        conn: Union[str, Path, sqlite3.Connection]
+)-> bool:
+    """
+    Whether the RAW table of a data collection uses the dictionary-encoded layout,
+    i.e. whether the {data_collection}_dim lookup table exists.
+
+    Args:
+        data_collection: name of data collection
+        conn: open connection or path to SQLite DB
+    """
+    if not isinstance(conn, sqlite3.Connection):
+        return table_exists(f"{data_collection}_dim", conn)
+
+    row = conn.execute("""
+        SELECT 1
+        FROM sqlite_master
+        WHERE type = 'table'
+            AND name = ?;
+    """, (f"{data_collection}_dim",)).fetchone()
+    return row is not None
+
+
+def raw_source(
+        data_collection: str,
+        conn_path: Union[str, Path]
+)-> str:
+    """
+    Name of the table or view exposing the RAW rows of a data collection with plain
+    (decoded) columns.
+    """
+    if is_encoded(data_collection, conn_path):
+        return f"{data_collection}_raw_decoded"
+    return f"{data_collection}_raw"
+
+
+def _encode_frame(
+        cursor: sqlite3.Cursor,
+        data_collection: str,
+        df: pd.DataFrame,
+        schema_dict: dict
+)-> pd.DataFrame:
+    """
+    Replace dimension strings by their integer codes, adding new values to the lookup table.
+    """
+    dim_table = f"{data_collection}_dim"
+    encoded_cols = [c for c in u.get_encoded_columns(data_collection, schema_dict) if c in df.columns]
+
+    values = set()
+    for col in encoded_cols:
+        values.update(df[col].dropna().astype(str).unique())
+
+    cursor.executemany(f"INSERT OR IGNORE INTO [{dim_table}] (value) VALUES (?);",
+                       [(v,) for v in values])
+    codes = {v: k for k, v in cursor.execute(f"SELECT dim_id, value FROM [{dim_table}];")}
+
+    df = df.copy()
+    for col in encoded_cols:
+        df[col] = df[col].map(lambda v: codes[str(v)] if pd.notna(v) else None).astype(object)
+
+    return df
+
+
 def ingest_frame(
         df: pd.DataFrame,
         to_table: str,
@@ -272,10 +570,16 @@ def ingest_frame(
         url: str,
         table_descr: str,
         conn_path: Union[str, Path],
-        ingest_ts: str
+        ingest_ts: str,
+        conn: sqlite3.Connection = None,
+        schema_dict: dict = None
 )-> int:
     """
     Ingests a pandas dataframe and saves an ingest log entry.
+    If a run connection is passed, data and log entry are written within the caller's
+    transaction (savepoint) and are only committed when the caller releases it.
+    If the data collection uses the dictionary-encoded layout, dimension values are
+    replaced by their codes in {data_collection}_dim before writing.
 
     Args:
         df: pandas dataframe to insert
@@ -284,8 +588,10 @@ def ingest_frame(
         data_collection: name of data collection
         url: source URL of the data
         table_descr: string detailing the content of the parent table
-        conn_path: path to SQLite DB
+        conn_path: path to SQLite DB. Ignored if conn is passed
         ingest_ts: timestamp string to save into the ingest log table
+        conn: optional connection opened with connect_writer(), shared across the run
+        schema_dict: schema dictionary, used to resolve encoded columns. Default is settings.SCHEMA
 
     Returns:
         ingest_id: ID of the ingest log row
@@ -294,69 +600,83 @@ def ingest_frame(
     if data_collection not in to_table:
         logging.warning(f"Writing to table {to_table} but data collection is {data_collection}")
 
-    with sqlite3.connect(conn_path) as conn:
-        cursor = conn.cursor()
-
-        # Insert a log entry first
-        cursor.execute(
-            """
-            INSERT INTO _ingest_log 
-                (ingest_ts
-                , data_collection
-                , table_name
-                , url
-                ,table_description
-                , success)
-            VALUES (?, ?, ?, ?, ?, 0)
-            """,
-            (ingest_ts, data_collection, table_name, url, table_descr)
-        )
+    # standalone call: use a dedicated connection and commit on exit
+    if conn is None:
+        with closing(connect_writer(conn_path)) as own_conn:
+            with savepoint(own_conn, "ingest_frame"):
+                return ingest_frame(
+                    df=df,
+                    to_table=to_table,
+                    table_name=table_name,
+                    data_collection=data_collection,
+                    url=url,
+                    table_descr=table_descr,
+                    conn_path=conn_path,
+                    ingest_ts=ingest_ts,
+                    conn=own_conn,
+                    schema_dict=schema_dict
+                )
+
+    cursor = conn.cursor()
+
+    # Insert a log entry first
+    cursor.execute(
+        """
+        INSERT INTO _ingest_log 
+            (ingest_ts
+            , data_collection
+            , table_name
+            , url
+            ,table_description
+            , success)
+        VALUES (?, ?, ?, ?, ?, 0)
+        """,
+        (ingest_ts, data_collection, table_name, url, table_descr)
+    )
 
-        # get lastrowid
-        ingest_id = cursor.lastrowid
+    # get lastrowid
+    ingest_id = cursor.lastrowid
 
-        # tag dataframe with ingest_id
-        df["ingest_id"] = ingest_id
+    # tag dataframe with ingest_id
+    df["ingest_id"] = ingest_id
 
-        try:
-            df.to_sql(to_table, conn, if_exists="append", index=False)
+    if is_encoded(data_collection, conn):
+        df = _encode_frame(cursor, data_collection, df, schema_dict or s.SCHEMA)
 
-            # Update success flag in log
-            cursor.execute(
-                """
-                UPDATE _ingest_log
-                SET success = 1
-                WHERE ingest_id = ?
-                """,
-                (ingest_id,)
-            )
+    _insert_frame(cursor, to_table, df)
 
-        except Exception as e:
-            raise e
+    # Update success flag in log
+    cursor.execute(
+        """
+        UPDATE _ingest_log
+        SET success = 1
+        WHERE ingest_id = ?
+        """,
+        (ingest_id,)
+    )
+    bump_snapshot_version(conn)
 
     return ingest_id
 
 
-def raw_to_prod(
-        conn_path: Union[str, Path],
+def _snapshot_select_sql(
         table_prefix: str,
-        cutoff: str
-)-> None:
+        n_tables: int = None,
+        raw_table: str = None
+)-> str:
     """
-    Moves the data from raw to prod table, selecting the most recent version of each record
-    that are older than the cutoff provided.
-    Args:
-        conn_path: Database path
-        table_prefix: data collection name
-        cutoff: the date as of which we want to stage data
-
-    Returns:
-        None
-
+    SELECT statement returning the rows of the most recent successful version of each table
+    as of a cutoff. Positional parameters are (cutoff, data_collection), followed by
+    n_tables table names if the selection is restricted to specific tables.
+    raw_table is the source of RAW rows (default {table_prefix}_raw, see raw_source()).
     """
-    staging_query = f"""
+    raw_table = raw_table or f"{table_prefix}_raw"
+    table_filter = ""
+    if n_tables:
+        placeholders = ", ".join("?" for _ in range(n_tables))
+        table_filter = f"AND table_name IN ({placeholders})"
 
-        CREATE TABLE {table_prefix}_prod AS
+    return f"""
         WITH current_ts AS
         (
             SELECT 
@@ -368,6 +688,7 @@ def raw_to_prod(
                 ingest_ts <= ?
                 AND data_collection = ?
                 AND success = 1
+                {table_filter}
             GROUP BY
                 table_name
         )
@@ -377,7 +698,7 @@ def raw_to_prod(
             ,log.table_description
             ,data.*
         FROM 
-            {table_prefix}_raw AS data
+            {raw_table} AS data
         JOIN
             current_ts as ts
         ON
@@ -386,22 +707,621 @@ def raw_to_prod(
         JOIN 
             _ingest_log as log
         ON 
-            data.ingest_id = log.ingest_id;
+            data.ingest_id = log.ingest_id
+    """
 
+
+def get_selected_versions(
+        conn_path: Union[str, Path],
+        data_collection: str,
+        cutoff: str
+)-> dict:
     """
+    Resolve the version (ingest_ts) of each table that would be staged for a given cutoff.
 
-    with sqlite3.connect(conn_path) as conn:
+    Args:
+        conn_path: Database path
+        data_collection: data collection name
+        cutoff: the date as of which we want to stage data
+
+    Returns:
+        a dictionary {table_name: ingest_ts}
+
+    """
+    rows = get_reader(conn_path).execute("""
+        SELECT 
+            table_name
+            ,MAX(ingest_ts)
+        FROM 
+            _ingest_log
+        WHERE
+            data_collection = ?
+            AND success = 1
+            AND ingest_ts <= ?
+        GROUP BY
+            table_name;
+    """, (data_collection, cutoff)).fetchall()
+
+    return dict(rows)
+
+
+def get_staged_versions(
+        conn_path: Union[str, Path],
+        data_collection: str
+)-> dict:
+    """
+    Return the version (ingest_ts) of each table currently in the prod snapshot.
+
+    Args:
+        conn_path: Database path
+        data_collection: data collection name
+
+    Returns:
+        a dictionary {table_name: ingest_ts}. Empty if the collection is not staged.
+
+    """
+    if not table_exists(f"{data_collection}_prod", conn_path):
+        return {}
+
+    rows = get_reader(conn_path).execute(f"""
+        SELECT 
+            table_name
+            ,MAX(ingest_ts)
+        FROM 
+            {data_collection}_prod
+        GROUP BY
+            table_name;
+    """).fetchall()
+
+    return dict(rows)
+
+
+def diff_versions(
+        conn_path: Union[str, Path],
+        data_collection: str,
+        from_cutoff: str,
+        to_cutoff: str,
+        table_name: str = None,
+        schema_dict: dict = None,
+        detail: bool = False
+)-> pd.DataFrame:
+    """
+    Compare the versions of the tables of a data collection selected at two cutoffs,
+    in SQL over RAW (see utils.generate_diff_sql). Cells are keyed on the dimension
+    columns and only the comparison result is returned.
+
+    Args:
+        conn_path: Database path
+        data_collection: data collection name
+        from_cutoff: ISO timestamp selecting the old versions
+        to_cutoff: ISO timestamp selecting the new versions
+        table_name: optional table to compare. Default is all tables
+        schema_dict: schema dictionary. Default is settings.SCHEMA
+        detail: whether to return the changed cells instead of the counts per table
+
+    Returns:
+        a dataframe with the counts of added, removed, changed and unchanged cells per
+        table or, with detail=True, one row per added, removed or changed cell
+
+    """
+    schema_dict = schema_dict or s.SCHEMA
+    query = u.generate_diff_sql(data_collection,
+                                schema_dict,
+                                encoded=is_encoded(data_collection, conn_path),
+                                detail=detail)
+
+    logging.debug(f"Comparing {data_collection} versions as of {from_cutoff} and {to_cutoff}")
+    return read_sql_as_frame(conn_path,
+                             query=query,
+                             query_params=(data_collection, from_cutoff, to_cutoff, table_name))
+
+
+def raw_to_prod(
+        conn_path: Union[str, Path],
+        table_prefix: str,
+        cutoff: str,
+        schema_dict: dict = None,
+        incremental: bool = False
+)-> Tuple[list, list]:
+    """
+    Moves the data from raw to prod table, selecting the most recent version of each record
+    that are older than the cutoff provided, and refreshes the metadata of the staged tables.
+
+    A full rebuild writes the new snapshot into a shadow table first; the shadow is then
+    swapped in with a rename, together with its index set and metadata, in a single
+    transaction. In incremental mode, the versions selected for the cutoff are compared with
+    the ones currently staged, and only the rows (and metadata) of tables whose version changed
+    are replaced, again in a single transaction. Either way, readers keep seeing the previous
+    snapshot until the new one is committed. Incremental mode falls back to a full rebuild if
+    the prod table does not exist yet.
+
+    Args:
+        conn_path: Database path
+        table_prefix: data collection name
+        cutoff: the date as of which we want to stage data
+        schema_dict: schema dictionary, used to resolve the indexed columns. Default is settings.SCHEMA
+        incremental: whether to restage only the tables whose version changed
+
+    Returns:
+        a tuple (staged, removed) with the list of tables (re)written to prod and the list
+        of previously staged tables that have no version for the cutoff.
+
+    """
+    schema_dict = schema_dict or s.SCHEMA
+    prod = f"{table_prefix}_prod"
+    shadow = f"{prod}_shadow"
+
+    raw_table = raw_source(table_prefix, conn_path)
+
+    selected = get_selected_versions(conn_path, table_prefix, cutoff)
+    current = get_staged_versions(conn_path, table_prefix)
+    removed = [t for t in current if t not in selected]
+
+    with closing(connect_writer(conn_path)) as conn:
+
+        if incremental and current:
+            staged = [t for t, ts in selected.items() if current.get(t) != ts]
+            logging.debug(f"Incremental staging: {len(staged)} changed and {len(removed)} removed table(s).")
+
+            to_delete = staged + removed
+            if not to_delete:
+                return [], []
+
+            with savepoint(conn, "stage"):
+                placeholders = ", ".join("?" for _ in to_delete)
+                conn.execute(f"DELETE FROM {prod} WHERE table_name IN ({placeholders});",
+                             to_delete)
+
+                if staged:
+                    conn.execute(f"INSERT INTO {prod} " + _snapshot_select_sql(table_prefix, len(staged), raw_table),
+                                 (cutoff, table_prefix, *staged))
+
+                metadata_df = compute_metadata(table_prefix, conn, schema_dict,
+                                               table_list=staged, from_table=prod)
+                replace_metadata(conn, table_prefix, metadata_df, table_list=to_delete)
+                bump_snapshot_version(conn)
+
+            return staged, removed
+
+        # build the new snapshot aside: prod stays readable meanwhile
+        _build_shadow(conn, table_prefix, shadow, cutoff, raw_table)
+
+        staged = list(selected)
+        metadata_df = compute_metadata(table_prefix, conn, schema_dict,
+                                       table_list=staged, from_table=shadow)
+
+        with savepoint(conn, "swap"):
+            _swap_in(conn, table_prefix, shadow, prod, schema_dict)
+            replace_metadata(conn, table_prefix, metadata_df)
+            bump_snapshot_version(conn)
+
+    return staged, removed
+
+
+def _build_shadow(
+        conn: sqlite3.Connection,
+        table_prefix: str,
+        shadow: str,
+        cutoff: str,
+        raw_table: str
+)-> None:
+    """Materialise the snapshot of a data collection as of cutoff into a shadow table."""
+    logging.debug(f"Building {shadow}.")
+    with savepoint(conn, "build"):
+        conn.execute(f"DROP TABLE IF EXISTS {shadow};")
+        conn.execute(f"CREATE TABLE {shadow} AS " + _snapshot_select_sql(table_prefix, raw_table=raw_table),
+                     (cutoff, table_prefix))
+
+
+def _swap_in(
+        conn: sqlite3.Connection,
+        table_prefix: str,
+        shadow: str,
+        target: str,
+        schema_dict: dict
+)-> None:
+    """
+    Replace target with a shadow table and rebuild its index set. Must run inside a
+    savepoint, together with the metadata of the new snapshot.
+    """
+    # do not let the rename rewrite references to target in other schema objects
+    logging.debug(f"Swapping {shadow} into {target}.")
+    conn.execute("PRAGMA legacy_alter_table = ON;")
+    conn.execute(f"DROP TABLE IF EXISTS {target};")
+    conn.execute(f"ALTER TABLE {shadow} RENAME TO {target};")
+
+    for stmt in u.generate_index_set_sql(table_prefix, "prod", schema_dict, table=target).splitlines():
+        conn.execute(stmt)
+
+
+def snapshot_table(
+        data_collection: str,
+        name: str
+)-> str:
+    """
+    Name of the table of a named snapshot, {data_collection}_snap_{name}.
+    Names must start with a letter and only contain letters, digits and underscores.
+    """
+    if not isinstance(name, str) or not re.fullmatch(r"[A-Za-z][A-Za-z0-9_]{0,63}", name):
+        raise ValueError(f"Invalid snapshot name {name!r}: use letters, digits and underscores, "
+                         f"starting with a letter (max 64 characters).")
+    return f"{data_collection}_snap_{name}"
+
+
+def create_snapshot(
+        conn_path: Union[str, Path],
+        table_prefix: str,
+        name: str,
+        cutoff: str,
+        schema_dict: dict = None,
+        replace: bool = False
+)-> list:
+    """
+    Materialise a named snapshot of a data collection as of a cutoff into
+    {table_prefix}_snap_{name}, with its own index set and metadata, and record its cutoff
+    and table versions in the snapshot registry. The staged prod snapshot is not affected.
+
+    Args:
+        conn_path: Database path
+        table_prefix: data collection name
+        name: snapshot name (see snapshot_table)
+        cutoff: the date as of which the snapshot is taken
+        schema_dict: schema dictionary. Default is settings.SCHEMA
+        replace: whether to rebuild an existing snapshot with the same name
+
+    Returns:
+        the list of tables in the snapshot
+
+    """
+    schema_dict = schema_dict or s.SCHEMA
+    target = snapshot_table(table_prefix, name)
+    shadow = f"{target}_shadow"
+
+    if not replace and name in get_snapshots(conn_path, table_prefix):
+        raise ValueError(f"Snapshot {name} already exists for {table_prefix}. Drop it or pass replace=True.")
+
+    selected = get_selected_versions(conn_path, table_prefix, cutoff)
+    if not selected:
+        raise ValueError(f"No version of {table_prefix} tables was ingested before {cutoff}.")
+
+    raw_table = raw_source(table_prefix, conn_path)
+    with closing(connect_writer(conn_path)) as conn:
+        _build_shadow(conn, table_prefix, shadow, cutoff, raw_table)
+
+        metadata_df = compute_metadata(table_prefix, conn, schema_dict,
+                                       table_list=list(selected), from_table=shadow)
+        metadata_df.insert(0, "snapshot", name)
+
+        with savepoint(conn, "swap"):
+            _swap_in(conn, table_prefix, shadow, target, schema_dict)
+            _delete_snapshot_entries(conn, table_prefix, name)
+
+            conn.execute("INSERT INTO _snapshots VALUES (?, ?, ?, ?);",
+                         (table_prefix, name, cutoff, datetime.datetime.now().isoformat()))
+            conn.executemany("INSERT INTO _snapshot_versions VALUES (?, ?, ?, ?);",
+                             [(table_prefix, name, t, ts) for t, ts in selected.items()])
+            if not metadata_df.empty:
+                _insert_frame(conn.cursor(), "_snapshot_metadata", metadata_df)
+            bump_snapshot_version(conn)
+
+    return list(selected)
+
+
+def _delete_snapshot_entries(
+        conn: sqlite3.Connection,
+        data_collection: str,
+        name: str
+)-> None:
+    """Remove a snapshot from the registry (without committing)."""
+    for registry, name_col in (("_snapshots", "name"),
+                               ("_snapshot_versions", "name"),
+                               ("_snapshot_metadata", "snapshot")):
+        conn.execute(f"DELETE FROM {registry} WHERE data_collection = ? AND {name_col} = ?;",
+                     (data_collection, name))
+
+
+def drop_snapshot(
+        conn_path: Union[str, Path],
+        data_collection: str,
+        name: str
+)-> None:
+    """
+    Drop a named snapshot table and its registry entries. Its versions are no longer
+    protected from pruning afterwards.
+    """
+    target = snapshot_table(data_collection, name)
+    if name not in get_snapshots(conn_path, data_collection):
+        raise KeyError(f"No snapshot {name} for {data_collection}.")
+
+    with closing(connect_writer(conn_path)) as conn:
+        with savepoint(conn, "drop_snapshot"):
+            conn.execute(f"DROP TABLE IF EXISTS {target};")
+            _delete_snapshot_entries(conn, data_collection, name)
+            bump_snapshot_version(conn)
+
+
+def get_snapshots(
+        conn_path: Union[str, Path],
+        data_collection: str
+)-> dict:
+    """
+    Return the named snapshots of a data collection as {name: cutoff}.
+    """
+    rows = get_reader(conn_path).execute("""
+        SELECT name, cutoff
+        FROM _snapshots
+        WHERE data_collection = ?
+        ORDER BY name;
+    """, (data_collection,)).fetchall()
+
+    return dict(rows)
+
+
+def get_snapshot_versions(
+        conn_path: Union[str, Path],
+        data_collection: str
+)-> dict:
+    """
+    Return the versions used by the named snapshots of a data collection,
+    as {table_name: set of ingest_ts}.
+    """
+    rows = get_reader(conn_path).execute("""
+        SELECT table_name, ingest_ts
+        FROM _snapshot_versions
+        WHERE data_collection = ?;
+    """, (data_collection,)).fetchall()
+
+    versions = {}
+    for table_name, ingest_ts in rows:
+        versions.setdefault(table_name, set()).add(ingest_ts)
+    return versions
 
-        cursor = conn.cursor()
 
-        # remove previously live data
-        cursor.execute(f"DROP TABLE IF EXISTS {table_prefix}_prod;")
+def prune_versions(
+        conn_path: Union[str, Path],
+        data_collection: str,
+        keep_last: int = None,
+        protected: dict = None,
+        schema_dict: dict = None
+)-> dict:
+    """
+    Delete old versions and failed ingests of a data collection from RAW and the ingest log,
+    in a single transaction. The following are always removed:
+    - rows and log entries of failed ingests (success = 0),
+    - RAW rows whose ingest_id has no log entry (orphans).
+    If keep_last is set, only the last keep_last successful versions of each table are kept,
+    plus any version listed in protected.
+
+    Args:
+        conn_path: Database path
+        data_collection: data collection name
+        keep_last: number of versions to keep per table. If None, no successful version is removed
+        protected: dictionary {table_name: set of ingest_ts} of versions that must be kept
+            (e.g. the ones used by a staged snapshot)
+        schema_dict: schema dictionary, used to clean up the dimension lookup of encoded RAW tables
+
+    Returns:
+        a dictionary with the number of deleted versions, failed ingests and RAW rows
+
+    """
+    if keep_last is not None and keep_last < 1:
+        raise ValueError("keep_last must be a positive integer.")
+
+    schema_dict = schema_dict or s.SCHEMA
+    protected = protected or {}
+    raw = f"{data_collection}_raw"
+
+    with closing(connect_writer(conn_path)) as conn:
+        log = conn.execute("""
+            SELECT 
+                ingest_id
+                ,table_name
+                ,ingest_ts
+                ,success
+            FROM 
+                _ingest_log
+            WHERE
+                data_collection = ?;
+        """, (data_collection,)).fetchall()
+
+        # successful versions of each table, most recent first
+        versions = {}
+        for _, table_name, ingest_ts, success in log:
+            if success == 1:
+                versions.setdefault(table_name, set()).add(ingest_ts)
+
+        pruned = set()
+        if keep_last is not None:
+            for table_name, ts_set in versions.items():
+                for ts in sorted(ts_set, reverse=True)[keep_last:]:
+                    if ts not in protected.get(table_name, set()):
+                        pruned.add((table_name, ts))
+
+        failed_ids = [i for i, _, _, success in log if success != 1]
+        pruned_ids = [i for i, table_name, ts, success in log
+                      if success == 1 and (table_name, ts) in pruned]
+        to_delete = [(i,) for i in failed_ids + pruned_ids]
+
+        with savepoint(conn, "prune"):
+            n_rows = conn.total_changes
+            conn.executemany(f"DELETE FROM {raw} WHERE ingest_id = ?;", to_delete)
+            conn.execute(f"""
+                DELETE FROM {raw}
+                WHERE ingest_id NOT IN (SELECT ingest_id FROM _ingest_log);
+            """)
+            n_rows = conn.total_changes - n_rows
+
+            conn.executemany("DELETE FROM _ingest_log WHERE ingest_id = ?;", to_delete)
+            bump_snapshot_version(conn)
+
+            # drop dimension values no longer referenced. Encoded columns are sparse: NULLs
+            # are left out, otherwise NOT IN would never be true
+            if is_encoded(data_collection, conn):
+                used = "\n                    UNION ".join(
+                    f"SELECT [{c}] FROM {raw} WHERE [{c}] IS NOT NULL"
+                    for c in u.get_encoded_columns(data_collection, schema_dict)
+                )
+                conn.execute(f"""
+                    DELETE FROM {data_collection}_dim
+                    WHERE dim_id NOT IN (
+                    {used}
+                    );
+                """)
+
+    return {
+        "versions_pruned": len(pruned),
+        "failed_ingests_removed": len(failed_ids),
+        "rows_deleted": n_rows
+    }
+
+
+def compact_db(conn_path: Union[str, Path])-> int:
+    """
+    Refresh query planner statistics (ANALYZE) and give free pages back to the file system.
+    Databases created with auto_vacuum = INCREMENTAL are compacted with an incremental vacuum;
+    older databases are converted with a one-off full VACUUM.
+
+    Args:
+        conn_path: Database path
+
+    Returns:
+        the number of bytes reclaimed
+
+    """
+    def _db_size(c: sqlite3.Connection) -> int:
+        return (c.execute("PRAGMA page_count;").fetchone()[0]
+                * c.execute("PRAGMA page_size;").fetchone()[0])
+
+    with closing(connect_writer(conn_path)) as conn:
+        size_before = _db_size(conn)
+
+        logging.debug("Running ANALYZE.")
+        conn.execute("ANALYZE;")
+
+        if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2:
+            logging.debug("Running incremental vacuum.")
+            conn.execute("PRAGMA incremental_vacuum;").fetchall()
+        else:
+            logging.info("Converting database to incremental auto-vacuum (full VACUUM).")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            conn.execute("VACUUM;")
+
+        # shrink the WAL file as well
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+        size_after = _db_size(conn)
+
+    return size_before - size_after
+
+
+def mirror_path(
+        conn_path: Union[str, Path],
+        data_collection: str
+)-> Path:
+    """
+    Location of the Parquet mirror of {data_collection}_prod: a directory next to the DB,
+    i.e. {db_dir}/{db_stem}_mirror/{data_collection}.
+    """
+    conn_path = Path(conn_path)
+    return conn_path.parent / f"{conn_path.stem}_mirror" / data_collection
+
 
-        # write staging table
-        cursor.execute(staging_query,
-                       (cutoff,table_prefix))
+def _mirror_schema(
+        conn: sqlite3.Connection,
+        data_collection: str,
+        schema_dict: dict
+)-> pa.Schema:
+    """
+    Arrow schema of the Parquet mirror, in the column order of the prod table and with
+    the types of the collection schema (service columns keep their SQLite affinity).
+    TEXT dimensions are dictionary-encoded; table_name is the partition key.
+    """
+    fields = []
+    for _, name, sql_type, *_ in conn.execute(f"PRAGMA table_info([{data_collection}_prod]);"):
+        sql_type = schema_dict[data_collection].get(name, {}).get("type", sql_type or "").upper()
+        if sql_type in {"INTEGER", "INT"}:
+            pa_type = pa.int64()
+        elif sql_type == "REAL":
+            pa_type = pa.float64()
+        elif sql_type == "TEXT" and name != "table_name":
+            pa_type = pa.dictionary(pa.int32(), pa.string())
+        else:
+            pa_type = pa.string()
+        fields.append(pa.field(name, pa_type))
+    return pa.schema(fields)
 
-        return None
+
+def write_parquet_mirror(
+        conn_path: Union[str, Path],
+        data_collection: str,
+        schema_dict: dict
+)-> Path:
+    """
+    Write the staged {data_collection}_prod to a Parquet dataset partitioned by table_name
+    (hive layout), with dictionary-encoded dimensions and rows sorted by year so that the
+    row-group statistics on year can be used to skip data. The dataset is written to a
+    temporary directory and then swapped with the existing mirror.
+
+    Args:
+        conn_path: Database path
+        data_collection: data collection name
+        schema_dict: a dictionary for table schema of data collections
+
+    Returns:
+        the path of the mirror
+
+    """
+    out_dir = mirror_path(conn_path, data_collection)
+    tmp_dir = out_dir.with_name(out_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    prod = f"{data_collection}_prod"
+
+    # the batches are consumed by the dataset writer threads
+    with closing(sqlite3.connect(conn_path, check_same_thread=False)) as conn:
+        schema = _mirror_schema(conn, data_collection, schema_dict)
+        table_names = [r[0] for r in conn.execute(f"SELECT DISTINCT table_name FROM [{prod}];")]
+
+        def batches():
+            # one table at a time to bound memory
+            for table_name in table_names:
+                df = pd.read_sql_query(
+                    f"SELECT * FROM [{prod}] WHERE table_name = ? ORDER BY year;",
+                    conn, params=(table_name,)
+                )
+                yield from pa.Table.from_pandas(df, schema=schema, preserve_index=False).to_batches()
+
+        logging.debug(f"Writing Parquet mirror of {prod} to {out_dir}")
+        ds.write_dataset(
+            batches(),
+            tmp_dir,
+            schema=schema,
+            format="parquet",
+            partitioning=ds.partitioning(pa.schema([("table_name", pa.string())]), flavor="hive"),
+            file_options=ds.ParquetFileFormat().make_write_options(use_dictionary=True,
+                                                                   write_statistics=True)
+        )
+
+    remove_parquet_mirror(conn_path, data_collection)
+    os.replace(tmp_dir, out_dir)
+
+    return out_dir
+
+
+def remove_parquet_mirror(
+        conn_path: Union[str, Path],
+        data_collection: str
+)-> bool:
+    """
+    Delete the Parquet mirror of a data collection, e.g. when it was restaged without it.
+    Returns True if a mirror was removed.
+    """
+    out_dir = mirror_path(conn_path, data_collection)
+    if not out_dir.exists():
+        return False
+
+    logging.debug(f"Removing Parquet mirror {out_dir}")
+    shutil.rmtree(out_dir)
+    return True
 
 
 def read_sql_as_frame(
@@ -423,13 +1343,81 @@ def read_sql_as_frame(
         a pandas dataframe
 
     """
-    with sqlite3.connect(conn_path) as conn:
-
-        df = pd.read_sql_query(query, conn,
-                               params=query_params)
+    conn = get_reader(conn_path)
+    df = pd.read_sql_query(query, conn,
+                           params=query_params)
 
     return df
 
+
+def read_sql_rows(
+        conn_path: Union[str, Path],
+        query: str,
+        query_params: tuple = None
+)-> Tuple[list, list]:
+    """
+    Run a parametrised query (positional placeholders ?) on the pooled read connection
+    and return the raw rows, without building a DataFrame. Used by serving paths that
+    serialise rows directly.
+
+    Args:
+        conn_path: connection string (path of db file)
+        query: the SQL query as a string
+        query_params: tuple of query parameters.
+
+    Returns:
+        a tuple (column names, list of row tuples)
+
+    """
+    cur = get_reader(conn_path).execute(query, query_params or ())
+    try:
+        return [d[0] for d in cur.description], cur.fetchall()
+    finally:
+        cur.close()
+
+
+def iter_sql_rows(
+        conn_path: Union[str, Path],
+        query: str,
+        query_params: tuple = None,
+        batch_size: int = 5000
+)-> Tuple[list, Iterator[list]]:
+    """
+    Run a parametrised query on a dedicated read connection and return its rows lazily,
+    in batches of at most batch_size rows, so that large results are never held in memory.
+    The query is executed straight away (so SQL errors are raised here); the connection is
+    closed when the batches are exhausted or the iterator is closed.
+
+    Args:
+        conn_path: connection string (path of db file)
+        query: the SQL query as a string
+        query_params: tuple of query parameters.
+        batch_size: number of rows fetched at a time
+
+    Returns:
+        a tuple (column names, iterator of lists of row tuples)
+
+    """
+    conn = open_reader(conn_path, check_same_thread=False)
+    try:
+        cur = conn.execute(query, query_params or ())
+    except Exception:
+        conn.close()
+        raise
+
+    def batches():
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+
+    return [d[0] for d in cur.description], batches()
+
+
 def table_exists(
         table_name: str,
         conn_path: Union[str, Path]
@@ -445,88 +1433,146 @@ def table_exists(
         bool: True if table exists, False otherwise.
     """
     try:
-        with sqlite3.connect(conn_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT name 
-                FROM sqlite_master 
-                WHERE type = 'table' 
-                    AND name = ?;
-            """, (table_name,))
-
-            result = cursor.fetchone()
-            return result is not None
+        cursor = get_reader(conn_path).cursor()
+        cursor.execute("""
+            SELECT name 
+            FROM sqlite_master 
+            WHERE type = 'table' 
+                AND name = ?;
+        """, (table_name,))
+
+        result = cursor.fetchone()
+        return result is not None
     except Exception as e:
         logging.error(f"Error checking table existence: {e}")
         return False
 
 
-def insert_metadata(
+def compute_metadata(
         data_collection: str,
-        table_name: str,
-        conn_path: Union[str, Path],
-        schema_dict: dict
+        conn: sqlite3.Connection,
+        schema_dict: dict,
+        table_list: list = None,
+        from_table: str = None
 )-> pd.DataFrame:
     """
-    Reads slice of _prod table and generates metadata for the slice
+    Generates metadata for the tables of a staged table with a single aggregate query
+    (COUNT and COUNT DISTINCT of every column, grouped by table_name). Columns that are
+    entirely NULL for a table are not queryable and are left out.
     Args:
-        data_collection: name of data collection (shadows the table)
-        table_name: slice to select
-        conn_path: DB file path
+        data_collection: name of data collection
+        conn: open DB connection
         schema_dict: dictionary that defines the schema of the parent table
+        table_list: tables to compute metadata for. Default is all tables in from_table
+        from_table: staged table to read. Default is {data_collection}_prod
 
     Returns:
-        a pandas dataframe with metadata for table_name
+        a pandas dataframe with metadata, one row per (table_name, column_name)
 
     """
+    from_table = from_table or data_collection + "_prod"
+    schema = schema_dict[data_collection]
+
+    # columns of the staged table, excluding service columns
+    service_cols = {"ingest_id", "ingest_ts", "table_description", "table_name"}
+    table_cols = [r[1] for r in conn.execute(f"PRAGMA table_info({from_table});")]
+    cols = [c for c in table_cols if c not in service_cols]
+
+    stats_sql = "\n            ,".join(f"COUNT([{c}]), COUNT(DISTINCT [{c}])" for c in cols)
+    table_filter, params = "", ()
+    if table_list is not None:
+        if not table_list:
+            return pd.DataFrame()
+        table_filter = "WHERE table_name IN (" + ", ".join("?" for _ in table_list) + ")"
+        params = tuple(table_list)
+
+    logging.debug(f"Calculate column stats from {from_table}.")
+    query = f"""
+        SELECT
+            table_name
+            ,{stats_sql}
+        FROM
+            {from_table}
+        {table_filter}
+        GROUP BY
+            table_name;
+    """
+    rows = conn.execute(query, params).fetchall()
+
+    # every requested table must have been staged
+    missing = set(table_list or []) - {r[0] for r in rows}
+    if missing:
+        raise sqlite3.IntegrityError(f"No data found for {data_collection}, {sorted(missing)}. \nAn error has occurred when staging the data.")
+
+    records = []
+    for table_name, *stats in rows:
+        for i, col in enumerate(cols):
+            n_non_nulls, n_unique = stats[2 * i], stats[2 * i + 1]
+            if n_non_nulls > 0:
+                records.append((data_collection, table_name, col, n_non_nulls, n_unique, schema[col]["type"]))
+
+    return pd.DataFrame.from_records(
+        records,
+        columns=["data_collection", "table_name", "column_name", "n_non_nulls", "n_unique", "dtype"]
+    )
 
-    logging.debug("Getting data from staged table.")
-    from_table = data_collection + "_prod"
-    where = "table_name = ?"
 
-    query = u.generate_select_sql(from_table=from_table, where=where)
-    df = read_sql_as_frame(
-        conn_path=conn_path,
-        query=query,
-        query_params=(table_name,)
-    )
+def replace_metadata(
+        conn: sqlite3.Connection,
+        data_collection: str,
+        metadata_df: pd.DataFrame,
+        table_list: list = None
+)-> None:
+    """
+    Replace metadata rows without committing, so that it can be part of a larger transaction.
+    Args:
+        conn: open DB connection (see connect_writer)
+        data_collection: name of data collection
+        metadata_df: new metadata rows
+        table_list: tables whose metadata is removed first. If None, the metadata of the
+            whole data collection is replaced.
 
-    # early return for empty dataframe
-    if df.empty:
-        raise sqlite3.IntegrityError(f"No data found for {data_collection}, {table_name}. \nAn error has occurred when staging the data.")
+    Returns:
+        None
 
-    logging.debug("Dropping service columns.")
-    df = df.dropna(axis=1, how="all")
-    df.drop(columns=["ingest_id", "ingest_ts", "table_description"], inplace=True, errors="ignore")
+    """
+    cursor = conn.cursor()
+    if table_list is None:
+        cursor.execute("DELETE FROM _metadata WHERE data_collection = ?;", (data_collection,))
+    else:
+        cursor.executemany("""
+            DELETE FROM _metadata
+            WHERE data_collection = ? AND table_name = ?;
+        """, [(data_collection, t) for t in table_list])
 
-    df["data_collection"] = data_collection
+    if not metadata_df.empty:
+        _insert_frame(cursor, "_metadata", metadata_df)
 
-    logging.debug("Reshape metadata into long format.")
-    metadata_df = pd.melt(
-        df.head(1),
-        id_vars=["data_collection", "table_name"],
-        var_name="column_name",
-        value_name="temp"
-    ).drop(columns="temp")
 
-    logging.debug("Calculate column stats.")
-    metadata_df["n_non_nulls"] = (metadata_df["column_name"]
-                                  .apply(lambda c: df[c].notna().sum()))
-    metadata_df["n_unique"] = (metadata_df["column_name"]
-                               .apply(lambda c: df[c].nunique()))
-    metadata_df["dtype"] = (metadata_df["column_name"]
-                            .apply(lambda c: schema_dict[data_collection][c]["type"]))
+def insert_metadata(
+        data_collection: str,
+        table_name: str,
+        conn_path: Union[str, Path],
+        schema_dict: dict
+)-> pd.DataFrame:
+    """
+    Reads slice of _prod table, generates metadata for the slice and writes it to _metadata
+    Args:
+        data_collection: name of data collection (shadows the table)
+        table_name: slice to select
+        conn_path: DB file path
+        schema_dict: dictionary that defines the schema of the parent table
 
+    Returns:
+        a pandas dataframe with metadata for table_name
 
-    logging.debug("Write to database.")
-    with sqlite3.connect(conn_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            DELETE FROM _metadata
-            WHERE data_collection = ? AND table_name = ?;
-        """, (data_collection, table_name))
+    """
+    with closing(connect_writer(conn_path)) as conn:
+        metadata_df = compute_metadata(data_collection, conn, schema_dict, table_list=[table_name])
 
-        metadata_df.to_sql("_metadata", conn, if_exists="append", index=False)
+        logging.debug("Write to database.")
+        with savepoint(conn, "metadata"):
+            replace_metadata(conn, data_collection, metadata_df, table_list=[table_name])
 
     return metadata_df
 
@@ -534,30 +1580,81 @@ def insert_metadata(
 def load_column_info(
         conn_path: Union[str, Path],
         data_collection: str,
-        table_name: str
+        table_name: str,
+        snapshot: str = None
 )-> Union[dict, callable]:
 
     # expects metadata table with columns: column_name, dtype
+    # named snapshots keep their own metadata
+    where = "data_collection = ? AND table_name = ?"
+    params = (data_collection, table_name)
+    if snapshot is not None:
+        where += " AND snapshot = ?"
+        params += (snapshot,)
+
     query = u.generate_select_sql(
-        from_table="_metadata",
+        from_table="_metadata" if snapshot is None else "_snapshot_metadata",
         cols=["column_name", "dtype"],
-        where="data_collection = ? AND table_name = ?"
+        where=where
     )
-    meta = read_sql_as_frame(
+    _, rows = read_sql_rows(
         conn_path,
         query=query,
-        query_params=(data_collection, table_name)
+        query_params=params
     )
 
-    if meta.empty:
+    if not rows:
         raise ValueError(f"No metadata for {data_collection} {table_name}")
 
     # build maps
-    sql_types = {r["column_name"]: r["dtype"] for _, r in meta.iterrows()}
+    sql_types = dict(rows)
+    cast = {col: s.DTYPES[sql_t] for col, sql_t in sql_types.items()}
 
-    cast = {}
-    for col, sql_t in sql_types.items():
-        py = s.DTYPES[sql_t]
-        cast[col] = py
+    return sql_types, cast
+
+
+def load_all_column_info(conn_path: Union[str, Path])-> dict:
+    """
+    Column info (see load_column_info) of every staged table and named snapshot table,
+    read with one query per metadata table.
+
+    Args:
+        conn_path: Database path
+
+    Returns:
+        a dictionary {(data_collection, snapshot, table_name): (sql_types, cast)}, where
+        snapshot is None for the staged prod tables
+    """
+    query = """
+        SELECT data_collection, NULL, table_name, column_name, dtype
+        FROM _metadata"""
+    # DBs created before named snapshots have no snapshot metadata
+    if table_exists("_snapshot_metadata", conn_path):
+        query += """
+        UNION ALL
+        SELECT data_collection, snapshot, table_name, column_name, dtype
+        FROM _snapshot_metadata"""
+    _, rows = read_sql_rows(conn_path, query=query + ";")
+
+    info = {}
+    for dc, snapshot, table_name, col, sql_t in rows:
+        sql_types, cast = info.setdefault((dc, snapshot, table_name), ({}, {}))
+        sql_types[col] = sql_t
+        cast[col] = s.DTYPES[sql_t]
+
+    return info
+
+
+def schema_column_info(
+        data_collection: str,
+        schema_dict: dict
+)-> Tuple[dict, dict]:
+    """
+    Same output as load_column_info(), from the collection schema rather than _metadata.
+    Used for tables read from RAW (e.g. as-of queries), which have no metadata.
+    """
+    sql_types = {col: props["type"] for col, props in schema_dict[data_collection].items()
+                 if col != "ingest_id"}
+    cast = {col: s.DTYPES[sql_t] for col, sql_t in sql_types.items()}
 
-    return sql_types, cast
\ No newline at end of file
+    return sql_types, cast
@@ -1,4 +1,5 @@
 import json
+import datetime
 import inspect
 import os.path
 import re
@@ -152,7 +153,8 @@ def remove_note_tags(text: str)-> str:
 def generate_create_table_sql(
         table_prefix: str,
         table_env: str,
-        schema_dict: dict
+        schema_dict: dict,
+        encoded: bool = False
 ) -> str:
     """
     Function that generates a SQL query string for creating a table
@@ -162,11 +164,13 @@ def generate_create_table_sql(
         table_prefix: the table identifier, normally the data_collection
         table_env: either raw or prod
         schema_dict: a dictionary for table schema of data collections. The first column is assumed to be the index column.
+        encoded: if True, dimension columns (see get_encoded_columns) are stored as INTEGER codes
 
     Returns:
         the generated query as a string
 
     """
+    encoded_cols = get_encoded_columns(table_prefix, schema_dict) if encoded else []
     schema_dict = schema_dict[table_prefix]
 
     destination_table = f"{table_prefix}_{table_env}"
@@ -174,7 +178,7 @@ def generate_create_table_sql(
     columns = []
 
     for col, props in schema_dict.items():
-        sql_type = props["type"]
+        sql_type = "INTEGER" if col in encoded_cols else props["type"]
         nullable = "" if props.get("nullable", True) else "NOT NULL"
         columns.append(f"[{col}] {sql_type} {nullable}".strip())
 
@@ -188,6 +192,349 @@ def generate_create_table_sql(
     return create_table
 
 
+def get_encoded_columns(
+        table_prefix: str,
+        schema_dict: dict
+)-> list:
+    """
+    Return the dimension columns that are dictionary-encoded in the RAW layout:
+    all TEXT columns except table_name, which is used to join the ingest log.
+    """
+    return [col for col, props in schema_dict[table_prefix].items()
+            if props["type"] == "TEXT" and col != "table_name"]
+
+
+def generate_create_dim_sql(table_prefix: str)-> str:
+    """
+    Generate the lookup table holding the distinct dimension strings of a data collection.
+    """
+    sql = f"""
+        CREATE TABLE IF NOT EXISTS [{table_prefix}_dim] (\n
+            dim_id      INTEGER PRIMARY KEY,
+            value       TEXT NOT NULL UNIQUE
+            );
+    """
+    return sql
+
+
+def _raw_select_parts(
+        table_prefix: str,
+        schema_dict: dict,
+        encoded: bool
+)-> Tuple[list, list]:
+    """
+    Select list and joins reading the columns of a RAW table (alias r) with plain values,
+    decoding dimension codes through {table_prefix}_dim if the table is encoded.
+    """
+    encoded_cols = get_encoded_columns(table_prefix, schema_dict) if encoded else []
+
+    select_cols = []
+    joins = []
+    for col in schema_dict[table_prefix]:
+        if col in encoded_cols:
+            select_cols.append(f"[d_{col}].value AS [{col}]")
+            joins.append(f"LEFT JOIN [{table_prefix}_dim] AS [d_{col}] ON [d_{col}].dim_id = r.[{col}]")
+        else:
+            select_cols.append(f"r.[{col}]")
+
+    return select_cols, joins
+
+
+def generate_decoded_view_sql(
+        table_prefix: str,
+        schema_dict: dict
+)-> str:
+    """
+    Generate a view over a dictionary-encoded RAW table that decodes dimension codes,
+    so that it has the same columns (and column order) as a plain RAW table.
+
+    Args:
+        table_prefix: the table identifier, normally the data_collection
+        schema_dict: a dictionary for table schema of data collections
+
+    Returns:
+        the generated statement as a string
+
+    """
+    select_cols, joins = _raw_select_parts(table_prefix, schema_dict, encoded=True)
+
+    select_sql = "\n            ,".join(select_cols)
+    joins_sql = "\n        ".join(joins)
+
+    sql = f"""
+        CREATE VIEW IF NOT EXISTS [{table_prefix}_raw_decoded] AS
+        SELECT
+            {select_sql}
+        FROM
+            [{table_prefix}_raw] AS r
+        {joins_sql};
+    """
+    return sql
+
+
+def generate_history_view_sql(
+        table_prefix: str,
+        schema_dict: dict,
+        encoded: bool = False
+)-> str:
+    """
+    Generate a view exposing every successfully ingested version of the RAW rows of a
+    data collection, with the same columns as the prod table plus raw_rowid (the RAW
+    rowid, used for cursor pagination). Rows of a version are resolved through the
+    (ingest_id) index on RAW, see generate_as_of_where().
+
+    Args:
+        table_prefix: the table identifier, normally the data_collection
+        schema_dict: a dictionary for table schema of data collections
+        encoded: whether the RAW table uses the dictionary-encoded layout
+
+    Returns:
+        the generated statement as a string
+
+    """
+    select_cols, joins = _raw_select_parts(table_prefix, schema_dict, encoded)
+
+    select_sql = "\n            ,".join(["log.ingest_ts", "log.table_description"]
+                                       + select_cols
+                                       + ["r.rowid AS raw_rowid"])
+    joins_sql = "\n        ".join(joins)
+
+    sql = f"""
+        CREATE VIEW IF NOT EXISTS [{table_prefix}_history] AS
+        SELECT
+            {select_sql}
+        FROM
+            [{table_prefix}_raw] AS r
+        JOIN
+            _ingest_log AS log
+        ON
+            r.ingest_id = log.ingest_id
+        {joins_sql}
+        WHERE
+            log.success = 1;
+    """
+    return sql
+
+
+def generate_as_of_where(where: str = None)-> str:
+    """
+    WHERE clause selecting, from a {collection}_history view, the rows of the most recent
+    successful version of one table as of a cutoff. The version is resolved on the
+    _ingest_log index. Positional parameters are (data_collection, table_name, cutoff),
+    followed by the parameters of the optional where clause.
+
+    Args:
+        where: additional filters, e.g. from build_where_clause()
+
+    Returns:
+        the WHERE clause as a string (without the WHERE keyword)
+
+    """
+    as_of = """ingest_id IN (
+            SELECT 
+                ingest_id
+            FROM 
+                _ingest_log
+            WHERE 
+                data_collection = ?1
+                AND table_name = ?2
+                AND success = 1
+                AND ingest_ts = (
+                    SELECT 
+                        MAX(ingest_ts)
+                    FROM 
+                        _ingest_log
+                    WHERE 
+                        data_collection = ?1
+                        AND table_name = ?2
+                        AND success = 1
+                        AND ingest_ts <= ?3
+                )
+        )"""
+
+    return f"{as_of} AND ({where})" if where else as_of
+
+
+def get_diff_key(
+        table_prefix: str,
+        schema_dict: dict
+)-> list:
+    """
+    Return the columns identifying a cell across versions of a table: all schema columns
+    except ingest_id, the row position and the value.
+    """
+    return [col for col in schema_dict[table_prefix]
+            if col not in {"ingest_id", "row", "value"}]
+
+
+def generate_diff_sql(
+        table_prefix: str,
+        schema_dict: dict,
+        encoded: bool = False,
+        detail: bool = False
+)-> str:
+    """
+    Generate a query comparing, for each table of a data collection, the versions selected
+    at two cutoffs (same rule as staging). Cells of both versions are read from RAW in a
+    single pass through the (ingest_id) index and paired by key (see get_diff_key) with a
+    GROUP BY, so NULL dimensions match each other. Duplicate keys within a version are
+    paired in row order. On the dictionary-encoded layout codes are compared directly and
+    only decoded for the detailed output.
+    Positional parameters are (data_collection, from_cutoff, to_cutoff, table_name), where
+    table_name can be None to compare all tables.
+
+    Args:
+        table_prefix: the table identifier, normally the data_collection
+        schema_dict: a dictionary for table schema of data collections
+        encoded: whether the RAW table uses the dictionary-encoded layout
+        detail: if True, return one row per added, removed or changed cell
+            (key columns, change, old_value, new_value). Otherwise, return the counts
+            per table (table_name, from_ts, to_ts, added, removed, changed, unchanged)
+
+    Returns:
+        the generated query as a string
+
+    """
+    key = get_diff_key(table_prefix, schema_dict)
+    key_sql = ", ".join(f"[{c}]" for c in key)
+    r_key_sql = ", ".join(f"r.[{c}]" for c in key)
+
+    sql = f"""
+        WITH vers AS (
+            SELECT
+                table_name
+                ,MAX(CASE WHEN ingest_ts <= ?2 THEN ingest_ts END) AS from_ts
+                ,MAX(CASE WHEN ingest_ts <= ?3 THEN ingest_ts END) AS to_ts
+            FROM
+                _ingest_log
+            WHERE
+                data_collection = ?1
+                AND success = 1
+                AND (?4 IS NULL OR table_name = ?4)
+            GROUP BY
+                table_name
+        ),
+        ids AS (
+            SELECT
+                log.ingest_id
+                ,log.ingest_ts IS v.to_ts AS is_new
+            FROM
+                vers AS v
+            JOIN
+                _ingest_log AS log
+            ON
+                log.data_collection = ?1
+                AND log.table_name = v.table_name
+                AND log.success = 1
+                AND log.ingest_ts IN (v.from_ts, v.to_ts)
+            WHERE
+                v.from_ts IS NOT v.to_ts
+        ),
+        cells AS (
+            SELECT
+                i.is_new
+                ,{r_key_sql}
+                ,r.[value]
+                ,ROW_NUMBER() OVER (PARTITION BY r.ingest_id, {r_key_sql} ORDER BY r.[row]) AS dup
+            FROM
+                ids AS i
+            JOIN
+                [{table_prefix}_raw] AS r
+            ON
+                r.ingest_id = i.ingest_id
+        ),
+        pairs AS (
+            SELECT
+                {key_sql}
+                ,MIN(is_new) = 0 AS in_old
+                ,MAX(is_new) = 1 AS in_new
+                ,MAX(CASE WHEN is_new = 0 THEN [value] END) AS old_value
+                ,MAX(CASE WHEN is_new = 1 THEN [value] END) AS new_value
+            FROM
+                cells
+            GROUP BY
+                {key_sql}, dup
+        ),
+        changes AS (
+            SELECT
+                *
+                ,CASE
+                    WHEN NOT in_old THEN 'added'
+                    WHEN NOT in_new THEN 'removed'
+                    WHEN old_value IS NOT new_value THEN 'changed'
+                END AS change
+            FROM
+                pairs
+        )"""
+
+    if not detail:
+        return sql + """
+        SELECT
+            v.table_name
+            ,v.from_ts
+            ,v.to_ts
+            ,COUNT(CASE WHEN c.change = 'added' THEN 1 END) AS added
+            ,COUNT(CASE WHEN c.change = 'removed' THEN 1 END) AS removed
+            ,COUNT(CASE WHEN c.change = 'changed' THEN 1 END) AS changed
+            ,COUNT(CASE WHEN c.table_name IS NOT NULL AND c.change IS NULL THEN 1 END) AS unchanged
+        FROM
+            vers AS v
+        LEFT JOIN
+            changes AS c
+        ON
+            c.table_name = v.table_name
+        WHERE
+            v.from_ts IS NOT NULL
+            OR v.to_ts IS NOT NULL
+        GROUP BY
+            v.table_name, v.from_ts, v.to_ts
+        ORDER BY
+            v.table_name;
+    """
+
+    # decode dimension codes of the changed cells only
+    encoded_cols = get_encoded_columns(table_prefix, schema_dict) if encoded else []
+    select_cols = []
+    joins = []
+    for col in key:
+        if col in encoded_cols:
+            select_cols.append(f"[d_{col}].value AS [{col}]")
+            joins.append(f"LEFT JOIN [{table_prefix}_dim] AS [d_{col}] ON [d_{col}].dim_id = c.[{col}]")
+        else:
+            select_cols.append(f"c.[{col}]")
+
+    select_sql = "\n            ,".join(select_cols + ["c.change", "c.old_value", "c.new_value"])
+    joins_sql = "\n        ".join(joins)
+
+    return sql + f"""
+        SELECT
+            {select_sql}
+        FROM
+            changes AS c
+        {joins_sql}
+        WHERE
+            c.change IS NOT NULL
+        ORDER BY
+            c.table_name, c.change;
+    """
+
+
+def parse_cutoff(as_of_date: str = None)-> str:
+    """
+    Convert an as-of date ('%Y-%m-%d') into the ISO timestamp compared with ingest_ts.
+    Full ISO timestamps (e.g. an ingest_ts listed by versions()) are also accepted.
+    Default is now.
+    """
+    if as_of_date is None:
+        return datetime.datetime.now().isoformat()
+    try:
+        return datetime.datetime.strptime(as_of_date, "%Y-%m-%d").isoformat()
+    except ValueError:
+        if "T" not in as_of_date:
+            raise
+        return datetime.datetime.fromisoformat(as_of_date).isoformat()
+
+
 def generate_create_log_sql()-> str:
     sql = """
         CREATE TABLE IF NOT EXISTS [_ingest_log] (\n
@@ -218,6 +565,123 @@ def generate_create_metadata_sql()-> str:
     return query
 
 
+def generate_create_snapshot_registry_sql()-> str:
+    """
+    Registry of named snapshots: cutoff, table versions and metadata of each snapshot
+    (the latter with the same columns as _metadata).
+    """
+    query = """
+        CREATE TABLE IF NOT EXISTS [_snapshots] (
+            [data_collection]     TEXT    NOT NULL,
+            [name]                TEXT    NOT NULL,
+            [cutoff]              DATETIME NOT NULL,
+            [created_ts]          DATETIME NOT NULL,
+            PRIMARY KEY (data_collection, name)
+        );
+        CREATE TABLE IF NOT EXISTS [_snapshot_versions] (
+            [data_collection]     TEXT    NOT NULL,
+            [name]                TEXT    NOT NULL,
+            [table_name]          TEXT    NOT NULL,
+            [ingest_ts]           DATETIME NOT NULL,
+            PRIMARY KEY (data_collection, name, table_name)
+        );
+        CREATE TABLE IF NOT EXISTS [_snapshot_metadata] (
+            [snapshot]            TEXT    NOT NULL,
+            [data_collection]     TEXT    NOT NULL,
+            [table_name]          TEXT    NOT NULL,
+            [column_name]         TEXT    NOT NULL,
+            [n_non_nulls]         INTEGER NOT NULL,
+            [n_unique]            INTEGER NOT NULL,
+            [dtype]               TEXT    NOT NULL,
+            PRIMARY KEY (data_collection, snapshot, table_name, column_name)
+        );
+    """
+    return query
+
+
+def generate_create_state_sql()-> str:
+    """
+    Key/value table of DB-wide state, e.g. the snapshot version token.
+    """
+    query = """
+        CREATE TABLE IF NOT EXISTS [_state] (
+            [key]                 TEXT    PRIMARY KEY,
+            [value]               TEXT    NOT NULL
+        );
+    """
+    return query
+
+
+def generate_create_index_sql(
+        table: str,
+        cols: list,
+        index_name: str = None
+)-> str:
+    """
+    Generate an idempotent CREATE INDEX statement.
+
+    Args:
+        table: the indexed table
+        cols: list of indexed columns, in order
+        index_name: optional index name. Default is idx_{table}_{col1}_{col2}...
+
+    Returns:
+        the generated statement as a string
+
+    """
+    if index_name is None:
+        index_name = f"idx_{table}_" + "_".join(cols)
+
+    cols_sql = ", ".join(f"[{c}]" for c in cols)
+
+    return f"CREATE INDEX IF NOT EXISTS [{index_name}] ON [{table}] ({cols_sql});"
+
+
+def generate_index_set_sql(
+        table_prefix: str,
+        table_env: str,
+        schema_dict: dict,
+        table: str = None
+)-> str:
+    """
+    Generate the set of indexes maintained for the tables of a data collection.
+    - raw: (ingest_id), used to join raw rows to the ingest log
+    - prod: (table_name, year), plus (table_name, column) for each column flagged
+      with "indexed": true in the schema
+    - log: (data_collection, table_name, success, ingest_ts) on _ingest_log. table_prefix is ignored
+
+    Args:
+        table_prefix: the table identifier, normally the data_collection
+        table_env: either raw, prod or log
+        schema_dict: a dictionary for table schema of data collections
+        table: the indexed table, if other than {table_prefix}_{table_env} (e.g. a named snapshot)
+
+    Returns:
+        a SQL script with one CREATE INDEX statement per line
+
+    """
+    if table_env == "log":
+        return generate_create_index_sql(
+            table="_ingest_log",
+            cols=["data_collection", "table_name", "success", "ingest_ts"],
+            index_name="idx_ingest_log_versions"
+        )
+
+    table = table or f"{table_prefix}_{table_env}"
+
+    if table_env == "raw":
+        index_cols = [["ingest_id"]]
+    elif table_env == "prod":
+        index_cols = [["table_name", "year"]]
+        for col, props in schema_dict[table_prefix].items():
+            if props.get("indexed", False) and col != "table_name":
+                index_cols.append(["table_name", col])
+    else:
+        raise ValueError(f"Unknown table environment: {table_env}")
+
+    return "\n".join(generate_create_index_sql(table, cols) for cols in index_cols)
+
+
 def generate_select_sql(
         from_table: str,
         cols: list = None,
@@ -259,6 +723,66 @@ def generate_select_sql(
 
     return query
 
+
+def get_table_columns(
+        data_collection: str,
+        schema_dict: dict,
+        sql_types: dict
+)-> list:
+    """
+    Data columns of a staged table, in schema order: table_name and the columns listed in
+    its metadata (sql_types, see read_write.load_column_info). Selecting these instead of
+    all the columns of the wide PROD table skips the columns the table leaves empty.
+    """
+    return ["table_name"] + [c for c in schema_dict[data_collection] if c in sql_types and c != "table_name"]
+
+
+def quote_identifier(name: str)-> str:
+    """
+    Quote a column name for the SQL of queries (some schema columns, e.g. group, are
+    keywords). Double quotes are used, as queries also run on DuckDB, where [name] is a list.
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def generate_aggregate_sql(
+        from_table: str,
+        group_by: list,
+        agg_func: str,
+        where: str = None
+)-> str:
+    """
+    Generate a GROUP BY query aggregating the value column over the group_by dimensions.
+    The aggregate is returned as `value`, groups are ordered by the group_by columns.
+    Args:
+        from_table: the source table
+        group_by: list of columns to group by. If empty, the whole selection is aggregated
+        agg_func: SQL aggregate function (see settings.AGG_SQL)
+        where: explicit WHERE clause
+
+    Returns:
+        the SQL query as a string
+
+    """
+    group_cols = [quote_identifier(c) for c in group_by]
+    select_block = ", ".join(group_cols + [f"{agg_func}(value) AS value"])
+    where_clause = f"WHERE \n\t{where}" if where is not None else ""
+    group_by_clause = "GROUP BY " + ", ".join(group_cols) if group_cols else ""
+    order_by_clause = "ORDER BY " + ", ".join(group_cols) if group_cols else ""
+
+    query = f"""
+        SELECT
+            {select_block}
+        FROM
+            {from_table}
+        {where_clause}
+        {group_by_clause}
+        {order_by_clause};
+    """
+
+    return query
+
+
 def to_nested(d: dict)-> dict:
     """
     Converts a dictionary in flat format {k : v,...} to a nested disct of the form {k : {"eq" : v}}
@@ -3,22 +3,32 @@ from typing import Union
 import logging
 import queens.core.read_write as rw
 from ..core import utils as u
+from .. import settings as s
 
 
 def initialize(
         db_path: Union[str, Path],
-        schema: dict
+        schema: dict,
+        dictionary_encoding: bool = None
 ) -> bool:
     """
     Idempotent DB bootstrap. Returns True if any table was created.
+    RAW tables created with dictionary_encoding (default: settings.DICTIONARY_ENCODING) store
+    dimension strings as integer codes into {collection}_dim, and are read back through
+    the {collection}_raw_decoded view. The layout of existing RAW tables is never changed.
     """
+    if dictionary_encoding is None:
+        dictionary_encoding = s.DICTIONARY_ENCODING
+
     created_any = False
     Path(db_path).parent.mkdir(parents=True, exist_ok=True)
 
     # ingest log (sentinel)
     if not rw.table_exists("_ingest_log", db_path):
         logging.info("Creating _ingest_log.")
-        rw.execute_sql(conn_path=db_path, sql=u.generate_create_log_sql())
+        # only effective on a new DB: lets `maintain` reclaim space incrementally
+        sql = "PRAGMA auto_vacuum = INCREMENTAL;" + u.generate_create_log_sql()
+        rw.execute_sql(conn_path=db_path, sql=sql)
         created_any = True
 
     # metadata
@@ -27,23 +37,71 @@ def initialize(
         rw.execute_sql(conn_path=db_path, sql=u.generate_create_metadata_sql())
         created_any = True
 
+    # named snapshots registry
+    if not rw.table_exists("_snapshots", db_path):
+        logging.info("Creating snapshot registry.")
+        rw.execute_sql(conn_path=db_path, sql=u.generate_create_snapshot_registry_sql())
+        created_any = True
+
+    # DB state (snapshot version token)
+    if not rw.table_exists("_state", db_path):
+        logging.info("Creating _state.")
+        rw.execute_sql(conn_path=db_path, sql=u.generate_create_state_sql())
+        created_any = True
+
     # raw tables per collection
     for data_collection in schema:
         raw = f"{data_collection}_raw"
         if not rw.table_exists(raw, db_path):
             logging.info(f"Creating {raw}.")
             sql = u.generate_create_table_sql(
-                table_prefix=data_collection, table_env="raw", schema_dict=schema
+                table_prefix=data_collection, table_env="raw", schema_dict=schema,
+                encoded=dictionary_encoding
             )
+            if dictionary_encoding:
+                logging.info(f"Using dictionary-encoded layout for {raw}.")
+                sql = (u.generate_create_dim_sql(data_collection)
+                       + sql
+                       + u.generate_decoded_view_sql(data_collection, schema))
             rw.execute_sql(conn_path=db_path, sql=sql)
             created_any = True
 
     if not created_any:
         logging.debug("All tables already exist. Skipping initialization.")
 
+    # history views (all versions) used by as-of queries. Also created on existing DBs
+    for data_collection in schema:
+        rw.execute_sql(conn_path=db_path,
+                       sql=u.generate_history_view_sql(data_collection, schema,
+                                                       encoded=rw.is_encoded(data_collection, db_path)))
+
+    # indexes are (re)created idempotently, which also migrates existing DBs
+    ensure_indexes(db_path, schema)
+
     return created_any
 
 
+def ensure_indexes(
+        db_path: Union[str, Path],
+        schema: dict
+) -> None:
+    """
+    Create the index set on the log, raw and (if staged) prod tables.
+    Idempotent: existing indexes are left untouched.
+    """
+    logging.debug("Ensuring indexes on _ingest_log.")
+    sql = [u.generate_index_set_sql(table_prefix=None, table_env="log", schema_dict=schema)]
+
+    for data_collection in schema:
+        logging.debug(f"Ensuring indexes for {data_collection}.")
+        sql.append(u.generate_index_set_sql(data_collection, "raw", schema))
+
+        if is_staged(db_path, data_collection):
+            sql.append(u.generate_index_set_sql(data_collection, "prod", schema))
+
+    rw.execute_sql(conn_path=db_path, sql="\n".join(sql))
+
+
 def is_staged(
         db_path: Union[str, Path],
         data_collection: str
@@ -52,4 +110,42 @@ def is_staged(
     Returns True if prod exists .
     """
     prod = f"{data_collection}_prod"
-    return rw.table_exists(prod, db_path)
\ No newline at end of file
+    return rw.table_exists(prod, db_path)
+
+
+def verify_read_only(
+        db_path: Union[str, Path],
+        schema: dict
+) -> list:
+    """
+    Check that a DB can be served in read-only (immutable) mode: the file exists, has no
+    pending WAL content (an immutable connection would not see it), and every staged
+    collection has its prod index set. Raises RuntimeError otherwise.
+
+    Returns:
+        the list of staged data collections
+    """
+    db_path = Path(db_path)
+    if not db_path.is_file():
+        raise RuntimeError(f"Database {db_path} does not exist.")
+
+    wal_path = Path(f"{db_path}-wal")
+    if wal_path.exists() and wal_path.stat().st_size > 0:
+        raise RuntimeError(f"Database {db_path} has uncheckpointed WAL content. "
+                           f"Run `queens maintain` before serving it read-only.")
+
+    staged = [c for c in schema if is_staged(db_path, c)]
+    if not staged:
+        raise RuntimeError("No data collection staged. Run `queens stage <collection>` before proceeding")
+
+    indexes = set(rw.read_sql_as_frame(
+        conn_path=db_path,
+        query=u.generate_select_sql(from_table="sqlite_master", cols=["name"], where="type = 'index'")
+    )["name"])
+    for data_collection in staged:
+        index_name = f"idx_{data_collection}_prod_table_name_year"
+        if index_name not in indexes:
+            raise RuntimeError(f"{data_collection}_prod is not indexed. Initialise or restage the DB "
+                               f"without read-only mode before serving it.")
+
+    return staged
@@ -5,6 +5,8 @@ from ..etl import transformations as tr
 from .. import settings as s
 import logging
 import datetime
+import sqlite3
+from contextlib import closing
 import pandas as pd
 from numpy import isnan
 
@@ -12,15 +14,19 @@ from numpy import isnan
 def ingest_tables(
         data_collection: str,
         table_list: list,
-        ingest_ts: str = None
+        ingest_ts: str = None,
+        conn: sqlite3.Connection = None
 ):
     """
     Reads, processes and writes a selection of tables, fetching new data from source URLs.
+    All writes go through a single run connection; each table is committed through its own
+    savepoint so that a failure only rolls back the rows and log entries of that table.
 
     Args:
         data_collection: name of the parent data collection for the tables (e.g. 'dukes')
         table_list: a list or iterable of tables to be parsed and ingested (e.g. ['1.1', 'J.1']
         ingest_ts: Optional ISO timestamp string. Automatically set to now if None is passed.
+        conn: optional run connection (see read_write.connect_writer). Opened and closed here if None.
 
     Returns:
         None
@@ -30,6 +36,14 @@ def ingest_tables(
     if ingest_ts is None:
         ingest_ts = datetime.datetime.now().isoformat()
 
+    # one connection per run
+    if conn is None:
+        with closing(rw.connect_writer(s.DB_PATH)) as run_conn:
+            return ingest_tables(data_collection=data_collection,
+                                 table_list=table_list,
+                                 ingest_ts=ingest_ts,
+                                 conn=run_conn)
+
     try:        # this is run only after initialization so all tables exist
         # and we can process data safely
         for table in table_list:
@@ -62,29 +76,31 @@ def ingest_tables(
             logging.debug(f"Calling function {f_name}")
             res = u.call_func(func=f_call, args_dict=f_args)
 
-            # placeholder for the time being: return results
-            for table_sheet in res:
-                logging.info(f"Ingesting subtable {table_sheet}.")
-                df = vld.validate_schema(
-                    data_collection=data_collection,
-                    table_name=table_sheet,
-                    df=res[table_sheet],
-                    schema_dict=s.SCHEMA)
-
-                # write into raw table
-                logging.debug(f"Ingesting table {table_sheet}")
-                to_table = data_collection + "_raw"
-                ingest_id = rw.ingest_frame(
-                    df=df,
-                    table_name=table_sheet,
-                    to_table=to_table,
-                    data_collection=data_collection,
-                    url=f_args["url"],
-                    table_descr=config["table_description"],
-                    conn_path=s.DB_PATH,
-                    ingest_ts=ingest_ts
-                )
-                logging.debug(f"Sheet {table_sheet} ingested successfully with id {ingest_id}")
+            # all sheets of the table are committed together
+            with rw.savepoint(conn, "ingest_table"):
+                for table_sheet in res:
+                    logging.info(f"Ingesting subtable {table_sheet}.")
+                    df = vld.validate_schema(
+                        data_collection=data_collection,
+                        table_name=table_sheet,
+                        df=res[table_sheet],
+                        schema_dict=s.SCHEMA)
+
+                    # write into raw table
+                    logging.debug(f"Ingesting table {table_sheet}")
+                    to_table = data_collection + "_raw"
+                    ingest_id = rw.ingest_frame(
+                        df=df,
+                        table_name=table_sheet,
+                        to_table=to_table,
+                        data_collection=data_collection,
+                        url=f_args["url"],
+                        table_descr=config["table_description"],
+                        conn_path=s.DB_PATH,
+                        ingest_ts=ingest_ts,
+                        conn=conn
+                    )
+                    logging.debug(f"Sheet {table_sheet} ingested successfully with id {ingest_id}")
             logging.info(f"ETL successful for table {table}")
 
     except Exception as e:
@@ -117,16 +133,18 @@ def ingest_all_tables(data_collection: str):
         logging.info(f"Processing all tables for {data_collection}.")
         config = s.ETL_CONFIG[data_collection]
 
-        # go through each chapter and table
-        for chapter_key in config.keys():
-            logging.info(f"Processing {chapter_key.replace('_', ' ')}.")
+        # go through each chapter and table, sharing one connection for the whole run
+        with closing(rw.connect_writer(s.DB_PATH)) as conn:
+            for chapter_key in config.keys():
+                logging.info(f"Processing {chapter_key.replace('_', ' ')}.")
 
-            # execute
-            table_list = config[chapter_key].keys()
+                # execute
+                table_list = config[chapter_key].keys()
 
-            ingest_tables(data_collection=data_collection,
-                          table_list=table_list,
-                          ingest_ts=ingest_ts)
+                ingest_tables(data_collection=data_collection,
+                              table_list=table_list,
+                              ingest_ts=ingest_ts,
+                              conn=conn)
 
     except Exception as e:
         logging.error(f"ERROR: {e}")
@@ -138,63 +156,194 @@ def ingest_all_tables(data_collection: str):
 
 def stage_data(
         data_collection: str,
-        as_of_date: str = None
+        as_of_date: str = None,
+        incremental: bool = False,
+        mirror: bool = None,
+        name: str = None
 ):
     """
     Select the most recent version of the data and move to production table.
     Optionally, the user can select older versions of the data.
+    In incremental mode, only tables whose selected version differs from the one currently
+    staged are rewritten, and metadata is recomputed for those tables only.
     Args:
         data_collection: the data collection to stage into production
         as_of_date: optional cutoff for data versioning. Default is today's date. Required format is '%Y-%m-%d'
+        incremental: whether to restage only the tables whose version changed. Default is False (full rebuild)
+        mirror: whether to write a Parquet mirror of the prod table. Default is settings.PARQUET_MIRROR.
+            If False, an existing mirror is removed since it would be stale
+        name: optional snapshot name. If passed, the data is materialised into the named snapshot
+            {data_collection}_snap_{name} (replacing it if it exists) and prod is left untouched
 
     Returns:
         None
 
     """
 
-    if as_of_date is not None:
-        cutoff_date = datetime.datetime.strptime(as_of_date, "%Y-%m-%d")
-    else:
-        cutoff_date = datetime.datetime.now().isoformat()
+    cutoff_date = u.parse_cutoff(as_of_date)
 
     try:
         # check if the data collection exists
         u.check_inputs(data_collection=data_collection,
                        etl_config=s.ETL_CONFIG)
 
+        if name is not None:
+            if incremental or mirror:
+                raise ValueError("Named snapshots are always built in full and have no Parquet mirror.")
+
+            logging.debug(f"Creating snapshot {name} of {data_collection}.")
+            table_list = rw.create_snapshot(
+                conn_path=s.DB_PATH,
+                table_prefix=data_collection,
+                name=name,
+                cutoff=cutoff_date,
+                schema_dict=s.SCHEMA,
+                replace=True
+            )
+            logging.info(f"Snapshot {name} of {data_collection} created with {len(table_list)} table(s) "
+                         f"as of {'today' if as_of_date is None else as_of_date}.")
+            return None
+
         logging.debug(f"Staging {data_collection} data.")
-        rw.raw_to_prod(
+        # data and metadata are published together. Note that the global table number
+        # may have been split into sheets (i.e. 1.3 -> 1.3.A, 1.3.B etc.
+        table_list, removed = rw.raw_to_prod(
             conn_path=s.DB_PATH,
             table_prefix=data_collection,
-            cutoff=cutoff_date
+            cutoff=cutoff_date,
+            schema_dict=s.SCHEMA,
+            incremental=incremental
         )
+        logging.debug(f"Staged {len(table_list)} table(s), removed {len(removed)}.")
+
+        if mirror is None:
+            mirror = s.PARQUET_MIRROR
+        if mirror:
+            logging.info(f"Writing Parquet mirror of {data_collection}_prod.")
+            try:
+                rw.write_parquet_mirror(conn_path=s.DB_PATH,
+                                        data_collection=data_collection,
+                                        schema_dict=s.SCHEMA)
+            except Exception:
+                # never leave a mirror of the previous snapshot behind
+                rw.remove_parquet_mirror(conn_path=s.DB_PATH, data_collection=data_collection)
+                raise
+        elif rw.remove_parquet_mirror(conn_path=s.DB_PATH, data_collection=data_collection):
+            logging.info(f"Removed stale Parquet mirror of {data_collection}_prod.")
+    except Exception as e:
+        logging.error(f"ERROR: staging failed for {data_collection}: \n {e}")
+        raise e
 
-        # get the list of tables staged to prod. Note that the global table number
-        # may have been split into sheets (i.e. 1.3 -> 1.3.A, 1.3.B etc.
-        query = u.generate_select_sql(
-            from_table=f"{data_collection}_prod",
-            cols=["table_name"],
-            distinct=True
-        )
+    date_str = "today" if as_of_date is None else as_of_date
+    mode_str = f" ({len(table_list)} table(s) restaged incrementally)" if incremental else ""
+    logging.info(f"Data for {data_collection} successfully staged in prod{mode_str}. \nThis is a snapshot as of {date_str}")
+    return None
 
-        table_list = rw.read_sql_as_frame(conn_path=s.DB_PATH,
-                                          query=query)["table_name"]
 
-        logging.debug("Updating metadata.")
-        for table_name in table_list:
-            rw.insert_metadata(
-                data_collection=data_collection,
-                table_name=table_name,
+def maintain_db(
+        data_collection: str = None,
+        keep_last: int = None,
+        vacuum: bool = True
+) -> dict:
+    """
+    Apply the retention policy to RAW and the ingest log, then compact the database.
+    Failed ingests and orphaned RAW rows are always removed. With keep_last, only the
+    last N versions of each table are kept, together with the versions used by the
+    staged snapshot.
+
+    Args:
+        data_collection: collection to prune. Default is all collections in the schema
+        keep_last: number of versions to keep per table. If None, successful versions are kept
+        vacuum: whether to run ANALYZE and vacuum after pruning
+
+    Returns:
+        a dictionary with a "pruned" dataframe (one row per data collection) and the
+        number of "bytes_reclaimed"
+
+    """
+    if data_collection is not None:
+        u.check_inputs(data_collection=data_collection,
+                       etl_config=s.ETL_CONFIG)
+        collections = [data_collection]
+    else:
+        collections = list(s.SCHEMA.keys())
+
+    try:
+        summary = {}
+        for collection in collections:
+            # versions used by the staged snapshot and by named snapshots are never pruned
+            protected = rw.get_snapshot_versions(s.DB_PATH, collection)
+            for t, ts in rw.get_staged_versions(s.DB_PATH, collection).items():
+                protected.setdefault(t, set()).add(ts)
+
+            logging.info(f"Pruning {collection} (keep_last={keep_last}).")
+            summary[collection] = rw.prune_versions(
                 conn_path=s.DB_PATH,
+                data_collection=collection,
+                keep_last=keep_last,
+                protected=protected,
                 schema_dict=s.SCHEMA
             )
+
+        bytes_reclaimed = 0
+        if vacuum:
+            logging.info("Compacting database.")
+            bytes_reclaimed = rw.compact_db(s.DB_PATH)
+
     except Exception as e:
-        logging.error(f"ERROR: staging failed for {data_collection}: \n {e}")
+        logging.error(f"ERROR: maintenance failed: \n {e}")
         raise e
 
-    date_str = "today" if as_of_date is None else as_of_date
-    logging.info(f"Data for {data_collection} successfully staged in prod. \nThis is a snapshot as of {date_str}")
-    return None
+    logging.info(f"Maintenance completed. {bytes_reclaimed} bytes reclaimed.")
+
+    df = pd.DataFrame.from_dict(summary, orient="index").rename(columns={
+        "versions_pruned": "Versions pruned",
+        "failed_ingests_removed": "Failed ingests removed",
+        "rows_deleted": "Rows deleted"
+    })
+    df.index.name = "Data collection"
+
+    return {"pruned": df, "bytes_reclaimed": bytes_reclaimed}
+
+
+def get_snapshots(data_collection: str)-> pd.DataFrame:
+    """
+    List the named snapshots of a data collection, with their cutoff, creation time
+    and number of tables.
+
+    Args:
+        data_collection: name of data collection
+
+    Returns:
+        a dataframe with one row per snapshot
+
+    """
+    u.check_inputs(data_collection=data_collection,
+                   etl_config=s.ETL_CONFIG)
+
+    query = """
+        SELECT
+            snap.name AS [Name]
+            ,snap.cutoff AS [Cutoff]
+            ,snap.created_ts AS [Created]
+            ,COUNT(v.table_name) AS [Tables]
+        FROM
+            _snapshots AS snap
+        LEFT JOIN
+            _snapshot_versions AS v
+        ON
+            v.data_collection = snap.data_collection
+            AND v.name = snap.name
+        WHERE
+            snap.data_collection = ?
+        GROUP BY
+            snap.name, snap.cutoff, snap.created_ts
+        ORDER BY
+            snap.name;
+    """
+    return rw.read_sql_as_frame(conn_path=s.DB_PATH,
+                                query=query,
+                                query_params=(data_collection,))
 
 
 def get_metadata(
@@ -389,4 +538,43 @@ def get_data_versions(
     df["Ingest time"] = df["ingest_ts"].dt.time
     df.drop(columns=["ingest_ts"], inplace=True)
 
-    return df
\ No newline at end of file
+    return df
+
+
+def get_data_diff(
+        data_collection: str,
+        from_ts: str,
+        to_ts: str = None,
+        table_name: str = None,
+        detail: bool = False
+)-> pd.DataFrame:
+    """
+    Compare two vintages of a data collection: for each table, the version selected at
+    from_ts is compared with the version selected at to_ts (same rule as staging), cell by
+    cell, keyed on the dimension columns.
+
+    Args:
+        data_collection: The name of the data collection (e.g., "dukes").
+        from_ts: date ('%Y-%m-%d') or ingest timestamp of the old vintage
+        to_ts: date ('%Y-%m-%d') or ingest timestamp of the new vintage. Default is the latest
+        table_name: Optional name of table to compare. Default compares all tables
+        detail: whether to list the changed cells instead of the counts per table
+
+    Returns:
+        pd.DataFrame: the counts of added, removed, changed and unchanged cells per table,
+        or the added, removed and changed cells with their old and new value.
+    """
+    u.check_inputs(data_collection=data_collection,
+                   etl_config=s.ETL_CONFIG,
+                   table_name=table_name)
+
+    from_cutoff = u.parse_cutoff(from_ts)
+    to_cutoff = u.parse_cutoff(to_ts)
+
+    return rw.diff_versions(conn_path=s.DB_PATH,
+                            data_collection=data_collection,
+                            from_cutoff=from_cutoff,
+                            to_cutoff=to_cutoff,
+                            table_name=table_name,
+                            schema_dict=s.SCHEMA,
+                            detail=detail)
@@ -186,7 +186,8 @@ def validate_query_filters(
         table_name: str,
         group: dict,
         conn_path: Union[str, Path],
-        schema_dict: dict
+        schema_dict: dict,
+        column_info: Tuple[dict, dict] = None
 )-> dict:
     """
      - ensures columns exist in schema_dict[data_collection]
@@ -201,6 +202,8 @@ def validate_query_filters(
         group: dictionary of filters. grouped by logical operator and in nested format
         conn_path: the path of the DB file
         schema_dict: schema dictionary of the database
+        column_info: optional (sql_types, cast_map) of the queryable columns. Default is
+            read from _metadata (see read_write.load_column_info)
 
     Returns:
         a dictionary of typed filters
@@ -213,7 +216,9 @@ def validate_query_filters(
         raise KeyError(f"No such column(s) in {data_collection}_prod table: {[invalid_cols]}")
 
     # get columns metadata
-    sql_types, cast_map = rw.load_column_info(conn_path, data_collection, table_name)
+    if column_info is None:
+        column_info = rw.load_column_info(conn_path, data_collection, table_name)
+    sql_types, cast_map = column_info
 
     invalid_cols = [c for c in group if c not in sql_types]
     if invalid_cols:
@@ -247,3 +252,101 @@ def validate_query_filters(
                 raise TypeError(f"Cannot cast value for '{col}' ({op}): {e}")
 
     return group
+
+
+def validate_fields(
+        data_collection: str,
+        table_name: str,
+        fields: list,
+        conn_path: Union[str, Path],
+        schema_dict: dict,
+        column_info: Tuple[dict, dict] = None
+)-> list:
+    """
+    Validate the columns selected by a query:
+    - ensures they exist in schema_dict[data_collection]
+    - ensures they are used by this table_name (metadata). table_name is always selectable
+
+    Args:
+        data_collection: name of parent data collection
+        table_name: number of table within data collection
+        fields: list of columns to select
+        conn_path: the path of the DB file
+        schema_dict: schema dictionary of the database
+        column_info: optional (sql_types, cast_map) of the queryable columns. Default is
+            read from _metadata (see read_write.load_column_info)
+
+    Returns:
+        the list of fields, without duplicates
+
+    """
+    fields = list(dict.fromkeys(fields))
+    invalid_cols = [c for c in fields if c not in schema_dict[data_collection]]
+    if invalid_cols:
+        logging.error(f"Column(s) {invalid_cols} do not exist in {data_collection}_prod.")
+        raise KeyError(f"No such column(s) in {data_collection}_prod table: {invalid_cols}")
+
+    # get columns metadata
+    if column_info is None:
+        column_info = rw.load_column_info(conn_path, data_collection, table_name)
+    sql_types = column_info[0]
+
+    invalid_cols = [c for c in fields if c not in sql_types and c != "table_name"]
+    if invalid_cols:
+        raise NameError(f"Column(s) {invalid_cols} cannot be selected in {table_name}. "
+                        f"Options are {['table_name'] + list(sql_types)}")
+
+    return fields
+
+
+def validate_aggregate(
+        data_collection: str,
+        table_name: str,
+        group_by: list,
+        agg: str,
+        conn_path: Union[str, Path],
+        schema_dict: dict,
+        column_info: Tuple[dict, dict] = None
+)-> list:
+    """
+    Validate the grouping of an aggregate query:
+    - ensures the aggregate function is supported (settings.AGG_SQL)
+    - ensures group_by columns exist in schema_dict[data_collection]
+    - ensures they are queryable for this table_name (metadata) and are not the value column
+
+    Args:
+        data_collection: name of parent data collection
+        table_name: number of table within data collection
+        group_by: list of dimension columns to group by
+        agg: name of the aggregate function (sum, avg, min, max, count)
+        conn_path: the path of the DB file
+        schema_dict: schema dictionary of the database
+        column_info: optional (sql_types, cast_map) of the queryable columns. Default is
+            read from _metadata (see read_write.load_column_info)
+
+    Returns:
+        the list of group_by columns, without duplicates
+
+    """
+    if agg not in s.AGG_SQL:
+        raise ValueError(f"Unsupported aggregate function '{agg}'. Options are {list(s.AGG_SQL)}")
+
+    group_by = list(dict.fromkeys(group_by or []))
+    invalid_cols = [c for c in group_by if c not in schema_dict[data_collection]]
+    if invalid_cols:
+        logging.error(f"Column(s) {invalid_cols} do not exist in {data_collection}_prod.")
+        raise KeyError(f"No such column(s) in {data_collection}_prod table: {invalid_cols}")
+
+    if "value" in group_by:
+        raise ValueError("Cannot group by the aggregated column 'value'.")
+
+    # get columns metadata
+    if column_info is None:
+        column_info = rw.load_column_info(conn_path, data_collection, table_name)
+    sql_types = column_info[0]
+
+    invalid_cols = [c for c in group_by if c not in sql_types]
+    if invalid_cols:
+        raise NameError(f"Column(s) {invalid_cols} cannot be grouped in {table_name}.")
+
+    return group_by
@@ -1,6 +1,7 @@
 import os
 from typing import Optional, List, Dict, Any, Union
 import pandas as pd
+import pyarrow as pa
 from pathlib import Path
 
 from . import settings as s
@@ -11,10 +12,14 @@ from .etl.process import (
     stage_data as _stage_data,
     get_data_info as _get_data_info,
     get_data_versions as _get_data_versions,
+    maintain_db as _maintain_db,
+    get_snapshots as _get_snapshots,
+    get_data_diff as _get_data_diff,
 )
 from .etl import validation as vld
 from .core import read_write as rw
 from .core import utils as u
+from .core import engines as eng
 
 # public API (import these in notebooks/code) ----------
 
@@ -46,7 +51,10 @@ def ingest(
 
 def stage(
         data_collection: str,
-        as_of_date: Optional[str] = None
+        as_of_date: Optional[str] = None,
+        incremental: bool = False,
+        mirror: Optional[bool] = None,
+        name: Optional[str] = None
 ) -> None:
     """
     Move most recent (or cutoff) data from RAW to PROD and refresh metadata.
@@ -54,13 +62,19 @@ def stage(
     Args:
         data_collection: the name of the data collection to stage
         as_of_date: cutoff date to which a snapshot should be stage. Format is "%Y-%mm-%dd"
+        incremental: if True, only tables whose selected version changed are restaged
+        mirror: whether to write a Parquet mirror of PROD (default: settings.PARQUET_MIRROR)
+        name: if passed, materialise a named snapshot {data_collection}_snap_{name} instead of PROD
     """
     # initialise DB
     initialize(s.DB_PATH, s.SCHEMA)
 
     # stage
     _stage_data(data_collection=data_collection,
-                as_of_date=as_of_date)
+                as_of_date=as_of_date,
+                incremental=incremental,
+                mirror=mirror,
+                name=name)
 
 
 def info(
@@ -85,6 +99,37 @@ def versions(data_collection: str, table_name: Optional[str] = None) -> pd.DataF
     return _get_data_versions(data_collection=data_collection, table_name=table_name)
 
 
+def diff(
+        data_collection: str,
+        table_name: Optional[str],
+        from_ts: str,
+        to_ts: Optional[str] = None,
+        detail: bool = False
+) -> pd.DataFrame:
+    """
+    Compare two vintages of a data collection in SQL, keyed on the dimension columns.
+
+    Args:
+        data_collection: name of the data collection
+        table_name: table to compare. If None, compares all tables
+        from_ts: date ('YYYY-MM-DD') or ingest timestamp of the old vintage
+        to_ts: date or ingest timestamp of the new vintage. Default is the latest
+        detail: if True, return the added, removed and changed cells instead of the counts per table
+
+    Returns:
+        a dataframe with the counts of added, removed, changed and unchanged cells per table,
+        or one row per changed cell with its old and new value
+    """
+    # initialise DB
+    initialize(s.DB_PATH, s.SCHEMA)
+
+    return _get_data_diff(data_collection=data_collection,
+                          from_ts=from_ts,
+                          to_ts=to_ts,
+                          table_name=table_name,
+                          detail=detail)
+
+
 def metadata(data_collection: str, table_name: str) -> pd.DataFrame:
     """
     Return queryable columns and inferred dtypes for the staged table.
@@ -109,30 +154,55 @@ def metadata(data_collection: str, table_name: str) -> pd.DataFrame:
         )
 
 
-def query(
-    data_collection: str,
-    table_name: str,
-    filters: Optional[Dict[str, Any]] = None
-) -> pd.DataFrame:
+def _resolve_query(
+        data_collection: str,
+        table_name: str,
+        filters: Optional[Dict[str, Any]],
+        as_of: Optional[str],
+        snapshot: Optional[str]
+) -> dict:
     """
-    Return a DataFrame directly from the PROD table,
-    using the same validation rules as the API (flat or nested filters are fine).
+    Validate a query on the staged data (or a named snapshot, or the version current at as_of)
+    and resolve it into its source table and WHERE clause.
 
+    Returns:
+        a dictionary with from_table, column_info, the validated filter groups (base, ors),
+        where_sql, params and columns (the columns of the table listed in its metadata,
+        or None for as_of reads, which have no metadata)
     """
     # validate collection + table existence
     u.check_inputs(data_collection=data_collection, table_name=table_name, etl_config=s.ETL_CONFIG)
 
+    from_table = f"{data_collection}_prod"
+    column_info = None
+    if snapshot is not None:
+        if snapshot not in rw.get_snapshots(s.DB_PATH, data_collection):
+            raise KeyError(f"No snapshot '{snapshot}' for {data_collection}. "
+                           f"Run queens.stage('{data_collection}', name='{snapshot}') first.")
+        from_table = rw.snapshot_table(data_collection, snapshot)
+        column_info = rw.load_column_info(s.DB_PATH, data_collection, table_name, snapshot=snapshot)
+
+    elif as_of is not None:
+        # RAW versions have no metadata: columns are validated against the schema
+        from_table = f"{data_collection}_history"
+        column_info = rw.schema_column_info(data_collection, s.SCHEMA)
+
     # check if data is staged
-    if not is_staged(s.DB_PATH, data_collection):
+    elif not is_staged(s.DB_PATH, data_collection):
         raise RuntimeError(
             f"Data collection '{data_collection}' is not staged. "
             f"Run queens.stage('{data_collection}') first."
         )
 
+    else:
+        # read the metadata once for all the filter groups and the projection
+        column_info = rw.load_column_info(s.DB_PATH, data_collection, table_name)
+
     filters = filters or {}
     base_raw, or_raw = vld.normalize_filters(filters)
-    base = vld.validate_query_filters(data_collection, table_name, base_raw, s.DB_PATH, s.SCHEMA)
-    ors = [vld.validate_query_filters(data_collection, table_name, g, s.DB_PATH, s.SCHEMA) for g in or_raw]
+    base = vld.validate_query_filters(data_collection, table_name, base_raw, s.DB_PATH, s.SCHEMA, column_info)
+    ors = [vld.validate_query_filters(data_collection, table_name, g, s.DB_PATH, s.SCHEMA, column_info)
+           for g in or_raw]
 
     # ensure mandatory table_name filter
     base["table_name"] = {"eq": table_name}
@@ -140,36 +210,210 @@ def query(
     # build where
     where_sql, params = u.build_where_clause(base, ors, s.OP_SQL, s.SCHEMA[data_collection])
 
+    if as_of is not None:
+        where_sql = u.generate_as_of_where(where_sql)
+        params = [data_collection, table_name, u.parse_cutoff(as_of)] + params
+
+    columns = None
+    if as_of is None:
+        columns = ["table_description"] + u.get_table_columns(data_collection, s.SCHEMA, column_info[0])
+
+    return {"from_table": from_table,
+            "columns": columns,
+            "column_info": column_info,
+            "base": base,
+            "ors": ors,
+            "where_sql": where_sql,
+            "params": params}
+
+
+def query(
+    data_collection: str,
+    table_name: str,
+    filters: Optional[Dict[str, Any]] = None,
+    engine: Optional[str] = None,
+    as_arrow: bool = False,
+    as_of: Optional[str] = None,
+    snapshot: Optional[str] = None,
+    fields: Union[List[str], str, None] = None
+) -> Union[pd.DataFrame, pa.Table]:
+    """
+    Return a DataFrame directly from the PROD table,
+    using the same validation rules as the API (flat or nested filters are fine).
+    With engine="duckdb" (default: settings.QUERY_ENGINE) the same SQL runs on DuckDB over the
+    attached SQLite file; engine="parquet" reads the Parquet mirror written by stage(..., mirror=True).
+    With as_arrow=True a pyarrow Table is returned instead of a DataFrame.
+    With as_of="YYYY-MM-DD", the version of the table that was current at that date is read from
+    RAW (same rule as stage(as_of_date=...)), leaving the staged snapshot untouched.
+    With snapshot="name", the named snapshot created by stage(..., name="name") is queried instead of PROD.
+    Only the columns listed in the table metadata are selected, so the columns of the wide PROD table
+    that the table leaves empty are never read. With fields=["year", "fuel", "value"], only those
+    columns are read (validated against the table metadata).
+
+    """
+    if as_of is not None and snapshot is not None:
+        raise ValueError("Pass either as_of or snapshot, not both.")
+    if snapshot is not None and engine is not None and engine.lower() == "parquet":
+        raise ValueError("Named snapshots have no Parquet mirror: use the sqlite or duckdb engine.")
+
+    if as_of is not None:
+        # versions are resolved on the SQLite log and RAW tables
+        if engine is not None and engine.lower() != "sqlite":
+            raise ValueError("as_of queries read RAW and are only supported by the sqlite engine.")
+        engine = "sqlite"
+    engine = eng.check_engine(engine)
+
+    if snapshot is not None and engine == "parquet":
+        engine = "sqlite"
+
+    src = _resolve_query(data_collection, table_name, filters, as_of, snapshot)
+    base, ors = src["base"], src["ors"]
+
+    if isinstance(fields, str):
+        fields = [fields]
+    if fields:
+        fields = vld.validate_fields(data_collection, table_name, fields, s.DB_PATH, s.SCHEMA, src["column_info"])
+
+    # projection: requested fields, or the columns in the metadata. as_of reads (no metadata)
+    # select all the columns and drop the empty ones afterwards
+    columns = fields or src["columns"]
+
+    if engine == "parquet":
+        table = eng.read_parquet_mirror(s.DB_PATH, data_collection, base, ors, s.SCHEMA[data_collection],
+                                        columns=columns)
+        return table if as_arrow else table.to_pandas()
+
     # select
+    where_sql, params = src["where_sql"], src["params"]
     q = u.generate_select_sql(
-        from_table=f"{data_collection}_prod",
+        from_table=src["from_table"],
+        cols=[u.quote_identifier(c) for c in columns] if columns else None,
         where=where_sql,
         order_by=None,            # caller can reorder after
         limit=False               # use OFFSET/LIMIT directly below
     )
 
+    if engine == "duckdb":
+        table = eng.read_sql_as_arrow(
+            conn_path=s.DB_PATH,
+            query=q,
+            query_params=tuple(params)
+        )
+        return table if as_arrow else table.to_pandas()
+
     df = rw.read_sql_as_frame(
         conn_path=s.DB_PATH,
         query=q,
         query_params=tuple(params)
     )
 
-    if df is None or df.empty:
-        return pd.DataFrame()
+    if columns is None:
+        if df is None or df.empty:
+            return pa.table({}) if as_arrow else pd.DataFrame()
+
+        # drop service and empty columns
+        df.drop(columns=["ingest_id", "ingest_ts", "raw_rowid"], inplace=True, errors="ignore")
+        df.dropna(axis=1, how="all", inplace=True)
 
-    # drop service columns
-    df.drop(columns=["ingest_id", "ingest_ts"], inplace=True, errors="ignore")
-    df.dropna(axis=1, how="all", inplace=True)
+    if as_arrow:
+        return pa.Table.from_pandas(df, preserve_index=False)
 
     return df
 
 
+def aggregate(
+    data_collection: str,
+    table_name: str,
+    group_by: Union[List[str], str, None] = None,
+    agg: str = "sum",
+    filters: Optional[Dict[str, Any]] = None,
+    engine: Optional[str] = None,
+    as_of: Optional[str] = None,
+    snapshot: Optional[str] = None
+) -> pd.DataFrame:
+    """
+    Aggregate the value column of a staged table in SQL, grouped by one or more dimensions
+    (e.g. the total of each fuel by year), instead of reading the whole table with query().
+
+    Args:
+        data_collection: name of the data collection
+        table_name: table to aggregate
+        group_by: dimension column(s) to group by (e.g. ["year", "fuel"]). If None, the whole
+            selection is aggregated into one row
+        agg: aggregate function: sum (default), avg, min, max or count (of non-null values)
+        filters: same filters as query(), applied before grouping
+        engine: sqlite or duckdb (default: settings.QUERY_ENGINE). The Parquet mirror is not
+            aggregated: the parquet engine runs on sqlite
+        as_of: aggregate the version of the table that was current at this date (see query())
+        snapshot: aggregate a named snapshot instead of PROD
+
+    Returns:
+        a dataframe with the group_by columns and the aggregate as `value`, ordered by group
+
+    """
+    if as_of is not None and snapshot is not None:
+        raise ValueError("Pass either as_of or snapshot, not both.")
+
+    if isinstance(group_by, str):
+        group_by = [group_by]
+
+    engine = eng.check_engine(engine)
+    if engine == "parquet" or as_of is not None:
+        engine = "sqlite"
+
+    src = _resolve_query(data_collection, table_name, filters, as_of, snapshot)
+    group_by = vld.validate_aggregate(data_collection, table_name, group_by, agg,
+                                      s.DB_PATH, s.SCHEMA, src["column_info"])
+
+    q = u.generate_aggregate_sql(
+        from_table=src["from_table"],
+        group_by=group_by,
+        agg_func=s.AGG_SQL[agg],
+        where=src["where_sql"]
+    )
+
+    if engine == "duckdb":
+        return eng.read_sql_as_arrow(s.DB_PATH, q, tuple(src["params"])).to_pandas()
+
+    return rw.read_sql_as_frame(
+        conn_path=s.DB_PATH,
+        query=q,
+        query_params=tuple(src["params"])
+    )
+
+
+def maintain(
+        data_collection: Optional[str] = None,
+        keep_last: Optional[int] = None,
+        vacuum: bool = True
+) -> dict:
+    """
+    Prune old versions and failed ingests, then compact the database.
+    Versions used by the staged snapshot are always kept.
+
+    Args:
+        data_collection: collection to prune. Default is all collections
+        keep_last: number of versions to keep per table. If None, only failed ingests are removed
+        vacuum: whether to run ANALYZE and an incremental VACUUM afterwards
+
+    Returns:
+        a dictionary with a "pruned" summary dataframe and the number of "bytes_reclaimed"
+    """
+    # initialise DB
+    initialize(s.DB_PATH, s.SCHEMA)
+
+    return _maintain_db(data_collection=data_collection,
+                        keep_last=keep_last,
+                        vacuum=vacuum)
+
+
 def export(
     data_collection: str,
     table_name: Optional[str] = None,
     file_type: str = "csv",
     output_path: Union[str, Path] = None,
     bulk_export: bool = False,
+    snapshot: Optional[str] = None,
 ) -> None:
     """
     Export staged data to disk using your existing core.read_write helpers.
@@ -183,10 +427,15 @@ def export(
         output_path: optional custom destination path. Default directory is stored in config file
         bulk_export: if True, exports the whole data_collection as a single file.
             If file_type='xlsx' is passed, each table is saved to a separate sheet in the same workbook
+        snapshot: optional named snapshot to export instead of the staged data
 
     """
+    if snapshot is not None:
+        if snapshot not in rw.get_snapshots(s.DB_PATH, data_collection):
+            raise KeyError(f"No snapshot '{snapshot}' for {data_collection}.")
+
     # require staging (same rule as CLI)
-    if not is_staged(db_path=s.DB_PATH, data_collection=data_collection):
+    elif not is_staged(db_path=s.DB_PATH, data_collection=data_collection):
         raise RuntimeError(
             f"Data collection '{data_collection}' is not staged. "
             f"Run queens.stage('{data_collection}') first."
@@ -200,12 +449,29 @@ def export(
             data_collection=data_collection,
             file_type=file_type,
             output_path=out_dir,
-            table_name=table_name
+            table_name=table_name,
+            snapshot=snapshot
         )
     else:
         rw.export_all(
             data_collection=data_collection,
             file_type=file_type,
             output_path=out_dir,
-            bulk_export=bulk_export
+            bulk_export=bulk_export,
+            snapshot=snapshot
         )
+
+
+def snapshots(data_collection: str) -> pd.DataFrame:
+    """
+    List the named snapshots of a data collection, with their cutoff and number of tables.
+    """
+    return _get_snapshots(data_collection)
+
+
+def drop_snapshot(data_collection: str, name: str) -> None:
+    """
+    Drop a named snapshot and remove it from the registry. Versions it pinned
+    can then be pruned by maintain().
+    """
+    rw.drop_snapshot(s.DB_PATH, data_collection, name)
@@ -8,6 +8,7 @@ QUEENS settings
 - Logs are always in the user data dir.
 """
 
+import os
 import json
 import shutil
 import configparser
@@ -78,6 +79,25 @@ OP_SQL = {
     "like": "LIKE ?",
 }
 
+# aggregate functions accepted by aggregate queries, applied to the value column
+AGG_SQL = {
+    "sum": "SUM",
+    "avg": "AVG",
+    "min": "MIN",
+    "max": "MAX",
+    "count": "COUNT",
+}
+
+# accepted values for PRAGMA synchronous on write connections
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+# engines available to run queries on the staged snapshot (duckdb is optional,
+# parquet reads the columnar mirror written on stage)
+QUERY_ENGINES = {"sqlite", "duckdb", "parquet"}
+
+# accepted values for PRAGMA temp_store on read connections
+TEMP_STORE_MODES = {"DEFAULT", "FILE", "MEMORY"}
+
 # ---------------------------------------------------------------------
 # resource helpers
 # ---------------------------------------------------------------------
@@ -136,6 +156,17 @@ if CONFIG_INI.exists():
 _INI_SECTION = "paths"
 _INI_DB_KEY = "db_path"
 _INI_EXPORT_KEY = "export_path"
+_INI_SQLITE_SECTION = "sqlite"
+_INI_SYNCHRONOUS_KEY = "synchronous"
+_INI_DICT_ENCODING_KEY = "dictionary_encoding"
+_INI_CACHE_SIZE_KEY = "cache_size"
+_INI_MMAP_SIZE_KEY = "mmap_size"
+_INI_TEMP_STORE_KEY = "temp_store"
+_INI_QUERY_SECTION = "query"
+_INI_ENGINE_KEY = "engine"
+_INI_MIRROR_KEY = "parquet_mirror"
+_INI_API_SECTION = "api"
+_INI_RESPONSE_CACHE_KEY = "response_cache_size"
 
 
 def _read_db_path_from_ini() -> Optional[Path]:
@@ -150,6 +181,46 @@ def _read_export_path_from_ini() -> Optional[Path]:
     return None
 
 
+def _read_synchronous_from_ini() -> Optional[str]:
+    if _config.has_option(_INI_SQLITE_SECTION, _INI_SYNCHRONOUS_KEY):
+        return _config.get(_INI_SQLITE_SECTION, _INI_SYNCHRONOUS_KEY).upper()
+    return None
+
+
+def _read_dict_encoding_from_ini() -> bool:
+    if _config.has_option(_INI_SQLITE_SECTION, _INI_DICT_ENCODING_KEY):
+        return _config.getboolean(_INI_SQLITE_SECTION, _INI_DICT_ENCODING_KEY)
+    return False
+
+
+def _read_read_pragmas_from_ini() -> dict:
+    pragmas = dict(_DEFAULT_READ_PRAGMAS)
+    for key in (_INI_CACHE_SIZE_KEY, _INI_MMAP_SIZE_KEY):
+        if _config.has_option(_INI_SQLITE_SECTION, key):
+            pragmas[key] = _config.getint(_INI_SQLITE_SECTION, key)
+    if _config.has_option(_INI_SQLITE_SECTION, _INI_TEMP_STORE_KEY):
+        pragmas[_INI_TEMP_STORE_KEY] = _config.get(_INI_SQLITE_SECTION, _INI_TEMP_STORE_KEY).upper()
+    return pragmas
+
+
+def _read_query_engine_from_ini() -> Optional[str]:
+    if _config.has_option(_INI_QUERY_SECTION, _INI_ENGINE_KEY):
+        return _config.get(_INI_QUERY_SECTION, _INI_ENGINE_KEY).lower()
+    return None
+
+
+def _read_parquet_mirror_from_ini() -> bool:
+    if _config.has_option(_INI_QUERY_SECTION, _INI_MIRROR_KEY):
+        return _config.getboolean(_INI_QUERY_SECTION, _INI_MIRROR_KEY)
+    return False
+
+
+def _read_response_cache_size_from_ini() -> Optional[int]:
+    if _config.has_option(_INI_API_SECTION, _INI_RESPONSE_CACHE_KEY):
+        return _config.getint(_INI_API_SECTION, _INI_RESPONSE_CACHE_KEY)
+    return None
+
+
 # ---------------------------------------------------------------------
 # resolve actual paths
 # ---------------------------------------------------------------------
@@ -158,10 +229,55 @@ _DEFAULT_DB_PATH = USER_DIR / "queens.db"
 DB_PATH: Path = _read_db_path_from_ini() or _DEFAULT_DB_PATH
 EXPORT_DIR: Path = _read_export_path_from_ini() or EXPORT_DEFAULT_DIR
 
+# durability of write runs (ingest/stage). NORMAL is safe in WAL mode
+# and avoids an fsync on every commit
+_DEFAULT_SYNCHRONOUS = "NORMAL"
+SQLITE_SYNCHRONOUS: str = _read_synchronous_from_ini() or _DEFAULT_SYNCHRONOUS
+
+# store dimension values of new RAW tables as integer codes into a lookup table
+DICTIONARY_ENCODING: bool = _read_dict_encoding_from_ini()
+
+# pragma profile of the pooled read connections (API, queries). A negative
+# cache_size is in KiB (64 MiB page cache); mmap_size is in bytes (256 MiB)
+_DEFAULT_READ_PRAGMAS = {
+    _INI_CACHE_SIZE_KEY: -65536,
+    _INI_MMAP_SIZE_KEY: 268435456,
+    _INI_TEMP_STORE_KEY: "MEMORY",
+}
+READ_PRAGMAS: dict = _read_read_pragmas_from_ini()
+
+# engine used by queens.query() and the API
+_DEFAULT_QUERY_ENGINE = "sqlite"
+QUERY_ENGINE: str = _read_query_engine_from_ini() or _DEFAULT_QUERY_ENGINE
+
+# write a Parquet mirror of the prod table on stage
+PARQUET_MIRROR: bool = _read_parquet_mirror_from_ini()
+
+# size in bytes of the API response cache (64 MiB). 0 disables it
+_DEFAULT_RESPONSE_CACHE_SIZE = 67108864
+RESPONSE_CACHE_SIZE: int = _read_response_cache_size_from_ini()
+if RESPONSE_CACHE_SIZE is None:
+    RESPONSE_CACHE_SIZE = _DEFAULT_RESPONSE_CACHE_SIZE
+
 # create parent directories if not exist
 DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 EXPORT_DIR.mkdir(parents=True, exist_ok=True)
 
+# serve a published, never-modified DB: read connections are opened as immutable
+# and every write path is refused. Set through the environment (see `queens serve --read-only`)
+# so that it is inherited by the API worker processes
+READ_ONLY_ENV_VAR = "QUEENS_READ_ONLY"
+
+
+def _read_read_only_from_env() -> bool:
+    return os.environ.get(READ_ONLY_ENV_VAR, "").strip().lower() in {"1", "true", "yes", "on"}
+
+
+READ_ONLY: bool = _read_read_only_from_env()
+
+# seconds API workers wait for in-flight requests to complete when shutting down
+SHUTDOWN_TIMEOUT = 30
+
 # ---------------------------------------------------------------------
 # load JSON configs from USER_DIR
 # ---------------------------------------------------------------------
@@ -186,7 +302,9 @@ def reload_settings() -> None:
     Re-read config.ini and JSONs, recompute DB_PATH / EXPORT_DIR.
     Call this after your CLI or programmatic setter changes config.ini.
     """
-    global _config, DB_PATH, EXPORT_DIR, ETL_CONFIG, SCHEMA, TEMPLATES, URLS
+    global _config, DB_PATH, EXPORT_DIR, SQLITE_SYNCHRONOUS, DICTIONARY_ENCODING, \
+        READ_PRAGMAS, READ_ONLY, QUERY_ENGINE, PARQUET_MIRROR, RESPONSE_CACHE_SIZE, \
+        ETL_CONFIG, SCHEMA, TEMPLATES, URLS
 
     _config = configparser.ConfigParser()
     if CONFIG_INI.exists():
@@ -198,6 +316,16 @@ def reload_settings() -> None:
     EXPORT_DIR = _read_export_path_from_ini() or EXPORT_DEFAULT_DIR
     EXPORT_DIR.mkdir(parents=True, exist_ok=True)
 
+    SQLITE_SYNCHRONOUS = _read_synchronous_from_ini() or _DEFAULT_SYNCHRONOUS
+    DICTIONARY_ENCODING = _read_dict_encoding_from_ini()
+    READ_PRAGMAS = _read_read_pragmas_from_ini()
+    READ_ONLY = _read_read_only_from_env()
+    QUERY_ENGINE = _read_query_engine_from_ini() or _DEFAULT_QUERY_ENGINE
+    PARQUET_MIRROR = _read_parquet_mirror_from_ini()
+    RESPONSE_CACHE_SIZE = _read_response_cache_size_from_ini()
+    if RESPONSE_CACHE_SIZE is None:
+        RESPONSE_CACHE_SIZE = _DEFAULT_RESPONSE_CACHE_SIZE
+
     ETL_CONFIG = _load_json("etl_config.json")
     SCHEMA = _load_json("schema.json")
     TEMPLATES = _load_json("templates.json")
@@ -206,11 +334,23 @@ def reload_settings() -> None:
 
 def set_config(
         db_path: str = None,
-        export_path: str = None) -> None:
+        export_path: str = None,
+        synchronous: str = None,
+        dictionary_encoding: bool = None,
+        read_pragmas: dict = None,
+        query_engine: str = None,
+        parquet_mirror: bool = None,
+        response_cache_size: int = None) -> None:
     """
     Persist user defined configurations (same effect as CLI method config).
     - db_path: where the SQLite DB will live
     - export_path: default export folder
+    - synchronous: SQLite synchronous mode for ingest/stage runs (OFF, NORMAL, FULL, EXTRA)
+    - dictionary_encoding: whether RAW tables created from now on store dimensions as integer codes
+    - read_pragmas: pragma profile of read connections, any of cache_size, mmap_size, temp_store
+    - query_engine: engine used by queries (sqlite, duckdb or parquet)
+    - parquet_mirror: whether stage writes a Parquet mirror of the prod table
+    - response_cache_size: size in bytes of the API response cache (0 disables it)
     Both paths are created if missing.
     Applies immediately
     """
@@ -231,6 +371,52 @@ def set_config(
         p.mkdir(parents=True, exist_ok=True)
         cfg[_INI_SECTION][_INI_EXPORT_KEY] = str(p)
 
+    if synchronous:
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"Invalid synchronous mode {synchronous}. Options are {sorted(SYNCHRONOUS_MODES)}")
+        if _INI_SQLITE_SECTION not in cfg:
+            cfg[_INI_SQLITE_SECTION] = {}
+        cfg[_INI_SQLITE_SECTION][_INI_SYNCHRONOUS_KEY] = synchronous
+
+    if dictionary_encoding is not None:
+        if _INI_SQLITE_SECTION not in cfg:
+            cfg[_INI_SQLITE_SECTION] = {}
+        cfg[_INI_SQLITE_SECTION][_INI_DICT_ENCODING_KEY] = str(bool(dictionary_encoding)).lower()
+
+    if read_pragmas:
+        unknown = set(read_pragmas) - set(_DEFAULT_READ_PRAGMAS)
+        if unknown:
+            raise KeyError(f"Invalid read pragma(s) {sorted(unknown)}. Options are {sorted(_DEFAULT_READ_PRAGMAS)}")
+        if _INI_TEMP_STORE_KEY in read_pragmas:
+            temp_store = str(read_pragmas[_INI_TEMP_STORE_KEY]).upper()
+            if temp_store not in TEMP_STORE_MODES:
+                raise ValueError(f"Invalid temp_store {temp_store}. Options are {sorted(TEMP_STORE_MODES)}")
+        if _INI_SQLITE_SECTION not in cfg:
+            cfg[_INI_SQLITE_SECTION] = {}
+        for key, value in read_pragmas.items():
+            cfg[_INI_SQLITE_SECTION][key] = str(value)
+
+    if query_engine:
+        query_engine = query_engine.lower()
+        if query_engine not in QUERY_ENGINES:
+            raise ValueError(f"Invalid query engine {query_engine}. Options are {sorted(QUERY_ENGINES)}")
+        if _INI_QUERY_SECTION not in cfg:
+            cfg[_INI_QUERY_SECTION] = {}
+        cfg[_INI_QUERY_SECTION][_INI_ENGINE_KEY] = query_engine
+
+    if parquet_mirror is not None:
+        if _INI_QUERY_SECTION not in cfg:
+            cfg[_INI_QUERY_SECTION] = {}
+        cfg[_INI_QUERY_SECTION][_INI_MIRROR_KEY] = str(bool(parquet_mirror)).lower()
+
+    if response_cache_size is not None:
+        if int(response_cache_size) < 0:
+            raise ValueError("response_cache_size must be >= 0")
+        if _INI_API_SECTION not in cfg:
+            cfg[_INI_API_SECTION] = {}
+        cfg[_INI_API_SECTION][_INI_RESPONSE_CACHE_KEY] = str(int(response_cache_size))
+
     with open(CONFIG_INI, "w", encoding="utf-8") as f:
         cfg.write(f)
 
@@ -21,6 +21,10 @@ fi
 echo "[startup] Configuring queens paths..."
 queens config --db-path "$DB_PATH"
 
-echo "[startup] Launching API..."
-exec uvicorn queens.api.app:app --host 0.0.0.0 --port "${PORT:-8000}" --log-level debug
+# one-off writable pass: creates missing indexes and checkpoints the WAL
+echo "[startup] Preparing DB..."
+python -c "from queens import settings as s; from queens.etl.bootstrap import initialize; initialize(s.DB_PATH, s.SCHEMA)"
+
+echo "[startup] Launching API (read-only)..."
+exec queens serve --read-only --host 0.0.0.0 --port "${PORT:-8000}" --log-level debug
 
@@ -0,0 +1,68 @@
+import pandas as pd
+import pytest
+
+import queens.core.read_write as rw
+from queens.etl.bootstrap import initialize
+
+
+# shared fixtures ---------------------------------------------------------
+
+SCHEMA = {
+    "dukes": {
+        "ingest_id": {"type": "INTEGER", "nullable": False},
+        "table_name": {"type": "TEXT", "nullable": False},
+        "row": {"type": "INTEGER", "nullable": False},
+        "label": {"type": "TEXT", "nullable": False},
+        "year": {"type": "INTEGER", "nullable": False},
+        "fuel": {"type": "TEXT", "nullable": True},
+        "unit": {"type": "TEXT", "nullable": True},
+        "group": {"type": "TEXT", "nullable": True},
+        "value": {"type": "REAL", "nullable": True},
+    }
+}
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "test.db"
+    initialize(path, SCHEMA)
+    return path
+
+
+def _frame(table_name, years=(2020, 2021), fuels=("Gas", "Coal"), offset=0.0):
+    rows = []
+    for i, fuel in enumerate(fuels):
+        for year in years:
+            rows.append({
+                "table_name": table_name,
+                "row": i,
+                "label": fuel,
+                "year": year,
+                "fuel": fuel,
+                "unit": "ktoe",
+                "value": float(year - 2000 + i) + offset,
+            })
+    return pd.DataFrame(rows)
+
+
+def _ingest(conn_path, table_name, ingest_ts, df=None, conn=None):
+    return rw.ingest_frame(
+        df=_frame(table_name) if df is None else df,
+        to_table="dukes_raw",
+        table_name=table_name,
+        data_collection="dukes",
+        url="https://example.com",
+        table_descr=f"Table {table_name}",
+        conn_path=conn_path,
+        ingest_ts=ingest_ts,
+        conn=conn,
+    )
+
+
+@pytest.fixture
+def staged_settings(monkeypatch, db_path):
+    import queens.settings as s
+    monkeypatch.setattr(s, "DB_PATH", db_path)
+    monkeypatch.setattr(s, "SCHEMA", SCHEMA)
+    monkeypatch.setattr(s, "ETL_CONFIG", {"dukes": {"chapter_1": {"1.1": {}, "1.2": {}}}})
+    return s
@@ -0,0 +1,358 @@
+import sqlite3
+import pandas as pd
+import pytest
+
+import queens.core.read_write as rw
+from queens.etl.bootstrap import initialize
+from conftest import SCHEMA, _frame, _ingest
+
+
+def _count(conn_path, sql, params=()):
+    with sqlite3.connect(conn_path) as conn:
+        return conn.execute(sql, params).fetchone()[0]
+
+
+# ----------------------------
+# ingestion
+# ----------------------------
+
+def test_ingest_frame_standalone_commits(db_path):
+    ingest_id = _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+
+    assert _count(db_path, "SELECT COUNT(*) FROM dukes_raw WHERE ingest_id = ?", (ingest_id,)) == 4
+    assert _count(db_path, "SELECT success FROM _ingest_log WHERE ingest_id = ?", (ingest_id,)) == 1
+
+
+def test_connect_writer_uses_wal(db_path):
+    conn = rw.connect_writer(db_path, synchronous="full")
+    try:
+        assert conn.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous;").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+def test_connect_writer_invalid_synchronous(db_path):
+    with pytest.raises(ValueError):
+        rw.connect_writer(db_path, synchronous="sometimes")
+
+
+def test_failed_table_rolls_back_only_its_own_rows(db_path):
+    conn = rw.connect_writer(db_path)
+    try:
+        with rw.savepoint(conn, "ingest_table"):
+            _ingest(db_path, "1.1", "2024-01-01T00:00:00", conn=conn)
+
+        with pytest.raises(sqlite3.Error):
+            with rw.savepoint(conn, "ingest_table"):
+                _ingest(db_path, "1.2", "2024-01-01T00:00:00", conn=conn)
+                # unknown column -> the whole table is rolled back
+                bad = _frame("1.2").assign(not_a_column=1)
+                _ingest(db_path, "1.2", "2024-01-01T00:00:00", df=bad, conn=conn)
+    finally:
+        conn.close()
+
+    assert _count(db_path, "SELECT COUNT(*) FROM _ingest_log WHERE table_name = '1.1'") == 1
+    assert _count(db_path, "SELECT COUNT(*) FROM _ingest_log WHERE table_name = '1.2'") == 0
+    assert _count(db_path, "SELECT COUNT(*) FROM dukes_raw WHERE table_name = '1.2'") == 0
+
+
+def test_readers_not_blocked_during_write_run(db_path):
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+
+    conn = rw.connect_writer(db_path)
+    try:
+        with rw.savepoint(conn, "ingest_table"):
+            _ingest(db_path, "1.2", "2024-01-01T00:00:00", conn=conn)
+
+            # a separate reader sees the last committed state without waiting
+            with sqlite3.connect(db_path, timeout=0) as reader:
+                n = reader.execute("SELECT COUNT(DISTINCT table_name) FROM dukes_raw").fetchone()[0]
+            assert n == 1
+    finally:
+        conn.close()
+
+
+# ----------------------------
+# indexes
+# ----------------------------
+
+def _index_names(conn_path, table):
+    with sqlite3.connect(conn_path) as conn:
+        rows = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (table,)
+        ).fetchall()
+    return {r[0] for r in rows}
+
+
+def test_initialize_creates_index_set(db_path):
+    assert "idx_dukes_raw_ingest_id" in _index_names(db_path, "dukes_raw")
+    assert "idx_ingest_log_versions" in _index_names(db_path, "_ingest_log")
+
+
+def test_prod_indexes_created_on_stage_and_migrated(db_path):
+    schema = {"dukes": {**SCHEMA["dukes"], "fuel": {"type": "TEXT", "nullable": True, "indexed": True}}}
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    rw.raw_to_prod(db_path, "dukes", "2099-01-01", schema_dict=schema)
+
+    assert {"idx_dukes_prod_table_name_year", "idx_dukes_prod_table_name_fuel"} <= _index_names(db_path, "dukes_prod")
+
+    # existing DB without indexes gets them back from initialize
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("DROP INDEX idx_dukes_prod_table_name_year")
+        conn.execute("DROP INDEX idx_dukes_raw_ingest_id")
+    initialize(db_path, schema)
+
+    assert "idx_dukes_prod_table_name_year" in _index_names(db_path, "dukes_prod")
+    assert "idx_dukes_raw_ingest_id" in _index_names(db_path, "dukes_raw")
+
+
+# ----------------------------
+# staging
+# ----------------------------
+
+def test_raw_to_prod_selects_latest_version_before_cutoff(db_path):
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+
+    staged, removed = rw.raw_to_prod(db_path, "dukes", "2024-03-01T00:00:00", schema_dict=SCHEMA)
+    assert staged == ["1.1"] and removed == []
+    assert _count(db_path, "SELECT MAX(value) FROM dukes_prod") < 100
+
+    rw.raw_to_prod(db_path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA)
+    assert _count(db_path, "SELECT MIN(value) FROM dukes_prod") > 100
+
+
+def test_raw_to_prod_incremental_only_restages_changed_tables(db_path):
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    _ingest(db_path, "1.2", "2024-01-01T00:00:00")
+    rw.raw_to_prod(db_path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA)
+    rowid_12 = _count(db_path, "SELECT MIN(rowid) FROM dukes_prod WHERE table_name = '1.2'")
+
+    # nothing changed
+    assert rw.raw_to_prod(db_path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA, incremental=True) == ([], [])
+
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+    staged, removed = rw.raw_to_prod(db_path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA, incremental=True)
+
+    assert staged == ["1.1"] and removed == []
+    assert _count(db_path, "SELECT MIN(value) FROM dukes_prod WHERE table_name = '1.1'") > 100
+    assert _count(db_path, "SELECT COUNT(*) FROM dukes_prod WHERE table_name = '1.1'") == 4
+    # untouched table keeps its rows
+    assert _count(db_path, "SELECT MIN(rowid) FROM dukes_prod WHERE table_name = '1.2'") == rowid_12
+
+
+def test_raw_to_prod_incremental_removes_tables_without_version(db_path):
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    _ingest(db_path, "1.2", "2024-06-01T00:00:00")
+    rw.raw_to_prod(db_path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA)
+
+    staged, removed = rw.raw_to_prod(db_path, "dukes", "2024-03-01T00:00:00", schema_dict=SCHEMA, incremental=True)
+
+    assert staged == [] and removed == ["1.2"]
+    assert _count(db_path, "SELECT COUNT(*) FROM dukes_prod WHERE table_name = '1.2'") == 0
+
+
+def test_stage_data_incremental_refreshes_metadata(staged_settings, db_path):
+    from queens.etl.process import stage_data
+
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    _ingest(db_path, "1.2", "2024-01-01T00:00:00")
+    stage_data("dukes")
+
+    cols = "SELECT COUNT(*) FROM _metadata WHERE table_name = ?"
+    assert _count(db_path, cols, ("1.1",)) == 6  # row, label, year, fuel, unit, value
+
+    # new version of 1.1 without the unit column
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1").drop(columns="unit"))
+    stage_data("dukes", incremental=True)
+
+    assert _count(db_path, cols, ("1.1",)) == 5
+    assert _count(db_path, cols, ("1.2",)) == 6
+
+
+def test_full_restage_swaps_shadow_without_disturbing_readers(db_path):
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    rw.raw_to_prod(db_path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA)
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+
+    reader = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        # in-flight read transaction keeps the old snapshot
+        reader.execute("BEGIN;")
+        assert reader.execute("SELECT MAX(value) FROM dukes_prod").fetchone()[0] < 100
+
+        rw.raw_to_prod(db_path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA)
+
+        assert reader.execute("SELECT MAX(value) FROM dukes_prod").fetchone()[0] < 100
+        reader.execute("COMMIT;")
+
+        assert reader.execute("SELECT MIN(value) FROM dukes_prod").fetchone()[0] > 100
+    finally:
+        reader.close()
+
+    assert _count(db_path, "SELECT COUNT(*) FROM sqlite_master WHERE name = 'dukes_prod_shadow'") == 0
+    assert _count(db_path, "SELECT COUNT(*) FROM _metadata WHERE table_name = '1.1'") == 6
+
+
+def test_compute_metadata_single_aggregate(db_path):
+    df = _frame("1.1")
+    df.loc[0, "unit"] = None
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00", df=df)
+    _ingest(db_path, "1.2", "2024-01-01T00:00:00", df=_frame("1.2").drop(columns="fuel"))
+    rw.raw_to_prod(db_path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA)
+
+    with sqlite3.connect(db_path) as conn:
+        meta = rw.compute_metadata("dukes", conn, SCHEMA).set_index(["table_name", "column_name"])
+
+    assert meta.loc[("1.1", "unit"), "n_non_nulls"] == 3
+    assert meta.loc[("1.1", "year"), "n_unique"] == 2
+    assert meta.loc[("1.1", "value"), "dtype"] == "REAL"
+    # all-null column is not queryable for 1.2
+    assert ("1.2", "fuel") not in meta.index
+    assert ("1.2", "label") in meta.index
+
+
+# ----------------------------
+# dictionary-encoded layout
+# ----------------------------
+
+def test_encoded_raw_round_trip(tmp_path):
+    plain, encoded = tmp_path / "plain.db", tmp_path / "encoded.db"
+    initialize(plain, SCHEMA, dictionary_encoding=False)
+    initialize(encoded, SCHEMA, dictionary_encoding=True)
+
+    for path in (plain, encoded):
+        _ingest(path, "1.1", "2024-01-01T00:00:00")
+        _ingest(path, "1.2", "2024-01-01T00:00:00", df=_frame("1.2", fuels=("Gas", "Oil")))
+        rw.raw_to_prod(path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA)
+
+    assert not rw.is_encoded("dukes", plain)
+    assert rw.is_encoded("dukes", encoded)
+
+    # dimension values are stored once and referenced by integer codes
+    assert _count(encoded, "SELECT COUNT(*) FROM dukes_dim") == 4  # Gas, Coal, Oil, ktoe
+    assert _count(encoded, "SELECT typeof(fuel) FROM dukes_raw LIMIT 1") == "integer"
+
+    query = "SELECT * FROM dukes_prod ORDER BY table_name, row, year"
+    with sqlite3.connect(plain) as c1, sqlite3.connect(encoded) as c2:
+        pd.testing.assert_frame_equal(pd.read_sql_query(query, c1), pd.read_sql_query(query, c2))
+
+
+# ----------------------------
+# maintenance
+# ----------------------------
+
+def test_prune_versions_keeps_last_and_protected(db_path):
+    for ts in ("2024-01-01T00:00:00", "2024-02-01T00:00:00", "2024-03-01T00:00:00"):
+        _ingest(db_path, "1.1", ts)
+    # failed ingest leftovers
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("INSERT INTO _ingest_log (ingest_ts, data_collection, table_name, success) "
+                     "VALUES ('2024-04-01T00:00:00', 'dukes', '1.1', 0)")
+        conn.execute("INSERT INTO dukes_raw (ingest_id, table_name, row, label, year) "
+                     "VALUES (last_insert_rowid(), '1.1', 0, 'x', 2020)")
+
+    res = rw.prune_versions(db_path, "dukes", keep_last=1,
+                            protected={"1.1": {"2024-01-01T00:00:00"}}, schema_dict=SCHEMA)
+
+    assert res == {"versions_pruned": 1, "failed_ingests_removed": 1, "rows_deleted": 5}
+    with sqlite3.connect(db_path) as conn:
+        kept = [r[0] for r in conn.execute("SELECT ingest_ts FROM _ingest_log ORDER BY ingest_ts")]
+    assert kept == ["2024-01-01T00:00:00", "2024-03-01T00:00:00"]
+
+
+def test_prune_versions_removes_unused_dim_values(tmp_path):
+    path = tmp_path / "encoded.db"
+    initialize(path, SCHEMA, dictionary_encoding=True)
+    _ingest(path, "1.1", "2024-01-01T00:00:00", df=_frame("1.1", fuels=("Gas", "Oil")))
+    # sparse dimension: the kept version has NULL units
+    _ingest(path, "1.1", "2024-02-01T00:00:00", df=_frame("1.1").assign(unit=[None, None, "ktoe", "ktoe"]))
+
+    rw.prune_versions(path, "dukes", keep_last=1, schema_dict=SCHEMA)
+
+    with sqlite3.connect(path) as conn:
+        values = {r[0] for r in conn.execute("SELECT value FROM dukes_dim")}
+    assert values == {"Gas", "Coal", "ktoe"}
+
+
+def test_compact_db_reclaims_space(db_path):
+    for i in range(20):
+        _ingest(db_path, "1.1", f"2024-01-{i + 1:02d}T00:00:00", df=_frame("1.1", years=range(1950, 2024)))
+    rw.prune_versions(db_path, "dukes", keep_last=1, schema_dict=SCHEMA)
+
+    assert rw.compact_db(db_path) > 0
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+# ----------------------------
+# pooled read connections
+# ----------------------------
+
+def test_reader_is_reused_per_thread_and_path(db_path, tmp_path):
+    import threading
+
+    conn = rw.get_reader(db_path)
+    assert rw.get_reader(db_path) is conn
+    assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2
+    assert conn.execute("PRAGMA cache_size").fetchone()[0] == -65536
+
+    # another thread gets its own connection
+    other = []
+    t = threading.Thread(target=lambda: other.append(rw.get_reader(db_path)))
+    t.start()
+    t.join()
+    assert other[0] is not conn
+
+    # a new DB path (e.g. after reload_settings) reopens the connection
+    other_path = tmp_path / "other.db"
+    initialize(other_path, SCHEMA)
+    assert rw.get_reader(other_path) is not conn
+    rw.close_readers()
+
+
+def test_reader_reopens_when_pragmas_change(db_path, monkeypatch):
+    conn = rw.get_reader(db_path)
+    monkeypatch.setattr(rw.s, "READ_PRAGMAS", {"cache_size": -1024, "mmap_size": 0, "temp_store": "FILE"})
+
+    new_conn = rw.get_reader(db_path)
+    assert new_conn is not conn
+    assert new_conn.execute("PRAGMA cache_size").fetchone()[0] == -1024
+    rw.close_readers()
+
+
+# ----------------------------
+# read-only serving
+# ----------------------------
+
+def test_read_only_mode_serves_immutable_and_refuses_writes(db_path, monkeypatch):
+    from queens.etl.bootstrap import verify_read_only
+
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    rw.raw_to_prod(db_path, "dukes", "2099-01-01T00:00:00", schema_dict=SCHEMA)
+    # the last connection to close checkpoints the WAL
+    rw.close_readers()
+
+    monkeypatch.setattr(rw.s, "READ_ONLY", True)
+    assert verify_read_only(db_path, SCHEMA) == ["dukes"]
+
+    conn = rw.get_reader(db_path)
+    assert _count(db_path, "SELECT COUNT(*) FROM dukes_prod") == 4
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("DELETE FROM dukes_prod;")
+    with pytest.raises(RuntimeError):
+        rw.connect_writer(db_path)
+    with pytest.raises(RuntimeError):
+        rw.execute_sql(db_path, "DELETE FROM dukes_prod;")
+    rw.close_readers()
+
+
+def test_verify_read_only_requires_staged_db(db_path, monkeypatch):
+    from queens.etl.bootstrap import verify_read_only
+
+    rw.close_readers()
+    monkeypatch.setattr(rw.s, "READ_ONLY", True)
+    with pytest.raises(RuntimeError, match="No data collection staged"):
+        verify_read_only(db_path, SCHEMA)
+    rw.close_readers()
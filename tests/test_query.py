@@ -0,0 +1,740 @@
+import copy
+import pytest
+import pyarrow as pa
+
+import queens.core.read_write as rw
+from queens import facade
+from queens.core import engines as eng
+from queens.etl.process import stage_data
+from conftest import SCHEMA, _frame, _ingest
+
+
+@pytest.fixture
+def staged(staged_settings, db_path):
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    _ingest(db_path, "1.2", "2024-01-01T00:00:00")
+    stage_data("dukes")
+    return staged_settings
+
+
+# ----------------------------
+# query engines
+# ----------------------------
+
+def test_query_sqlite_as_arrow(staged):
+    df = facade.query("dukes", "1.1", {"fuel": "gas", "year": {"gte": 2021}})
+    table = facade.query("dukes", "1.1", {"fuel": "gas", "year": {"gte": 2021}}, as_arrow=True)
+
+    assert isinstance(table, pa.Table)
+    assert table.to_pandas().equals(df)
+    assert df["year"].tolist() == [2021]
+    assert "ingest_id" not in table.column_names
+
+
+def test_query_rejects_unknown_engine(staged):
+    with pytest.raises(ValueError, match="Invalid query engine"):
+        facade.query("dukes", "1.1", engine="postgres")
+
+
+def test_drop_columns_arrow():
+    table = pa.table({"ingest_id": [1, 1], "fuel": ["Gas", None], "unit": [None, None]})
+    assert eng.drop_columns_arrow(table, ["ingest_id"]).column_names == ["fuel"]
+
+
+def test_query_duckdb_matches_sqlite(staged):
+    pytest.importorskip("duckdb")
+    try:
+        eng.get_duckdb()
+    except Exception as e:
+        pytest.skip(f"DuckDB sqlite extension not available: {e}")
+
+    filters = {"$or": [{"fuel": "gas"}, {"fuel": "COAL"}], "year": {"gt": 2020}}
+    expected = facade.query("dukes", "1.1", copy.deepcopy(filters), engine="sqlite", as_arrow=True)
+    table = facade.query("dukes", "1.1", filters, engine="duckdb", as_arrow=True)
+
+    assert table.num_rows == expected.num_rows == 2
+    assert sorted(table.column_names) == sorted(expected.column_names)
+    eng.close_duckdb()
+
+
+def test_duckdb_sqlite_extension_is_loaded_before_installing():
+    class Error(Exception):
+        pass
+
+    class FakeConn:
+        def __init__(self, installed, online):
+            self.installed, self.online, self.sql, self.closed = installed, online, [], False
+
+        def execute(self, sql):
+            self.sql.append(sql)
+            if sql.startswith("INSTALL"):
+                if not self.online:
+                    raise Error("download failed")
+                self.installed = True
+            elif sql.startswith("LOAD") and not self.installed:
+                raise Error("not installed")
+
+        def close(self):
+            self.closed = True
+
+    duckdb = type("duckdb", (), {"Error": Error})
+
+    conn = FakeConn(installed=True, online=False)
+    eng._load_sqlite_extension(duckdb, conn)
+    assert not any(q.startswith("INSTALL") for q in conn.sql)
+
+    conn = FakeConn(installed=False, online=True)
+    eng._load_sqlite_extension(duckdb, conn)
+    assert conn.sql[-2:] == ["INSTALL sqlite;", "LOAD sqlite;"]
+
+    conn = FakeConn(installed=False, online=False)
+    with pytest.raises(RuntimeError, match="sqlite extension"):
+        eng._load_sqlite_extension(duckdb, conn)
+    assert conn.closed
+
+
+def test_aggregate_sql_runs_on_duckdb(staged, db_path):
+    # dialect check on a native DuckDB copy of PROD: no sqlite extension (network) needed
+    duckdb = pytest.importorskip("duckdb")
+    from queens.core import utils as u
+
+    prod = rw.read_sql_as_frame(db_path, "SELECT * FROM dukes_prod")
+    where, params = u.build_where_clause({"table_name": {"eq": "1.1"}, "fuel": {"eq": "GAS"}}, [],
+                                         staged.OP_SQL, SCHEMA["dukes"])
+    query = u.generate_aggregate_sql("dukes_prod", ["fuel", "year"], "SUM", where)
+
+    conn = duckdb.connect()
+    conn.register("prod_frame", prod)
+    conn.execute("CREATE TABLE dukes_prod AS SELECT * FROM prod_frame")
+    expected = rw.read_sql_rows(db_path, query, tuple(params))[1]
+    assert len(expected) == 2
+    assert conn.execute(query, params).fetchall() == expected
+    conn.close()
+
+
+# ----------------------------
+# parquet mirror
+# ----------------------------
+
+def test_parquet_mirror_matches_sqlite(staged):
+    from queens.core import read_write as rw
+    stage_data("dukes", mirror=True)
+
+    path = rw.mirror_path(staged.DB_PATH, "dukes")
+    assert sorted(p.name for p in path.iterdir()) == ["table_name=1.1", "table_name=1.2"]
+
+    for filters in ({}, {"fuel": "GAS"}, {"fuel": {"like": "c%"}, "year": {"lt": 2021}},
+                    {"$or": [{"fuel": "gas"}, {"year": 2021}]}, {"fuel": {"neq": "gas"}}):
+        # normalize_filters consumes "$or" from the dict
+        expected = facade.query("dukes", "1.1", copy.deepcopy(filters), engine="sqlite")
+        table = facade.query("dukes", "1.1", filters, engine="parquet", as_arrow=True)
+
+        assert not pa.types.is_dictionary(table.schema.field("fuel").type)
+        df = table.to_pandas()[expected.columns].sort_values(["row", "year"], ignore_index=True)
+        assert df.equals(expected.sort_values(["row", "year"], ignore_index=True)), filters
+
+
+def test_restage_without_mirror_removes_it(staged):
+    from queens.core import read_write as rw
+    stage_data("dukes", mirror=True)
+    stage_data("dukes", mirror=False)
+
+    assert not rw.mirror_path(staged.DB_PATH, "dukes").exists()
+    with pytest.raises(RuntimeError, match="No Parquet mirror"):
+        facade.query("dukes", "1.1", engine="parquet")
+
+
+# ----------------------------
+# as-of queries
+# ----------------------------
+
+def test_query_as_of_reads_old_version_without_restaging(staged, db_path):
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+    stage_data("dukes")
+    staged_before = rw.get_staged_versions(db_path, "dukes")
+
+    old = facade.query("dukes", "1.1", {"fuel": "gas"}, as_of="2024-03-01")
+    new = facade.query("dukes", "1.1", {"fuel": "gas"})
+
+    assert old["value"].tolist() == [20.0, 21.0]
+    assert new["value"].tolist() == [120.0, 121.0]
+    assert "raw_rowid" not in old.columns
+    assert rw.get_staged_versions(db_path, "dukes") == staged_before
+
+    # nothing ingested yet at that date
+    assert facade.query("dukes", "1.1", as_of="2023-01-01").empty
+    with pytest.raises(ValueError):
+        facade.query("dukes", "1.1", as_of="2024-03-01", engine="parquet")
+
+
+def test_api_data_as_of(staged, db_path):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api.app import app
+
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+    stage_data("dukes")
+
+    client = TestClient(app)
+    res = client.get("/data/dukes", params={"table_name": "1.1", "as_of": "2024-03-01", "limit": 3})
+    assert res.status_code == 200
+    body = res.json()
+    assert [r["value"] for r in body["data"]] == [20.0, 21.0, 21.0]
+
+    res = client.get("/data/dukes", params={"table_name": "1.1", "as_of": "2024-03-01",
+                                            "cursor": body["next_cursor"]})
+    assert [r["value"] for r in res.json()["data"]] == [22.0]
+
+    assert client.get("/data/dukes", params={"table_name": "1.1", "as_of": "2023-01-01"}).status_code == 404
+    assert client.get("/data/dukes", params={"table_name": "1.1", "as_of": "01/03/2024"}).status_code == 422
+
+
+# ----------------------------
+# named snapshots
+# ----------------------------
+
+def test_named_snapshot_is_queried_alongside_prod(staged, db_path):
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+    stage_data("dukes")
+    stage_data("dukes", as_of_date="2024-03-01", name="q1")
+
+    assert rw.get_snapshots(db_path, "dukes") == {"q1": "2024-03-01T00:00:00"}
+    assert rw.get_snapshot_versions(db_path, "dukes") == {"1.1": {"2024-01-01T00:00:00"},
+                                                          "1.2": {"2024-01-01T00:00:00"}}
+
+    snap = facade.query("dukes", "1.1", {"fuel": "gas"}, snapshot="q1")
+    prod = facade.query("dukes", "1.1", {"fuel": "gas"})
+    assert snap["value"].tolist() == [20.0, 21.0]
+    assert prod["value"].tolist() == [120.0, 121.0]
+    assert facade.snapshots("dukes")["Tables"].tolist() == [2]
+
+    with pytest.raises(ValueError):
+        stage_data("dukes", name="q1", incremental=True)
+    with pytest.raises(ValueError):
+        rw.snapshot_table("dukes", "1st; DROP")
+    with pytest.raises(KeyError):
+        facade.query("dukes", "1.1", snapshot="missing")
+
+
+def test_maintain_keeps_snapshot_versions(staged, db_path):
+    stage_data("dukes", name="jan")
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+    _ingest(db_path, "1.1", "2024-09-01T00:00:00", df=_frame("1.1", offset=200))
+    stage_data("dukes")
+
+    facade.maintain("dukes", keep_last=1, vacuum=False)
+    assert facade.query("dukes", "1.1", {"fuel": "gas"}, snapshot="jan")["value"].tolist() == [20.0, 21.0]
+    # the June version is pruned: as-of reads fall back to the January one kept by the snapshot
+    assert facade.query("dukes", "1.1", {"fuel": "gas"}, as_of="2024-07-01")["value"].tolist() == [20.0, 21.0]
+
+    facade.drop_snapshot("dukes", "jan")
+    assert rw.get_snapshots(db_path, "dukes") == {}
+    assert not rw.table_exists("dukes_snap_jan", db_path)
+    with pytest.raises(KeyError):
+        facade.drop_snapshot("dukes", "jan")
+
+
+def test_api_data_snapshot(staged, db_path):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api.app import app
+
+    stage_data("dukes", name="q1")
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+    stage_data("dukes")
+
+    client = TestClient(app)
+    res = client.get("/data/dukes", params={"table_name": "1.1", "snapshot": "q1",
+                                            "filters": '{"fuel": "gas"}'})
+    assert res.status_code == 200
+    assert [r["value"] for r in res.json()["data"]] == [20.0, 21.0]
+
+    assert client.get("/data/dukes", params={"table_name": "1.1", "snapshot": "nope"}).status_code == 404
+    assert client.get("/data/dukes", params={"table_name": "1.1", "snapshot": "q1",
+                                             "as_of": "2024-03-01"}).status_code == 422
+
+
+# ----------------------------
+# version diff
+# ----------------------------
+
+def _revised_frame():
+    df = _frame("1.1", years=(2020, 2021, 2022))
+    df = df[~((df["fuel"] == "Coal") & (df["year"] == 2020))].copy()
+    df.loc[(df["fuel"] == "Gas") & (df["year"] == 2021), "value"] = 99.0
+    return df
+
+
+@pytest.mark.parametrize("encoded", [False, True])
+def test_diff_counts_and_cells(staged_settings, tmp_path, encoded):
+    from queens.etl.bootstrap import initialize
+
+    path = tmp_path / "diff.db"
+    staged_settings.DB_PATH = path
+    initialize(path, SCHEMA, dictionary_encoding=encoded)
+    assert rw.is_encoded("dukes", path) == encoded
+
+    _ingest(path, "1.1", "2024-01-01T00:00:00")
+    _ingest(path, "1.2", "2024-01-01T00:00:00")
+    _ingest(path, "1.1", "2024-06-01T00:00:00", df=_revised_frame())
+
+    summary = facade.diff("dukes", None, "2024-03-01")
+    assert summary.to_dict(orient="records") == [
+        {"table_name": "1.1", "from_ts": "2024-01-01T00:00:00", "to_ts": "2024-06-01T00:00:00",
+         "added": 2, "removed": 1, "changed": 1, "unchanged": 2},
+        {"table_name": "1.2", "from_ts": "2024-01-01T00:00:00", "to_ts": "2024-01-01T00:00:00",
+         "added": 0, "removed": 0, "changed": 0, "unchanged": 0},
+    ]
+
+    cells = facade.diff("dukes", "1.1", "2024-01-01T00:00:00", "2024-06-01T00:00:00", detail=True)
+    changed = cells[cells["change"] == "changed"].iloc[0]
+    assert (changed["fuel"], changed["year"], changed["old_value"], changed["new_value"]) == ("Gas", 2021, 21.0, 99.0)
+    removed = cells[cells["change"] == "removed"].iloc[0]
+    assert (removed["fuel"], removed["year"], removed["old_value"]) == ("Coal", 2020, 21.0)
+    assert removed[["new_value"]].isna().all()
+    assert sorted(cells.loc[cells["change"] == "added", "fuel"]) == ["Coal", "Gas"]
+
+    # nothing before the first ingest: everything is added
+    first = facade.diff("dukes", "1.2", "2023-01-01", "2024-01-01")
+    assert first[["added", "unchanged"]].values.tolist() == [[4, 0]]
+
+
+def test_api_diff(staged, db_path):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api.app import app
+
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_revised_frame())
+
+    client = TestClient(app)
+    res = client.get("/diff/dukes", params={"from_ts": "2024-03-01"})
+    assert res.status_code == 200
+    assert [(r["table_name"], r["changed"]) for r in res.json()["data"]] == [("1.1", 1), ("1.2", 0)]
+
+    res = client.get("/diff/dukes", params={"from_ts": "2024-03-01", "table_name": "1.1", "detail": True})
+    assert sorted(r["change"] for r in res.json()["data"]) == ["added", "added", "changed", "removed"]
+
+    assert client.get("/diff/nope", params={"from_ts": "2024-03-01"}).status_code == 404
+    assert client.get("/diff/dukes", params={"from_ts": "March"}).status_code == 422
+
+
+# ----------------------------
+# API serialisation
+# ----------------------------
+
+def test_records_from_rows_matches_pandas(monkeypatch):
+    import pandas as pd
+    import json
+    from queens.api import serialize as ser
+
+    columns = ["rowid", "table_description", "year", "fuel", "sector", "value"]
+    rows = [(1, "T", 2020, "Gas", None, 1.5), (2, "T", 2021, "Coal", None, None)]
+
+    df = pd.DataFrame(rows, columns=columns).drop(columns=["rowid", "table_description"])
+    expected = df.dropna(axis=1, how="all").astype(object).where(df.notna(), None).to_dict(orient="records")
+    records = ser.records_from_rows(columns, rows)
+    assert records == expected
+
+    # the json fallback produces the same document
+    fast = ser.dumps({"data": records})
+    monkeypatch.setattr(ser, "orjson", None)
+    assert json.loads(ser.dumps({"data": records})) == json.loads(fast)
+
+
+def test_api_stream_ndjson_and_csv(staged, monkeypatch):
+    pytest.importorskip("httpx")
+    import json
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    # several batches per response
+    monkeypatch.setattr(api, "STREAM_BATCH_SIZE", 3)
+    client = TestClient(api.app)
+
+    res = client.get("/stream/dukes", params={"table_name": "1.1"})
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert [r["value"] for r in lines] == [20.0, 21.0, 21.0, 22.0]
+    assert "ingest_id" not in lines[0] and lines[0]["table_name"] == "1.1"
+
+    res = client.get("/stream/dukes", params={"table_name": "1.1", "format": "csv",
+                                              "filters": '{"fuel": "coal"}'})
+    rows = res.text.splitlines()
+    assert rows[0].split(",")[:2] == ["table_name", "row"]
+    assert len(rows) == 3
+
+    res = client.get("/stream/dukes", params={"table_name": "1.1", "format": "csv",
+                                              "filters": '{"year": 1990}'})
+    assert len(res.text.splitlines()) == 1
+
+    assert client.get("/stream/dukes", params={"table_name": "1.1", "format": "xml"}).status_code == 422
+    assert client.get("/stream/dukes", params={"table_name": "9.9"}).status_code == 404
+
+
+def test_api_arrow_and_parquet_formats(staged, monkeypatch):
+    pytest.importorskip("httpx")
+    import io
+    import pyarrow.parquet as pq
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    client = TestClient(api.app)
+    params = {"table_name": "1.1", "limit": 3}
+
+    res = client.get("/data/dukes", params={**params, "format": "arrow"})
+    assert res.headers["content-type"] == "application/vnd.apache.arrow.stream"
+    table = pa.ipc.open_stream(res.content).read_all()
+    assert table["value"].to_pylist() == [20.0, 21.0, 21.0]
+    assert table.schema.field("year").type == pa.int64()
+    assert "ingest_id" not in table.column_names
+    assert table.schema.metadata[b"next_cursor"] == res.headers["x-next-cursor"].encode()
+
+    res = client.get("/data/dukes", params=params, headers={"Accept": "application/vnd.apache.parquet"})
+    assert pq.read_table(io.BytesIO(res.content))["value"].to_pylist() == [20.0, 21.0, 21.0]
+
+    # JSON stays the default
+    assert client.get("/data/dukes", params=params, headers={"Accept": "*/*"}).json()["next_cursor"]
+    assert client.get("/data/dukes", params={**params, "format": "xml"}).status_code == 422
+
+    monkeypatch.setattr(api, "STREAM_BATCH_SIZE", 3)
+    res = client.get("/stream/dukes", params={"table_name": "1.1", "format": "arrow"})
+    reader = pa.ipc.open_stream(res.content)
+    assert [b.num_rows for b in reader] == [3, 1]
+
+    res = client.get("/stream/dukes", params={"table_name": "1.1"},
+                     headers={"Accept": "application/vnd.apache.parquet"})
+    parquet = pq.ParquetFile(io.BytesIO(res.content))
+    assert parquet.metadata.num_row_groups == 2
+    assert parquet.read()["fuel"].to_pylist() == ["Gas", "Gas", "Coal", "Coal"]
+
+
+# ----------------------------
+# API response cache
+# ----------------------------
+
+def test_response_cache_lru_and_versions():
+    from queens.api.cache import ResponseCache
+
+    cache = ResponseCache(max_bytes=40)
+    cache.put(("a",), "v1", (b"x" * 10, "application/json", {}))
+    cache.put(("b",), "v1", (b"x" * 10, "application/json", {}))
+    assert cache.get(("a",), "v1") is not None
+    cache.put(("c",), "v1", (b"x" * 10, "application/json", {}))
+    cache.put(("d",), "v1", (b"x" * 10, "application/json", {}))
+    cache.put(("e",), "v1", (b"x" * 10, "application/json", {}))
+
+    # least recently used entry evicted, size bounded
+    assert cache.get(("b",), "v1") is None
+    assert cache.get(("a",), "v1") is not None
+    assert cache.stats()["bytes"] <= 40
+
+    # a new snapshot version drops everything
+    assert cache.get(("a",), "v2") is None
+    assert cache.stats()["entries"] == 0
+
+    disabled = ResponseCache(max_bytes=0)
+    disabled.put(("a",), "v1", (b"x", "application/json", {}))
+    assert disabled.get(("a",), "v1") is None
+
+
+def test_api_cache_invalidated_by_stage(staged, db_path):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    api.response_cache.clear()
+    client = TestClient(api.app)
+    params = {"table_name": "1.1", "filters": '{"fuel": "gas", "year": {"gte": 2020}}'}
+
+    assert client.get("/data/dukes", params=params).headers["x-cache"] == "MISS"
+    # same query, filters in another order
+    res = client.get("/data/dukes", params={**params, "filters": '{"year": {"gte": 2020}, "fuel": "gas"}'})
+    assert res.headers["x-cache"] == "HIT"
+    assert [r["value"] for r in res.json()["data"]] == [20.0, 21.0]
+    assert client.get("/metadata/dukes", params={"table_name": "1.1"}).headers["x-cache"] == "MISS"
+    assert client.get("/metadata/dukes", params={"table_name": "1.1"}).headers["x-cache"] == "HIT"
+
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+    stage_data("dukes")
+
+    res = client.get("/data/dukes", params=params)
+    assert res.headers["x-cache"] == "MISS"
+    assert [r["value"] for r in res.json()["data"]] == [120.0, 121.0]
+    assert client.get("/cache/stats").json()["hits"] == 2
+
+
+def test_api_etag_conditional_get(staged, db_path):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    client = TestClient(api.app)
+    params = {"table_name": "1.1"}
+
+    res = client.get("/data/dukes", params=params)
+    etag = res.headers["etag"]
+    assert res.headers["cache-control"] == api.CACHE_CONTROL
+
+    # ETags only depend on the snapshot version and the request
+    api.response_cache.clear()
+    res = client.get("/data/dukes", params=params, headers={"If-None-Match": f'"other", W/{etag}'})
+    assert res.status_code == 304 and res.content == b""
+    assert client.get("/data/dukes", params={**params, "format": "arrow"}).headers["etag"] != etag
+
+    meta = client.get("/metadata/dukes", params=params)
+    assert client.get("/metadata/dukes", params=params,
+                      headers={"If-None-Match": meta.headers["etag"]}).status_code == 304
+
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1", offset=100))
+    stage_data("dukes")
+    res = client.get("/data/dukes", params=params, headers={"If-None-Match": etag})
+    assert res.status_code == 200 and res.headers["etag"] != etag
+
+
+def test_metadata_registry_reloads_on_new_snapshot(staged, db_path):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    info = rw.load_all_column_info(db_path)
+    assert info[("dukes", None, "1.1")] == rw.load_column_info(db_path, "dukes", "1.1")
+
+    api.response_cache.clear()
+    api.metadata_registry.clear()
+    loads = api.metadata_registry.loads
+    client = TestClient(api.app)
+    for filters in ('{"fuel": "gas"}', '{"fuel": "coal"}', '{"year": 2021}'):
+        assert client.get("/data/dukes", params={"table_name": "1.1", "filters": filters}).status_code == 200
+    assert api.metadata_registry.loads == loads + 1
+
+    stage_data("dukes", name="q1")
+    res = client.get("/data/dukes", params={"table_name": "1.2", "snapshot": "q1"})
+    assert res.status_code == 200
+    assert api.metadata_registry.loads == loads + 2
+    assert client.get("/data/dukes", params={"table_name": "1.1", "filters": '{"sector": "x"}'}).status_code == 422
+
+
+def _check_batch(client, parallel):
+    body = {"parallel": parallel,
+            "queries": [{"id": "gas", "table_name": "1.1", "filters": {"fuel": "gas"}},
+                        {"table_name": "1.2", "fields": ["year", "value"], "limit": 1},
+                        {"id": "bad", "table_name": "1.1", "filters": {"sector": "x"}}]}
+
+    res = client.post("/batch/dukes", json=body)
+    assert res.status_code == 200
+    results = res.json()["results"]
+
+    single = client.get("/data/dukes", params={"table_name": "1.1", "filters": '{"fuel": "gas"}'}).json()
+    assert results["gas"] == single
+    assert results["1"]["next_cursor"] is not None
+    assert set(results["1"]["data"][0]) == {"year", "value"}
+    assert results["bad"]["error"]["status"] == 422
+
+    body["queries"][1]["id"] = "gas"
+    assert client.post("/batch/dukes", json=body).status_code == 422
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_api_batch(staged, parallel, monkeypatch):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    # run the startup, which starts the batch threads
+    monkeypatch.setattr(api.s, "setup_logging", lambda **kwargs: None)
+    with TestClient(api.app) as client:
+        _check_batch(client, parallel)
+        assert len(api.batch_executor._threads) <= api.BATCH_WORKERS
+    assert api.batch_executor is None
+
+
+def test_aggregate_pushes_group_by_to_sql(staged):
+    df = facade.aggregate("dukes", "1.1", group_by=["year"], agg="sum")
+    assert df.to_dict(orient="records") == [{"year": 2020, "value": 41.0}, {"year": 2021, "value": 43.0}]
+
+    # same result as aggregating the full query in pandas
+    full = facade.query("dukes", "1.1", {"year": {"gte": 2021}})
+    expected = full.groupby("fuel", as_index=False)["value"].max()
+    df = facade.aggregate("dukes", "1.1", group_by="fuel", agg="max", filters={"year": {"gte": 2021}})
+    assert df.to_dict(orient="records") == expected.to_dict(orient="records")
+
+    assert facade.aggregate("dukes", "1.1", agg="count")["value"].tolist() == [4]
+
+    with pytest.raises(ValueError):
+        facade.aggregate("dukes", "1.1", group_by="year", agg="median")
+    with pytest.raises(ValueError):
+        facade.aggregate("dukes", "1.1", group_by="value")
+    with pytest.raises(KeyError):
+        facade.aggregate("dukes", "1.1", group_by="nope")
+
+
+def test_api_aggregate(staged):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    client = TestClient(api.app)
+    params = {"table_name": "1.1", "group_by": "fuel,year", "agg": "avg", "filters": '{"fuel": "gas"}'}
+    res = client.get("/aggregate/dukes", params=params)
+    assert res.status_code == 200
+    assert res.json()["data"] == [{"fuel": "Gas", "year": 2020, "value": 20.0},
+                                  {"fuel": "Gas", "year": 2021, "value": 21.0}]
+    assert client.get("/aggregate/dukes", params=params).headers["x-cache"] == "HIT"
+
+    assert client.get("/aggregate/dukes", params={**params, "agg": "median"}).status_code == 422
+    assert client.get("/aggregate/dukes", params={**params, "group_by": "sector"}).status_code == 422
+
+
+def test_query_fields_projects_columns(staged):
+    full = facade.query("dukes", "1.1", {"fuel": "gas"})
+    df = facade.query("dukes", "1.1", {"fuel": "gas"}, fields=["year", "fuel", "value"])
+
+    assert df.columns.tolist() == ["year", "fuel", "value"]
+    assert df.equals(full[["year", "fuel", "value"]])
+    assert facade.query("dukes", "1.1", fields="value", as_arrow=True).column_names == ["value"]
+
+    with pytest.raises(KeyError):
+        facade.query("dukes", "1.1", fields=["nope"])
+    with pytest.raises(NameError):
+        facade.query("dukes", "1.1", fields=["ingest_id"])
+
+
+def test_api_data_fields(staged):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    client = TestClient(api.app)
+    res = client.get("/data/dukes", params={"table_name": "1.1", "fields": "year,value"})
+    assert res.status_code == 200
+    body = res.json()
+    assert [set(r) for r in body["data"]] == [{"year", "value"}] * 4
+    assert body["table_description"] == "Table 1.1"
+
+    assert client.get("/data/dukes", params={"table_name": "1.1", "fields": "year,nope"}).status_code == 422
+
+
+def test_query_selects_metadata_columns(staged_settings, db_path):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    # 1.2 does not use the unit column
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    _ingest(db_path, "1.2", "2024-01-01T00:00:00", df=_frame("1.2").drop(columns="unit"))
+    stage_data("dukes")
+
+    df = facade.query("dukes", "1.2")
+    assert df.columns.tolist() == ["table_description", "table_name", "row", "label", "year", "fuel", "value"]
+    assert facade.query("dukes", "1.2", {"fuel": "nothing"}).columns.tolist() == df.columns.tolist()
+
+    # columns listed in the metadata are kept even if null in the page
+    _ingest(db_path, "1.1", "2024-06-01T00:00:00", df=_frame("1.1").assign(unit=[None, None, "ktoe", "ktoe"]))
+    stage_data("dukes")
+    res = TestClient(api.app).get("/data/dukes", params={"table_name": "1.1", "filters": '{"fuel": "gas"}'})
+    assert [r["unit"] for r in res.json()["data"]] == [None, None]
+
+
+def test_api_health_follows_worker_lifespan(staged, monkeypatch):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    monkeypatch.setattr(api.s, "setup_logging", lambda **kwargs: None)
+    api.ready.clear()
+    assert TestClient(api.app).get("/health").status_code == 503
+
+    # entering the client runs the startup of the worker: registry loaded, then ready
+    with TestClient(api.app) as client:
+        res = client.get("/health")
+        assert res.status_code == 200
+        assert res.json()["snapshot_version"] == rw.get_snapshot_version(staged.DB_PATH)
+        assert api.metadata_registry.loads >= 1
+
+    assert not api.ready.is_set()
+    assert api.response_cache.stats()["entries"] == 0
+
+
+@pytest.fixture
+def staged_with_group(staged_settings, db_path):
+    # `group` is a column of the DUKES schema and an SQL keyword
+    _ingest(db_path, "1.1", "2024-01-01T00:00:00")
+    _ingest(db_path, "1.2", "2024-01-01T00:00:00", df=_frame("1.2").assign(group=["A", "B", "A", "B"]))
+    stage_data("dukes")
+    return staged_settings
+
+
+def test_keyword_columns_are_quoted(staged_with_group):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    df = facade.query("dukes", "1.2")
+    assert df["group"].tolist() == ["A", "B", "A", "B"]
+
+    client = TestClient(api.app)
+    res = client.get("/data/dukes", params={"table_name": "1.2"})
+    assert res.status_code == 200
+    assert [r["group"] for r in res.json()["data"]] == ["A", "B", "A", "B"]
+
+    res = client.post("/batch/dukes", json={"queries": [{"table_name": "1.2"}]})
+    assert "error" not in res.json()["results"]["0"]
+
+
+def test_aggregate_by_keyword_column(staged_with_group):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    df = facade.aggregate("dukes", "1.2", group_by=["group"], agg="count")
+    assert df.to_dict(orient="records") == [{"group": "A", "value": 2}, {"group": "B", "value": 2}]
+
+    res = TestClient(api.app).get("/aggregate/dukes", params={"table_name": "1.2", "group_by": "group", "agg": "count"})
+    assert res.status_code == 200
+    assert res.json()["data"] == df.to_dict(orient="records")
+
+
+def test_fields_with_keyword_column(staged_with_group):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    df = facade.query("dukes", "1.2", fields=["group", "value"])
+    assert df.columns.tolist() == ["group", "value"]
+
+    res = TestClient(api.app).get("/data/dukes", params={"table_name": "1.2", "fields": "group,value"})
+    assert res.status_code == 200
+    assert [r["group"] for r in res.json()["data"]] == df["group"].tolist()
+
+
+def test_gunicorn_conf(staged, monkeypatch):
+    from types import SimpleNamespace
+    from queens.api import gunicorn_conf as conf
+
+    assert conf.worker_class == "uvicorn_worker.UvicornWorker"
+    assert conf.workers >= 1 and not conf.preload_app
+    assert conf.graceful_timeout == staged.SHUTDOWN_TIMEOUT
+
+    # the master checks that the DB can be served read-only
+    monkeypatch.setattr(staged, "READ_ONLY", True)
+    rw.close_readers()
+    conf.on_starting(SimpleNamespace(cfg=SimpleNamespace(workers=2)))
+    rw.close_readers()
+
+
+def test_api_conditional_get_on_missing_resource(staged):
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from queens.api import app as api
+
+    client = TestClient(api.app)
+    star = {"If-None-Match": "*"}
+    assert client.get("/data/dukes", params={"table_name": "1.1"}, headers=star).status_code == 304
+
+    assert client.get("/data/nope", params={"table_name": "1.1"}, headers=star).status_code == 404
+    assert client.get("/data/dukes", params={"table_name": "9.9"}, headers=star).status_code == 404
+    assert client.get("/data/dukes", params={"table_name": "1.1", "snapshot": "q1"}, headers=star).status_code == 404
+    assert client.get("/aggregate/dukes", params={"table_name": "9.9"}, headers=star).status_code == 404
+    assert client.get("/metadata/dukes", params={"table_name": "9.9"}, headers=star).status_code == 404
+    assert client.get("/metadata/dukes", params={"table_name": "1.1"}, headers=star).status_code == 304